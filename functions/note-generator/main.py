@@ -1,57 +1,323 @@
 import os
 import json
-import boto3
-import uuid
-import ydb
-import requests
-from markdown_pdf import MarkdownPdf, Section
 import io
+import random
+import traceback
+import time
+from contextlib import contextmanager
+import uuid
+import re
+import threading
+from collections import deque
+from difflib import SequenceMatcher
+
+TASK_ENVELOPE_VERSION = 1
+STAGE_NAME = 'note-generator'
+
+STORAGE_ENDPOINT = os.environ.get('STORAGE_ENDPOINT', 'https://storage.yandexcloud.net')
+QUEUE_ENDPOINT = os.environ.get('QUEUE_ENDPOINT', 'https://message-queue.api.cloud.yandex.net')
+GPT_API_URL = os.environ.get('GPT_API_URL', 'https://llm.api.cloud.yandex.net')
+
+# Общий для всех инстансов бюджет YandexGPT в таблице api_budget: одновременные запросы
+# и запросы в секунду. Слот занят на время запроса, аренда покрывает его таймаут
+GPT_API = 'yandexgpt'
+GPT_MAX_OPERATIONS = int(os.environ.get('GPT_MAX_OPERATIONS', '10'))
+GPT_MAX_RPS = int(os.environ.get('GPT_MAX_RPS', '10'))
+GPT_LEASE_SECONDS = 120
+# Задержка повторной попытки растет с числом откладываний; SQS допускает не больше 900 секунд
+QUOTA_RETRY_SECONDS = 10
+MAX_DELAY_SECONDS = 900
+
+# Сжатие расшифровки перед запросом к YandexGPT. Междометия удаляются везде; слова-паразиты —
+# в начале фразы или между запятыми, в остальных местах они могут нести смысл ("в общем случае").
+# "мм" — единица измерения, поэтому междометием считается только растянутое "ммм"
+HESITATIONS = r'э+|э-э+(?:-э+)*|а-а+(?:-а+)*|аа+|м{3,}|мм-м+(?:-м+)*|эм+|хм+'
+LEADING_FILLERS = r'ну|вот|ну вот|как бы|так сказать|это самое|скажем так|в общем-то|как говорится|короче говоря|собственно говоря'
+PARENTHETICAL_FILLERS = LEADING_FILLERS + r'|значит|типа|в общем|короче|собственно|знаете|понимаете|видите'
+# Фраза сравнивается только с последними NEAR_DUPLICATE_WINDOW оставленными фразами: дословный
+# повтор одной из них отбрасывается, а то же определение, повторенное лектором в другой части
+# лекции, сохраняется. Фраза из NEAR_DUPLICATE_MIN_WORDS слов и длиннее отбрасывается как почти
+# дословный повтор недавней, только если не добавляет к ней ни одного слова, совпадает с ней
+# по порядку слов не меньше чем на NEAR_DUPLICATE_SIMILARITY и содержит те же отрицания и числа:
+# "верно" после "не верно" — поправка, а не повтор
+NEAR_DUPLICATE_MIN_WORDS = 4
+NEAR_DUPLICATE_SIMILARITY = 0.9
+NEAR_DUPLICATE_WINDOW = 8
+NEGATIONS = {'не', 'ни', 'нет'}
+# Оценка токенов без запроса к API токенизации: в среднем токен на 4 символа слова
+CHARS_PER_TOKEN = 4
+
+# Страница конспекта: формат и поля в пунктах
+PDF_PAPER_SIZE = 'A4'
+PDF_BORDERS = (36, 36, -36, -36)
+# Встроенные шрифты MuPDF с кириллицей: подключаются один раз, чтобы рендеринг не искал
+# запасной шрифт для каждого конспекта. Ключ — код шрифта PyMuPDF, значение — правило @font-face
+PDF_FONTS = {
+    'helv': 'font-family: text;',
+    'hebo': 'font-family: text; font-weight: bold;',
+    'heit': 'font-family: text; font-style: italic;',
+    'hebi': 'font-family: text; font-weight: bold; font-style: italic;',
+    'cour': 'font-family: mono;',
+    'cobo': 'font-family: mono; font-weight: bold;'
+}
+PDF_CSS = """
+body { font-family: text; font-size: 11pt; line-height: 1.4; }
+code, pre { font-family: mono; font-size: 10pt; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #999; padding: 2pt 4pt; }
+"""
+
+# Запись статуса повторяется внутри обработки сообщения: ошибка одного сообщения не возвращает
+# в очередь всю пачку, уже выполненные сообщения которой иначе обработались бы повторно.
+# Если статус так и не записан, а сообщение еще не передано дальше, повторяется только оно
+FLUSH_ATTEMPTS = 3
+FLUSH_RETRY_SECONDS = 1
+STATUS_RETRY_DELAY_SECONDS = 30
+
+# Потоков для блокирующих вызовов SDK и соединений в пулах клиентов — с запасом на пачку сообщений
+IO_CONCURRENCY = 16
+
+_cold_start = True
+_s3_client = None
+_sqs_client = None
+_http_session = None
+_ydb_driver = None
+_ydb_pool = None
+_io_executor = None
+_pdf_renderer = None
+# PyMuPDF не рассчитан на одновременную работу из нескольких потоков
+_pdf_lock = threading.Lock()
 
 def handler(event, context):
+    # asyncio импортируется в вызове, а не при загрузке модуля, чтобы не удлинять холодный старт
+    import asyncio
+
+    asyncio.run(handle_messages(event['messages']))
+
+async def handle_messages(messages):
+    # Сообщения пачки триггера обрабатываются конкурентно в одном цикле событий
+    import asyncio
+
+    results = await asyncio.gather(*(handle_message(message) for message in messages), return_exceptions=True)
+    # Сообщение само повторяет запись статуса или возвращает себя в очередь; пачка целиком
+    # в очередь не возвращается
+    for result in results:
+        if isinstance(result, Exception):
+            Tracer(STAGE_NAME).error(result)
+
+async def handle_message(message):
+    import asyncio
+
+    started_at = time.time()
+    status_writer = StatusWriter(STAGE_NAME)
+    tracer = Tracer(STAGE_NAME, status_writer)
+    lease_held = False
+    # Сообщение передано дальше или отложено: повторять его уже нельзя
+    handed_off = False
+    consumed_text_url = None
     try:
         # 1. Парсинг сообщения из очереди
-        message = event['messages'][0]['details']['message']
-        data = json.loads(message['body'])
+        data = json.loads(message['details']['message']['body'])
+        envelope = get_task_envelope(data)
         task_id = data['task_id']
+        tracer.bind(task_id)
+
+        # 2. Слот в бюджете YandexGPT: если он исчерпан, задача откладывается
+        lease_held, usage = await run_io(
+            acquire_api_budget, GPT_API, task_id, GPT_MAX_OPERATIONS, GPT_MAX_RPS, GPT_LEASE_SECONDS
+        )
+        delay_seconds = 0 if lease_held else quota_delay_seconds(usage, data.get('deferrals', 0))
+        tracer.log('api_budget', admitted=lease_held, delay_seconds=delay_seconds, **usage)
+        if not lease_held:
+            await run_io(defer_to_queue, data, delay_seconds)
+            handed_off = True
+            return
+        status_writer.start(task_id)
         
-        # 2. Загрузка текста из Storage
+        # 3. Загрузка текста из Storage
+        # Название берется из конверта; чтение из YDB — только для сообщений без него,
+        # и тогда оно идет параллельно с загрузкой текста
         storage_url = data['storage_url']
-        text_content = download_text_from_storage(storage_url)
+        with tracer.span('download_text_from_storage') as span:
+            text_content, lecture_title = await asyncio.gather(
+                run_io(download_text_from_storage, storage_url),
+                no_io(envelope['lecture_title']) if envelope.get('lecture_title') else run_io(get_lecture_title, task_id)
+            )
+            span['bytes'] = len(text_content.encode('utf-8'))
         
-        # 3. Генерация конспекта через YandexGPT
-        lecture_title = get_lecture_title(task_id)
-        note_md_content = generate_note_with_yagpt(text_content, lecture_title)
+        # 4. Сжатие расшифровки: короче запрос — быстрее и дешевле ответ YandexGPT
+        with tracer.span('compact_transcript') as span:
+            text_content, compaction = compact_transcript(text_content)
+            span.update(compaction)
+
+        # 5. Генерация конспекта через YandexGPT
+        with tracer.span('generate_note_with_yagpt'):
+            note_md_content = await run_io(generate_note_with_yagpt, text_content, lecture_title)
         
-        # 4. Конвертация конспекта в PDF
-        pdf = convert_markdown_to_pdf(note_md_content)
+        # 6. Конвертация конспекта в PDF; слот YandexGPT освобождается параллельно.
+        # Ошибка освобождения не проваливает задачу: слот освободится сам по истечении аренды
+        lease_held = False
+        with tracer.span('convert_markdown_to_pdf') as span:
+            rendered, released = await asyncio.gather(
+                run_io(convert_markdown_to_pdf, note_md_content),
+                run_io(release_api_budget, GPT_API, task_id),
+                return_exceptions=True
+            )
+            if isinstance(released, Exception):
+                tracer.error(released)
+            if isinstance(rendered, Exception):
+                raise rendered
+            pdf, rendering = rendered
+            span.update(rendering)
         
-        # 5. Загрузка PDF в Storage
-        storage_url = upload_pdf_to_storage(pdf)
+        # 7. Загрузка PDF в Storage
+        with tracer.span('upload_pdf_to_storage') as span, pdf:
+            pdf_url = await run_io(upload_pdf_to_storage, pdf)
+            span['bytes'] = rendering['bytes']
+        handed_off = True
         
-        # 6. Обновление статуса задачи в YDB
-        update_task_with_result(task_id, storage_url)
+        # 8. Обновление статуса задачи в YDB
+        status_writer.event('completed')
+        status_writer.set_status('Успешно завершено', pdf_url=pdf_url)
+
+        # 9. Итоговые тайминги этапов из конверта задачи
+        record_stage_timing(envelope, STAGE_NAME, started_at)
+        tracer.log('timings', timings=envelope['timings'])
+
+        # 10. Текст распознавания больше не нужен: остается только PDF
+        consumed_text_url = storage_url
         
+    except QuotaExceeded as e:
+        # 429 от YandexGPT: задача не проваливается, а повторяется позже
+        delay_seconds = e.retry_after or quota_delay_seconds({}, data.get('deferrals', 0))
+        tracer.log('throttled', api=GPT_API, delay_seconds=delay_seconds)
+        status_writer.event('throttled', f'YandexGPT: повтор через {delay_seconds} с')
+        await run_io(defer_to_queue, data, delay_seconds)
+        handed_off = True
     except Exception as e:
-        update_task_status(task_id, 'Ошибка', 'Произошла ошибка во время генерации конспекта')
+        tracer.error(e)
+        status_writer.fail('Произошла ошибка во время генерации конспекта')
+    finally:
+        # Запись статуса и освобождение слота не зависят друг от друга
+        flushed, release = await asyncio.gather(
+            flush_status(status_writer, tracer),
+            run_io(release_api_budget, GPT_API, task_id) if lease_held else no_io(),
+            return_exceptions=True
+        )
+        if isinstance(release, Exception):
+            tracer.error(release)
+        if not flushed and not handed_off:
+            try:
+                await run_io(defer_to_queue, data, STATUS_RETRY_DELAY_SECONDS)
+            except Exception as e:
+                tracer.error(e)
+        # Текст удаляется только после записи итогового статуса, иначе повтору было бы не из чего
+        # сделать конспект; текст, который не удалось удалить, удалит правило жизненного цикла
+        if flushed and consumed_text_url:
+            try:
+                await run_io(delete_storage_object, consumed_text_url)
+            except Exception as e:
+                tracer.error(e)
+        tracer.finish()
+
+async def flush_status(status_writer, tracer):
+    # Запись идемпотентна: события адресуются временем, статус перезаписывается
+    import asyncio
+
+    for attempt in range(FLUSH_ATTEMPTS):
+        try:
+            await run_io(status_writer.flush)
+            return True
+        except Exception as e:
+            tracer.error(e)
+            if attempt + 1 < FLUSH_ATTEMPTS:
+                await asyncio.sleep(FLUSH_RETRY_SECONDS * 2 ** attempt)
+    return False
+
+async def run_io(func, *args):
+    # Блокирующий вызов SDK выполняется в общем пуле потоков, а цикл событий
+    # тем временем продолжает другие операции этого и соседних сообщений
+    import asyncio
+
+    return await asyncio.get_running_loop().run_in_executor(get_io_executor(), func, *args)
+
+async def no_io(value=None):
+    return value
 
 def download_text_from_storage(storage_url):
     bucket_name = storage_url.split('//')[1].split('.')[0]
     object_key = storage_url.split(bucket_name + '.storage.yandexcloud.net/')[1]
-    
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    
-    s3 = boto3.client('s3',
-        endpoint_url='https://storage.yandexcloud.net',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
+
+    s3 = get_s3_client()
     
     response = s3.get_object(Bucket=bucket_name, Key=object_key)
     content = response['Body'].read().decode('utf-8')
     
     return content
 
+def delete_storage_object(storage_url):
+    bucket_name = storage_url.split('//')[1].split('.')[0]
+    object_key = storage_url.split(bucket_name + '.storage.yandexcloud.net/')[1]
+
+    get_s3_client().delete_object(Bucket=bucket_name, Key=object_key)
+
+def compact_transcript(text):
+    # Фразы берутся по строкам расшифровки (одна строка — одна реплика) и по концу предложения.
+    # Результат детерминирован: зависит только от текста
+    kept = []
+    recent = deque(maxlen=NEAR_DUPLICATE_WINDOW)
+    for phrase in re.split(r'\n+|(?<=[.!?]) +', remove_disfluencies(text)):
+        phrase = phrase.strip(' ,;:')
+        words = re.findall(r'\w+', phrase.lower())
+        if not words:
+            continue
+
+        if any(words == other for other in recent):
+            continue
+        if len(words) >= NEAR_DUPLICATE_MIN_WORDS and any(is_near_duplicate(words, other) for other in recent):
+            continue
+
+        recent.append(words)
+        kept.append(phrase)
+
+    compacted = '\n'.join(kept)
+    tokens_before = estimate_tokens(text)
+    tokens_after = estimate_tokens(compacted)
+    return compacted, {
+        'bytes': len(text.encode('utf-8')),
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_removed_percent': round(100 * (1 - tokens_after / tokens_before), 1) if tokens_before else 0.0
+    }
+
+def is_near_duplicate(words, other):
+    if not set(words) <= set(other) or meaning_markers(words) != meaning_markers(other):
+        return False
+    return SequenceMatcher(None, words, other, autojunk=False).ratio() >= NEAR_DUPLICATE_SIMILARITY
+
+def meaning_markers(words):
+    return {word for word in words if word in NEGATIONS or any(char.isdigit() for char in word)}
+
+def remove_disfluencies(text):
+    # Весь текст обрабатывается за один проход каждого выражения; границы строк сохраняются
+    flags = re.IGNORECASE | re.MULTILINE
+    space = r'[^\S\n]'
+    text = re.sub(rf'(?<!\w)(?:{HESITATIONS})(?![\w-])', ' ', text, flags=flags)
+    text = re.sub(rf'(?:^|(?<=[.!?;:])){space}*(?:{LEADING_FILLERS})(?![\w-]){space}*,?', ' ', text, flags=flags)
+    text = re.sub(rf'(?:^|,){space}*(?:{PARENTHETICAL_FILLERS}){space}*(?:,|(?=[.!?;:]|$))', ' ', text, flags=flags)
+    # Повторы слова подряд ("что что что") — обычно запинка; числа не трогаем ("точка 0 0")
+    text = re.sub(rf'\b([^\W\d_]+)(?:{space}+\1\b)+', r'\1', text, flags=flags)
+    text = re.sub(rf'{space}+([,.!?;:])', r'\1', text)
+    text = re.sub(r'([,;:])(?:[^\S\n]*[,;:])+', r'\1', text)
+    # Запятая от удаленного междометия перед концом предложения ("равен 0, ммм.")
+    text = re.sub(r'[,;:]+(?=[.!?])', '', text)
+    return re.sub(rf'{space}+', ' ', text)
+
+def estimate_tokens(text):
+    words = re.findall(r'\w+', text)
+    punctuation = len(re.findall(r'[^\w\s]', text))
+    return sum(1 + (len(word) - 1) // CHARS_PER_TOKEN for word in words) + punctuation
+
 def generate_note_with_yagpt(text_content, lecture_title):
     prompt = f"""
     Создай конспект лекции "{lecture_title}" на основе текста ниже.
@@ -95,13 +361,15 @@ def generate_note_with_yagpt(text_content, lecture_title):
         ]
     }
     
-    response = requests.post(
-        "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
+    response = get_http_session().post(
+        f"{GPT_API_URL}/foundationModels/v1/completion",
         headers=headers,
         json=payload,
         timeout=60
     )
     
+    if response.status_code == 429:
+        raise QuotaExceeded(parse_retry_after(response.headers.get('Retry-After')))
     if response.status_code != 200:
         raise Exception(f"YandexGPT error: {response.status_code} - {response.text}")
     
@@ -110,26 +378,96 @@ def generate_note_with_yagpt(text_content, lecture_title):
     
     return note
 
-def convert_markdown_to_pdf(markdown_content):    
-    pdf = MarkdownPdf()
-    
-    pdf.add_section(Section(markdown_content))
-    
-    out = io.BytesIO()
-    pdf.save_bytes(out)
-    return out.getvalue() 
-        
+def parse_retry_after(value):
+    try:
+        return min(max(int(value), 1), MAX_DELAY_SECONDS)
+    except (TypeError, ValueError):
+        return None
+
+def acquire_api_budget(api, lease_id, max_operations, max_rps, lease_seconds):
+    # Строки api_budget: kind = 'operation' — занятый слот до освобождения или конца аренды,
+    # kind = 'request' — отметка запроса, живет одну секунду и ограничивает RPS
+    import ydb
+
+    select_query = """
+    DECLARE $api AS Utf8;
+
+    SELECT leaseId, kind, expiresAt
+    FROM api_budget
+    WHERE api = $api;
+    """
+    admit_query = """
+    DECLARE $api AS Utf8;
+    DECLARE $expired AS List<Utf8>;
+    DECLARE $leases AS List<Struct<
+        leaseId: Utf8,
+        kind: Utf8,
+        expiresAt: Timestamp
+    >>;
+
+    DELETE FROM api_budget
+    WHERE api = $api AND leaseId IN $expired;
+
+    UPSERT INTO api_budget (api, leaseId, kind, expiresAt)
+    SELECT $api AS api, leaseId, kind, expiresAt
+    FROM AS_TABLE($leases);
+    """
+
+    def callee(session):
+        # Подсчет занятого бюджета и запись новых строк — в одной сериализуемой транзакции
+        tx = session.transaction(ydb.SerializableReadWrite()).begin()
+        rows = tx.execute(session.prepare(select_query), {'$api': api})[0].rows
+        now = int(time.time() * 1000000)
+        active = [row for row in rows if row.expiresAt > now and row.leaseId != lease_id]
+        usage = {
+            'api': api,
+            'operations': sum(1 for row in active if row.kind == 'operation'),
+            'max_operations': max_operations,
+            'requests_per_second': sum(1 for row in active if row.kind == 'request'),
+            'max_rps': max_rps
+        }
+        if usage['operations'] >= max_operations or usage['requests_per_second'] >= max_rps:
+            tx.rollback()
+            return False, usage
+
+        tx.execute(session.prepare(admit_query), {
+            '$api': api,
+            '$expired': [row.leaseId for row in rows if row.expiresAt <= now],
+            '$leases': [
+                {'leaseId': lease_id, 'kind': 'operation', 'expiresAt': now + lease_seconds * 1000000},
+                {'leaseId': str(uuid.uuid4()), 'kind': 'request', 'expiresAt': now + 1000000}
+            ]
+        }, commit_tx=True)
+        return True, usage
+
+    return get_session_pool().retry_operation_sync(callee)
+
+def release_api_budget(api, lease_id):
+    query = """
+    DECLARE $api AS Utf8;
+    DECLARE $lease_id AS Utf8;
 
-def upload_pdf_to_storage(pdf_bytes):
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
+    DELETE FROM api_budget
+    WHERE api = $api AND leaseId = $lease_id;
+    """
+    execute_query(query, {'$api': api, '$lease_id': lease_id})
+
+def quota_delay_seconds(usage, deferrals):
+    # Исчерпан только RPS — хватит секунды; заняты все слоты — экспоненциальная задержка
+    # со случайной добавкой, чтобы отложенные задачи не возвращались одновременно
+    if usage.get('operations', 0) < usage.get('max_operations', 0):
+        return random.randint(1, 2)
+    delay_seconds = QUOTA_RETRY_SECONDS * 2 ** min(deferrals, 5)
+    return min(delay_seconds + random.randint(0, QUOTA_RETRY_SECONDS), MAX_DELAY_SECONDS)
+
+def convert_markdown_to_pdf(markdown_content):
+    with _pdf_lock:
+        return get_pdf_renderer().render(markdown_content)
+
+def upload_pdf_to_storage(pdf_file):
     bucket_name = os.environ['STORAGE_BUCKET']
     
-    s3 = boto3.client('s3',
-        endpoint_url='https://storage.yandexcloud.net',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
+    s3 = get_s3_client()
     
     file_name = f"{uuid.uuid4()}.pdf"
     object_key = f"notes/{file_name}"
@@ -137,54 +475,375 @@ def upload_pdf_to_storage(pdf_bytes):
     s3.put_object(
         Bucket=bucket_name,
         Key=object_key,
-        Body=pdf_bytes,
+        Body=pdf_file,
         ContentType='application/pdf',
         ContentDisposition=f'inline; filename="{file_name}"'
     )
     
     return f"https://{bucket_name}.storage.yandexcloud.net/{object_key}"
 
-def update_task_with_result(task_id, pdf_url):
-    query = f"""
-    UPDATE tasks 
-    SET 
-        status = 'Успешно завершено',
-        pdfUrl = '{pdf_url}'
-    WHERE taskId = '{task_id}';
-    """
-    execute_query(query)
+def get_task_envelope(data):
+    # Конверт задачи передается между этапами, чтобы не читать строку задачи из YDB
+    envelope = data.get('envelope') or {}
+    envelope.setdefault('version', TASK_ENVELOPE_VERSION)
+    envelope.setdefault('task_id', data['task_id'])
+    envelope.setdefault('source', {})
+    envelope.setdefault('timings', {})
+    return envelope
 
-def update_task_status(task_id, status, error):
-    query = f"""
-    UPDATE tasks 
-    SET status = '{status}', errorMessage = '{error}'
-    WHERE taskId = '{task_id}';
-    """
-    execute_query(query)
+def record_stage_timing(envelope, stage, started_at):
+    timing = envelope['timings'].setdefault(stage, {'started_at': round(started_at, 3)})
+    timing['finished_at'] = round(time.time(), 3)
+
+class PdfRenderer:
+    """Рендерит конспекты из Markdown в PDF; один экземпляр на теплый инстанс"""
+
+    def __init__(self):
+        # PyMuPDF и markdown_it импортируются только на этапе рендеринга, а не при холодном старте
+        import fitz
+        from markdown_it import MarkdownIt
+
+        self.fitz = fitz
+        self.markdown = MarkdownIt('commonmark').enable('table')
+        self.page_rect = fitz.paper_rect(PDF_PAPER_SIZE)
+        self.content_rect = self.page_rect + PDF_BORDERS
+        self.archive = fitz.Archive()
+        font_faces = []
+        for code, rule in PDF_FONTS.items():
+            self.archive.add(fitz.Font(code).buffer, f'{code}.ttf')
+            font_faces.append(f'@font-face {{ {rule} src: url({code}.ttf); }}')
+        self.css = '\n'.join(font_faces) + PDF_CSS
+
+    def render(self, markdown_content):
+        # Возвращает буфер с PDF для загрузки и сведения о рендеринге
+        started_at = time.time()
+        story = self.fitz.Story(html=self.markdown.render(markdown_content), archive=self.archive, user_css=self.css)
+        positions = []
+        toc = []
+        pages = 0
+        # Раскладка и итоговый PDF собираются в памяти, без временных файлов в /tmp
+        layout = io.BytesIO()
+        writer = self.fitz.DocumentWriter(layout)
+        more = True
+        while more:
+            pages += 1
+            device = writer.begin_page(self.page_rect)
+            more, _ = story.place(self.content_rect)
+            story.element_positions(record_element_position, {'page': pages, 'positions': positions, 'toc': toc})
+            story.draw(device)
+            writer.end_page()
+        writer.close()
+
+        # Внутренняя ссылка на несуществующий якорь — ошибка для PyMuPDF; такие ссылки пропускаются
+        anchors = {position.id for position in positions if position.id}
+        positions = [
+            position for position in positions
+            if not (position.href or '').startswith('#') or position.href[1:] in anchors
+        ]
+
+        pdf = io.BytesIO()
+        document = self.fitz.open('pdf', layout)
+        try:
+            self.fitz.Story.add_pdf_links(document, positions)
+            document.set_toc(toc)
+            document.save(pdf)
+        finally:
+            document.close()
+        pdf.seek(0)
+
+        return pdf, {
+            'bytes': pdf.getbuffer().nbytes,
+            'pages': pages,
+            'render_ms': round((time.time() - started_at) * 1000, 1)
+        }
+
+def record_element_position(position):
+    # Вызывается PyMuPDF для каждого элемента страницы: ссылки и заголовки для оглавления
+    position.page_num = position.page
+    if position.id or position.href:
+        position.positions.append(position)
+    if position.open_close & 1 and 0 < position.heading <= 6:
+        position.toc.append([position.heading, position.text, position.page, position.rect[1]])
+
+class Tracer:
+    """Замеряет шаги обработчика и пишет их структурированными JSON-логами"""
+
+    def __init__(self, stage, status_writer=None):
+        global _cold_start
+        self.stage = stage
+        self.status_writer = status_writer
+        self.task_id = None
+        self.cold_start = _cold_start
+        self.started_at = time.time()
+        _cold_start = False
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    @contextmanager
+    def span(self, name):
+        # В span можно дописать bytes и retries — они попадут в лог и в task_events
+        span = {'name': name}
+        started_at = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration_ms'] = round((time.time() - started_at) * 1000, 1)
+            self.log('span', **span)
+            if self.status_writer is not None:
+                self.status_writer.event(
+                    name,
+                    created_at=started_at,
+                    duration_ms=span['duration_ms'],
+                    bytes_moved=span.get('bytes')
+                )
+
+    def error(self, e):
+        # Трейсбек берется из самого исключения: в корутине ошибка может логироваться вне блока except
+        self.log(
+            'error',
+            error=type(e).__name__,
+            message=str(e),
+            traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        )
+
+    def finish(self):
+        self.log('invocation', duration_ms=round((time.time() - self.started_at) * 1000, 1))
+
+    def log(self, msg, **fields):
+        record = {
+            'msg': msg,
+            'stage': self.stage,
+            'task_id': self.task_id,
+            'cold_start': self.cold_start
+        }
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+class StatusWriter:
+    """Накапливает переходы статуса задачи и записывает их одной транзакцией"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.task_id = None
+        self.events = []
+        self.status = None
+        self.error = None
+        self.pdf_url = None
+        self.route = None
+        self.probe = None
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    def start(self, task_id):
+        self.bind(task_id)
+        self.event('started')
+
+    def event(self, name, message=None, created_at=None, duration_ms=None, bytes_moved=None):
+        self.events.append({
+            'createdAt': int((created_at or time.time()) * 1000000),
+            'stage': self.stage,
+            'event': name,
+            'message': message,
+            'durationMs': int(duration_ms) if duration_ms is not None else None,
+            'bytes': bytes_moved
+        })
+
+    def set_status(self, status, error=None, pdf_url=None):
+        self.status = status
+        self.error = error
+        self.pdf_url = pdf_url
+
+    def set_probe(self, route, probe):
+        # Результаты предварительной проверки файла сохраняются в строке задачи
+        self.route = route
+        self.probe = probe
+
+    def fail(self, error):
+        self.event('failed', error)
+        self.set_status('Ошибка', error=error)
+
+    def flush(self):
+        if self.task_id is None or (not self.events and self.status is None):
+            return
+
+        query = """
+        DECLARE $task_id AS Utf8;
+        DECLARE $events AS List<Struct<
+            createdAt: Timestamp,
+            stage: Utf8,
+            event: Utf8,
+            message: Utf8?,
+            durationMs: Uint64?,
+            bytes: Uint64?
+        >>;
+        DECLARE $stage AS Utf8;
+        DECLARE $status AS Utf8?;
+        DECLARE $error AS Utf8?;
+        DECLARE $pdf_url AS Utf8?;
+        DECLARE $route AS Utf8?;
+        DECLARE $probe AS Json?;
+
+        UPSERT INTO task_events (taskId, createdAt, stage, event, message, durationMs, bytes)
+        SELECT $task_id AS taskId, createdAt, stage, event, message, durationMs, bytes
+        FROM AS_TABLE($events);
+
+        UPDATE tasks
+        SET
+            status = $status,
+            stage = $stage,
+            errorMessage = COALESCE($error, errorMessage),
+            pdfUrl = COALESCE($pdf_url, pdfUrl),
+            updatedAt = CurrentUtcTimestamp()
+        WHERE taskId = $task_id AND $status IS NOT NULL;
+
+        UPDATE tasks
+        SET route = $route, probe = $probe
+        WHERE taskId = $task_id AND $route IS NOT NULL;
+        """
+        execute_query(query, {
+            '$task_id': self.task_id,
+            '$events': self.events,
+            '$stage': self.stage,
+            '$status': self.status,
+            '$error': self.error,
+            '$pdf_url': self.pdf_url,
+            '$route': self.route,
+            '$probe': json.dumps(self.probe, ensure_ascii=False) if self.probe is not None else None
+        })
+        self.events = []
+        self.status = None
+        self.route = None
 
 def get_lecture_title(task_id):
-    query = f"""
-    SELECT lectureTitle 
-    FROM tasks 
-    WHERE taskId = '{task_id}';
+    query = """
+    DECLARE $task_id AS Utf8;
+
+    SELECT lectureTitle
+    FROM tasks
+    WHERE taskId = $task_id;
     """
-    result = execute_query(query)
+    result = execute_query(query, {'$task_id': task_id})
     row = result[0].rows[0]
     return row.lectureTitle
 
-def execute_query(query):
-    endpoint = f"grpcs://{os.environ['YDB_ENDPOINT']}"
-    database = os.environ['YDB_DATABASE']
-    
-    driver_config = ydb.DriverConfig(
-        endpoint=endpoint,
-        database=database,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate()
-    )
-    
-    with ydb.Driver(driver_config) as driver:
-        driver.wait(timeout=30, fail_fast=True)
-        session = driver.table_client.session().create()
-        result = session.transaction().execute(query, commit_tx=True)
-        return result
\ No newline at end of file
+def get_s3_client():
+    # Клиенты создаются при первом использовании и живут весь срок жизни инстанса
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url=STORAGE_ENDPOINT,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(max_pool_connections=IO_CONCURRENCY)
+        )
+    return _s3_client
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+        from botocore.config import Config
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url=QUEUE_ENDPOINT,
+            region_name='ru-central1',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(
+                signature_version='s3v4',
+                s3={'addressing_style': 'virtual'},
+                max_pool_connections=IO_CONCURRENCY
+            )
+        )
+    return _sqs_client
+
+def get_http_session():
+    # Общая HTTP-сессия держит keep-alive соединения между вызовами
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=IO_CONCURRENCY, pool_maxsize=IO_CONCURRENCY)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+def get_pdf_renderer():
+    # Движок рендеринга создается с первым конспектом и живет весь срок жизни инстанса
+    global _pdf_renderer
+    if _pdf_renderer is None:
+        _pdf_renderer = PdfRenderer()
+    return _pdf_renderer
+
+def get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _io_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
+    return _io_executor
+
+def get_session_pool():
+    # Драйвер и пул сессий живут весь срок жизни инстанса функции,
+    # поэтому подготовленные запросы переиспользуются между вызовами
+    global _ydb_driver, _ydb_pool
+    if _ydb_pool is None:
+        import ydb
+
+        # YDB_ENDPOINT без схемы — облачная база по grpcs, со схемой — например, локальный контейнер
+        endpoint = os.environ['YDB_ENDPOINT']
+        if '://' not in endpoint:
+            endpoint = f"grpcs://{endpoint}"
+        database = os.environ['YDB_DATABASE']
+
+        driver_config = ydb.DriverConfig(
+            endpoint=endpoint,
+            database=database,
+            credentials=ydb.credentials_from_env_variables(),
+            root_certificates=ydb.load_ydb_root_certificate() if endpoint.startswith('grpcs://') else None
+        )
+
+        _ydb_driver = ydb.Driver(driver_config)
+        _ydb_driver.wait(timeout=30, fail_fast=True)
+        _ydb_pool = ydb.SessionPool(_ydb_driver)
+    return _ydb_pool
+
+def execute_query(query, parameters=None):
+    import ydb
+
+    def callee(session):
+        prepared_query = session.prepare(query)
+        return session.transaction(ydb.SerializableReadWrite()).execute(
+            prepared_query,
+            parameters or {},
+            commit_tx=True
+        )
+    return get_session_pool().retry_operation_sync(callee)
+
+def defer_to_queue(message, delay_seconds):
+    queue_url = os.environ['SELF_QUEUE_URL']
+
+    sqs = get_sqs_client()
+
+    message['deferrals'] = message.get('deferrals', 0) + 1
+    send_params = {
+        'QueueUrl': queue_url,
+        'MessageBody': json.dumps(message, ensure_ascii=False),
+        'DelaySeconds': delay_seconds
+    }
+    return sqs.send_message(**send_params)
+
+class QuotaExceeded(Exception):
+    """API ответил 429: квота исчерпана"""
+
+    def __init__(self, retry_after=None):
+        super().__init__(f'Quota exceeded, retry after {retry_after} s')
+        self.retry_after = retry_after
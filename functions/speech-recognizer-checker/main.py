@@ -1,57 +1,202 @@
 import os
 import json
-import boto3
+import shutil
+import traceback
+import time
+from contextlib import contextmanager
 import uuid
-import ydb
-from botocore.config import Config
-import requests
 import tempfile
 
+TASK_ENVELOPE_VERSION = 1
+STAGE_NAME = 'speech-recognizer-checker'
+
+STORAGE_ENDPOINT = os.environ.get('STORAGE_ENDPOINT', 'https://storage.yandexcloud.net')
+QUEUE_ENDPOINT = os.environ.get('QUEUE_ENDPOINT', 'https://message-queue.api.cloud.yandex.net')
+OPERATION_API_URL = os.environ.get('OPERATION_API_URL', 'https://operation.api.cloud.yandex.net')
+SPEECHKIT_API_URL = os.environ.get('SPEECHKIT_API_URL', 'https://stt.api.cloud.yandex.net:443')
+
+# Слот в общем бюджете SpeechKit занимает speech-recognizer, освобождает — завершение операции
+SPEECHKIT_API = 'speechkit'
+
+# Запись статуса повторяется внутри обработки сообщения: ошибка одного сообщения не возвращает
+# в очередь всю пачку, уже выполненные сообщения которой иначе обработались бы повторно.
+# Если статус так и не записан, а сообщение еще не передано дальше, повторяется только оно
+FLUSH_ATTEMPTS = 3
+FLUSH_RETRY_SECONDS = 1
+STATUS_RETRY_DELAY_SECONDS = 30
+
+# Потоков для блокирующих вызовов SDK и соединений в пулах клиентов — с запасом на пачку сообщений
+IO_CONCURRENCY = 16
+
+_cold_start = True
+_s3_client = None
+_sqs_client = None
+_http_session = None
+_ydb_driver = None
+_ydb_pool = None
+_io_executor = None
+
 def handler(event, context):
+    # asyncio импортируется в вызове, а не при загрузке модуля, чтобы не удлинять холодный старт
+    import asyncio
+
+    # Каталоги от прошлых вызовов удаляются до начала обработки пачки: сообщения пачки
+    # работают одновременно, и каждое удаляет только свой каталог
+    sweep_scratch(STAGE_NAME)
+    asyncio.run(handle_messages(event['messages']))
+
+async def handle_messages(messages):
+    # Сообщения пачки триггера обрабатываются конкурентно в одном цикле событий
+    import asyncio
+
+    results = await asyncio.gather(*(handle_message(message) for message in messages), return_exceptions=True)
+    # Сообщение само повторяет запись статуса или возвращает себя в очередь; пачка целиком
+    # в очередь не возвращается
+    for result in results:
+        if isinstance(result, Exception):
+            Tracer(STAGE_NAME).error(result)
+
+async def handle_message(message):
+    import asyncio
+
+    started_at = time.time()
+    status_writer = StatusWriter(STAGE_NAME)
+    tracer = Tracer(STAGE_NAME, status_writer)
+    operation_finished = False
+    # Следующее сообщение уже отправлено (дальше или на повторную проверку): повторять это нельзя
+    handed_off = False
+    consumed_audio_url = None
+    scratch = ScratchSpace(STAGE_NAME)
     try:
         # 1. Парсинг сообщения из очереди
-        message = event['messages'][0]['details']['message']
-        data = json.loads(message['body'])
+        data = json.loads(message['details']['message']['body'])
+        envelope = get_task_envelope(data)
         task_id = data['task_id']
+        status_writer.bind(task_id)
+        tracer.bind(task_id)
+        if data['attempt'] == 1:
+            status_writer.event('started')
         
         # 2. Получение статуса операции
         operation_id = data['operation_id']
-        status = check_speech_recognize_status(operation_id)
+        with tracer.span('check_speech_recognize_status') as span:
+            status = await run_io(check_speech_recognize_status, operation_id)
+            span['retries'] = data['attempt'] - 1
+        operation_finished = status != 'running'
 
         # 3.1. Распознавание завершено успешно
         if (status == "done"):
             # 4. Получение распознанного текста
-            recognized_text_path = get_speechkit_result(operation_id)
+            with tracer.span('get_speechkit_result') as span:
+                recognized_text_path = await run_io(get_speechkit_result, operation_id, scratch.file('recognition.txt'))
+                span['bytes'] = os.path.getsize(recognized_text_path)
 
-            # 5. Сохранение текста в Storage
-            storage_url = upload_recognized_text(recognized_text_path)
+            # 5. Сохранение текста в Storage параллельно с записью прогресса в YDB; незаписанный
+            # прогресс не проваливает задачу и записывается вместе с итоговым статусом
+            with tracer.span('upload_recognized_text') as span:
+                storage_url, _ = await asyncio.gather(
+                    run_io(upload_recognized_text, recognized_text_path),
+                    flush_status(status_writer, tracer)
+                )
+                span['bytes'] = os.path.getsize(recognized_text_path)
 
             # 6. Отправка сообщения в очередь для формирования конспекта
+            record_stage_timing(envelope, STAGE_NAME, started_at)
             queue_message = {
                 'task_id': task_id,
-                'storage_url': storage_url
+                'storage_url': storage_url,
+                'envelope': envelope
             }
-            send_to_queue(queue_message)
+            with tracer.span('send_to_queue') as span:
+                response = await run_io(send_to_queue, queue_message)
+                span['retries'] = response['ResponseMetadata'].get('RetryAttempts', 0)
+            handed_off = True
+            status_writer.event('completed')
+            status_writer.set_status('В обработке')
 
-            # 7. Удаление временных файлов
-            os.remove(recognized_text_path)
+            # 7. Аудио больше не нужно: следующий этап работает с текстом
+            consumed_audio_url = data.get('audio_url')
 
         # 3.2. Распознавание в процессе
         elif (status == "running"):
             # 4. Отправка сообщения в очередь для проверки статуса распознавания
+            # Время начала этапа сохраняется с первой попытки проверки
+            record_stage_timing(envelope, STAGE_NAME, started_at)
             message = {
                 'task_id': task_id,
                 'operation_id': operation_id,
-                'attempt': data['attempt'] + 1
+                'audio_url': data.get('audio_url'),
+                'attempt': data['attempt'] + 1,
+                'envelope': envelope
             }
-            resend_to_queue_with_delay(message)
+            with tracer.span('resend_to_queue_with_delay') as span:
+                response = await run_io(resend_to_queue_with_delay, message)
+                span['retries'] = response['ResponseMetadata'].get('RetryAttempts', 0)
+            handed_off = True
 
         # 3.3 Распознавание завершено с ошибкой    
         else:
             raise Exception("Recognition complete with error")
+    except QuotaExceeded:
+        # 429 от SpeechKit: проверка повторяется позже, слот операции остается занят
+        operation_finished = False
+        tracer.log('throttled', api=SPEECHKIT_API, attempt=data['attempt'])
+        with tracer.span('resend_to_queue_with_delay'):
+            await run_io(resend_to_queue_with_delay, dict(data, attempt=data['attempt'] + 1, envelope=envelope))
+        handed_off = True
     except Exception as e:
-        update_task_status(task_id, 'Ошибка', 'Произошла ошибка во время распознавания речи')
-    
+        operation_finished = True
+        tracer.error(e)
+        status_writer.fail('Произошла ошибка во время распознавания речи')
+    finally:
+        scratch.cleanup()
+        # Запись статуса и освобождение слота не зависят друг от друга
+        release = operation_finished and status_writer.task_id
+        flushed, released = await asyncio.gather(
+            flush_status(status_writer, tracer),
+            run_io(release_api_budget, SPEECHKIT_API, status_writer.task_id) if release else no_io(),
+            return_exceptions=True
+        )
+        if isinstance(released, Exception):
+            tracer.error(released)
+        if not flushed and not handed_off:
+            # Повторная проверка с тем же номером попытки
+            try:
+                await run_io(resend_to_queue_with_delay, data)
+            except Exception as e:
+                tracer.error(e)
+        # Аудио удаляется только после записи статуса; аудио, которое не удалось удалить,
+        # удалит правило жизненного цикла бакета
+        if flushed and consumed_audio_url:
+            try:
+                await run_io(delete_storage_object, consumed_audio_url)
+            except Exception as e:
+                tracer.error(e)
+        tracer.finish()
+
+async def flush_status(status_writer, tracer):
+    # Запись идемпотентна: события адресуются временем, статус перезаписывается
+    import asyncio
+
+    for attempt in range(FLUSH_ATTEMPTS):
+        try:
+            await run_io(status_writer.flush)
+            return True
+        except Exception as e:
+            tracer.error(e)
+            if attempt + 1 < FLUSH_ATTEMPTS:
+                await asyncio.sleep(FLUSH_RETRY_SECONDS * 2 ** attempt)
+    return False
+
+async def run_io(func, *args):
+    # Блокирующий вызов SDK выполняется в общем пуле потоков, а цикл событий
+    # тем временем продолжает другие операции этого и соседних сообщений
+    import asyncio
+
+    return await asyncio.get_running_loop().run_in_executor(get_io_executor(), func, *args)
+
+async def no_io():
+    return None
 
 def check_speech_recognize_status(operation_id):
     api_key = os.environ['API_KEY']
@@ -62,9 +207,11 @@ def check_speech_recognize_status(operation_id):
         'x-folder-id': folder_id
     }
     
-    operation_url = f"https://operation.api.cloud.yandex.net/operations/{operation_id}"
+    operation_url = f"{OPERATION_API_URL}/operations/{operation_id}"
     
-    response = requests.get(operation_url, headers=headers)
+    response = get_http_session().get(operation_url, headers=headers)
+    if response.status_code == 429:
+        raise QuotaExceeded()
     response.raise_for_status()
     
     result = response.json()
@@ -76,7 +223,7 @@ def check_speech_recognize_status(operation_id):
     else:
         return 'running'    
     
-def get_speechkit_result(operation_id):
+def get_speechkit_result(operation_id, text_path):
     api_key = os.environ['API_KEY']
     folder_id = os.environ['FOLDER_ID']
     
@@ -85,20 +232,21 @@ def get_speechkit_result(operation_id):
         'x-folder-id': folder_id,
         'Content-Type': 'application/json'
     }
-    result_url = "https://stt.api.cloud.yandex.net/stt/v3/getRecognition"
+    result_url = f"{SPEECHKIT_API_URL}/stt/v3/getRecognition"
     params = {'operationId': operation_id}
     
-    response = requests.get(result_url, headers=headers, params=params)
+    response = get_http_session().get(result_url, headers=headers, params=params)
+    if response.status_code == 429:
+        raise QuotaExceeded()
     if response.status_code != 200:
         raise Exception(f"Failed to get recognition result: {response.status_code}")
     
     text = extract_full_text(response.content)
 
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as temp_file:
-        temp_file.write(text)
-        temp_file_path = temp_file.name
+    with open(text_path, 'w', encoding='utf-8') as text_file:
+        text_file.write(text)
     
-    return temp_file_path
+    return text_path
     
 def extract_full_text(response_content, channel='0'):
     full_text = ""
@@ -135,24 +283,16 @@ def extract_full_text(response_content, channel='0'):
                     if final_index not in results_by_index:
                         results_by_index[final_index] = alt['text']
     
+    # Реплика на строку: по границам реплик note-generator ищет повторы
     sorted_indices = sorted(results_by_index.keys(), key=int)
-    full_text = " ".join(results_by_index[idx] for idx in sorted_indices)
+    full_text = "\n".join(results_by_index[idx] for idx in sorted_indices)
     
     return full_text.strip()
 
 def resend_to_queue_with_delay(message):
     queue_url = os.environ['SELF_QUEUE_URL']
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(signature_version='s3v4')
-    )
+    
+    sqs = get_sqs_client()
 
     attempt = message['attempt']
     delay_seconds = min(2 ** attempt, 900)
@@ -162,42 +302,285 @@ def resend_to_queue_with_delay(message):
         'MessageBody': json.dumps(message, ensure_ascii=False),
         'DelaySeconds': delay_seconds
     }
-    sqs.send_message(**send_params)
+    return sqs.send_message(**send_params)
+
+def release_api_budget(api, lease_id):
+    query = """
+    DECLARE $api AS Utf8;
+    DECLARE $lease_id AS Utf8;
 
-def update_task_status(task_id, status, error):
-    query = f"""
-    UPDATE tasks 
-    SET status = '{status}', errorMessage = '{error}'
-    WHERE taskId = '{task_id}';
+    DELETE FROM api_budget
+    WHERE api = $api AND leaseId = $lease_id;
     """
-    execute_query(query)
+    execute_query(query, {'$api': api, '$lease_id': lease_id})
 
-def execute_query(query):
-    endpoint = f"grpcs://{os.environ['YDB_ENDPOINT']}"
-    database = os.environ['YDB_DATABASE']
-    
-    driver_config = ydb.DriverConfig(
-        endpoint=endpoint,
-        database=database,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate()
-    )
-    
-    with ydb.Driver(driver_config) as driver:
-        driver.wait(timeout=30, fail_fast=True)
-        session = driver.table_client.session().create()
-        session.transaction().execute(query, commit_tx=True)
+def get_task_envelope(data):
+    # Конверт задачи передается между этапами, чтобы не читать строку задачи из YDB
+    envelope = data.get('envelope') or {}
+    envelope.setdefault('version', TASK_ENVELOPE_VERSION)
+    envelope.setdefault('task_id', data['task_id'])
+    envelope.setdefault('source', {})
+    envelope.setdefault('timings', {})
+    return envelope
+
+def record_stage_timing(envelope, stage, started_at):
+    timing = envelope['timings'].setdefault(stage, {'started_at': round(started_at, 3)})
+    timing['finished_at'] = round(time.time(), 3)
+
+class Tracer:
+    """Замеряет шаги обработчика и пишет их структурированными JSON-логами"""
+
+    def __init__(self, stage, status_writer=None):
+        global _cold_start
+        self.stage = stage
+        self.status_writer = status_writer
+        self.task_id = None
+        self.cold_start = _cold_start
+        self.started_at = time.time()
+        _cold_start = False
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    @contextmanager
+    def span(self, name):
+        # В span можно дописать bytes и retries — они попадут в лог и в task_events
+        span = {'name': name}
+        started_at = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration_ms'] = round((time.time() - started_at) * 1000, 1)
+            self.log('span', **span)
+            if self.status_writer is not None:
+                self.status_writer.event(
+                    name,
+                    created_at=started_at,
+                    duration_ms=span['duration_ms'],
+                    bytes_moved=span.get('bytes')
+                )
+
+    def error(self, e):
+        # Трейсбек берется из самого исключения: в корутине ошибка может логироваться вне блока except
+        self.log(
+            'error',
+            error=type(e).__name__,
+            message=str(e),
+            traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        )
+
+    def finish(self):
+        self.log('invocation', duration_ms=round((time.time() - self.started_at) * 1000, 1))
+
+    def log(self, msg, **fields):
+        record = {
+            'msg': msg,
+            'stage': self.stage,
+            'task_id': self.task_id,
+            'cold_start': self.cold_start
+        }
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+class StatusWriter:
+    """Накапливает переходы статуса задачи и записывает их одной транзакцией"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.task_id = None
+        self.events = []
+        self.status = None
+        self.error = None
+        self.pdf_url = None
+        self.route = None
+        self.probe = None
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    def start(self, task_id):
+        self.bind(task_id)
+        self.event('started')
+
+    def event(self, name, message=None, created_at=None, duration_ms=None, bytes_moved=None):
+        self.events.append({
+            'createdAt': int((created_at or time.time()) * 1000000),
+            'stage': self.stage,
+            'event': name,
+            'message': message,
+            'durationMs': int(duration_ms) if duration_ms is not None else None,
+            'bytes': bytes_moved
+        })
+
+    def set_status(self, status, error=None, pdf_url=None):
+        self.status = status
+        self.error = error
+        self.pdf_url = pdf_url
+
+    def set_probe(self, route, probe):
+        # Результаты предварительной проверки файла сохраняются в строке задачи
+        self.route = route
+        self.probe = probe
+
+    def fail(self, error):
+        self.event('failed', error)
+        self.set_status('Ошибка', error=error)
+
+    def flush(self):
+        if self.task_id is None or (not self.events and self.status is None):
+            return
+
+        query = """
+        DECLARE $task_id AS Utf8;
+        DECLARE $events AS List<Struct<
+            createdAt: Timestamp,
+            stage: Utf8,
+            event: Utf8,
+            message: Utf8?,
+            durationMs: Uint64?,
+            bytes: Uint64?
+        >>;
+        DECLARE $stage AS Utf8;
+        DECLARE $status AS Utf8?;
+        DECLARE $error AS Utf8?;
+        DECLARE $pdf_url AS Utf8?;
+        DECLARE $route AS Utf8?;
+        DECLARE $probe AS Json?;
+
+        UPSERT INTO task_events (taskId, createdAt, stage, event, message, durationMs, bytes)
+        SELECT $task_id AS taskId, createdAt, stage, event, message, durationMs, bytes
+        FROM AS_TABLE($events);
+
+        UPDATE tasks
+        SET
+            status = $status,
+            stage = $stage,
+            errorMessage = COALESCE($error, errorMessage),
+            pdfUrl = COALESCE($pdf_url, pdfUrl),
+            updatedAt = CurrentUtcTimestamp()
+        WHERE taskId = $task_id AND $status IS NOT NULL;
+
+        UPDATE tasks
+        SET route = $route, probe = $probe
+        WHERE taskId = $task_id AND $route IS NOT NULL;
+        """
+        execute_query(query, {
+            '$task_id': self.task_id,
+            '$events': self.events,
+            '$stage': self.stage,
+            '$status': self.status,
+            '$error': self.error,
+            '$pdf_url': self.pdf_url,
+            '$route': self.route,
+            '$probe': json.dumps(self.probe, ensure_ascii=False) if self.probe is not None else None
+        })
+        self.events = []
+        self.status = None
+        self.route = None
+
+def get_s3_client():
+    # Клиенты создаются при первом использовании и живут весь срок жизни инстанса
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url=STORAGE_ENDPOINT,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(max_pool_connections=IO_CONCURRENCY)
+        )
+    return _s3_client
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+        from botocore.config import Config
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url=QUEUE_ENDPOINT,
+            region_name='ru-central1',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(
+                signature_version='s3v4',
+                s3={'addressing_style': 'virtual'},
+                max_pool_connections=IO_CONCURRENCY
+            )
+        )
+    return _sqs_client
+
+def get_http_session():
+    # Общая HTTP-сессия держит keep-alive соединения между вызовами
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=IO_CONCURRENCY, pool_maxsize=IO_CONCURRENCY)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+def get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _io_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
+    return _io_executor
+
+def get_session_pool():
+    # Драйвер и пул сессий живут весь срок жизни инстанса функции,
+    # поэтому подготовленные запросы переиспользуются между вызовами
+    global _ydb_driver, _ydb_pool
+    if _ydb_pool is None:
+        import ydb
+
+        # YDB_ENDPOINT без схемы — облачная база по grpcs, со схемой — например, локальный контейнер
+        endpoint = os.environ['YDB_ENDPOINT']
+        if '://' not in endpoint:
+            endpoint = f"grpcs://{endpoint}"
+        database = os.environ['YDB_DATABASE']
+
+        driver_config = ydb.DriverConfig(
+            endpoint=endpoint,
+            database=database,
+            credentials=ydb.credentials_from_env_variables(),
+            root_certificates=ydb.load_ydb_root_certificate() if endpoint.startswith('grpcs://') else None
+        )
+
+        _ydb_driver = ydb.Driver(driver_config)
+        _ydb_driver.wait(timeout=30, fail_fast=True)
+        _ydb_pool = ydb.SessionPool(_ydb_driver)
+    return _ydb_pool
+
+def execute_query(query, parameters=None):
+    import ydb
+
+    def callee(session):
+        prepared_query = session.prepare(query)
+        return session.transaction(ydb.SerializableReadWrite()).execute(
+            prepared_query,
+            parameters or {},
+            commit_tx=True
+        )
+    return get_session_pool().retry_operation_sync(callee)
+
+def delete_storage_object(url):
+    bucket_name = url.split('.')[0].replace('https://', '')
+    object_key = url.split(bucket_name + '.storage.yandexcloud.net/')[1]
+
+    get_s3_client().delete_object(Bucket=bucket_name, Key=object_key)
 
 def upload_recognized_text(path):
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
     bucket_name = os.environ['STORAGE_BUCKET']
     
-    s3 = boto3.client('s3',
-        endpoint_url='https://storage.yandexcloud.net',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
+    s3 = get_s3_client()
 
     file_name = uuid.uuid4()
     object_key = f"recognitions/{file_name}"
@@ -214,25 +597,41 @@ def upload_recognized_text(path):
     
     return f"https://{bucket_name}.storage.yandexcloud.net/{object_key}"        
 
+class ScratchSpace:
+    """Временный каталог сообщения в /tmp; удаляется в finally обработчика"""
+
+    def __init__(self, stage):
+        self.prefix = f'scratch-{stage}-'
+        self.path = None
+
+    def file(self, name):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix=self.prefix)
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+def sweep_scratch(stage):
+    # Инстанс обрабатывает один вызов за раз, поэтому каталоги этапа от прошлых вызовов —
+    # остатки прерванных по таймауту или падению; без удаления они занимали бы память
+    root = tempfile.gettempdir()
+    for name in os.listdir(root):
+        if name.startswith(f'scratch-{stage}-'):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
 def send_to_queue(message):
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
     queue_url = os.environ['QUEUE_URL']
 
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'virtual'}
-        )
-    )
+    sqs = get_sqs_client()
 
     send_params = {
         'QueueUrl': queue_url,
         'MessageBody': json.dumps(message, ensure_ascii=False),
     }
-    sqs.send_message(**send_params)
\ No newline at end of file
+    return sqs.send_message(**send_params)
+
+class QuotaExceeded(Exception):
+    """API ответил 429: квота исчерпана"""
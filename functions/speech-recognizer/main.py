@@ -1,47 +1,184 @@
 import os
 import json
-import boto3
-import ydb
-from botocore.config import Config
-import requests
+import random
+import traceback
+import time
+import uuid
+from contextlib import contextmanager
+
+TASK_ENVELOPE_VERSION = 1
+STAGE_NAME = 'speech-recognizer'
+
+CONTAINER_AUDIO_TYPES = {
+    'mp3': 'MP3',
+    'wav': 'WAV',
+    'ogg': 'OGG_OPUS'
+}
+
+STORAGE_ENDPOINT = os.environ.get('STORAGE_ENDPOINT', 'https://storage.yandexcloud.net')
+QUEUE_ENDPOINT = os.environ.get('QUEUE_ENDPOINT', 'https://message-queue.api.cloud.yandex.net')
+SPEECHKIT_API_URL = os.environ.get('SPEECHKIT_API_URL', 'https://stt.api.cloud.yandex.net:443')
+
+# Общий для всех инстансов бюджет SpeechKit в таблице api_budget: одновременные операции
+# распознавания и запросы в секунду. Операция держит слот, пока checker не получит результат;
+# аренда — страховка от вызовов, упавших до освобождения слота
+SPEECHKIT_API = 'speechkit'
+SPEECHKIT_MAX_OPERATIONS = int(os.environ.get('SPEECHKIT_MAX_OPERATIONS', '10'))
+SPEECHKIT_MAX_RPS = int(os.environ.get('SPEECHKIT_MAX_RPS', '5'))
+SPEECHKIT_LEASE_SECONDS = 3 * 3600
+# Задержка повторной попытки растет с числом откладываний; SQS допускает не больше 900 секунд
+QUOTA_RETRY_SECONDS = 30
+MAX_DELAY_SECONDS = 900
+
+# Запись статуса повторяется внутри обработки сообщения: ошибка одного сообщения не возвращает
+# в очередь всю пачку, уже выполненные сообщения которой иначе обработались бы повторно.
+# Если статус так и не записан, а сообщение еще не передано дальше, повторяется только оно
+FLUSH_ATTEMPTS = 3
+FLUSH_RETRY_SECONDS = 1
+STATUS_RETRY_DELAY_SECONDS = 30
+
+# Потоков для блокирующих вызовов SDK и соединений в пулах клиентов — с запасом на пачку сообщений
+IO_CONCURRENCY = 16
+
+_cold_start = True
+_s3_client = None
+_sqs_client = None
+_http_session = None
+_ydb_driver = None
+_ydb_pool = None
+_io_executor = None
 
 def handler(event, context):
+    # asyncio импортируется в вызове, а не при загрузке модуля, чтобы не удлинять холодный старт
+    import asyncio
+
+    asyncio.run(handle_messages(event['messages']))
+
+async def handle_messages(messages):
+    # Сообщения пачки триггера обрабатываются конкурентно в одном цикле событий
+    import asyncio
+
+    results = await asyncio.gather(*(handle_message(message) for message in messages), return_exceptions=True)
+    # Сообщение само повторяет запись статуса или возвращает себя в очередь; пачка целиком
+    # в очередь не возвращается
+    for result in results:
+        if isinstance(result, Exception):
+            Tracer(STAGE_NAME).error(result)
+
+async def handle_message(message):
+    import asyncio
+
+    started_at = time.time()
+    status_writer = StatusWriter(STAGE_NAME)
+    tracer = Tracer(STAGE_NAME, status_writer)
+    lease_held = False
+    # Операция SpeechKit создана или сообщение отложено: повторять его уже нельзя
+    handed_off = False
     try:
         # 1. Парсинг сообщения из очереди
-        message = event['messages'][0]['details']['message']
-        data = json.loads(message['body'])
+        data = json.loads(message['details']['message']['body'])
+        envelope = get_task_envelope(data)
         task_id = data['task_id']
+        tracer.bind(task_id)
 
-        # 2. Генерация подписанной ссылки на аудио
+        # 2. Слот в бюджете SpeechKit: если он исчерпан, задача откладывается
+        admitted, usage = await run_io(
+            acquire_api_budget,
+            SPEECHKIT_API, task_id, SPEECHKIT_MAX_OPERATIONS, SPEECHKIT_MAX_RPS, SPEECHKIT_LEASE_SECONDS
+        )
+        delay_seconds = 0 if admitted else quota_delay_seconds(usage, data.get('deferrals', 0))
+        tracer.log('api_budget', admitted=admitted, delay_seconds=delay_seconds, **usage)
+        if not admitted:
+            await run_io(defer_to_queue, data, delay_seconds)
+            handed_off = True
+            return
+        lease_held = True
+        status_writer.start(task_id)
+
+        # 3. Генерация подписанной ссылки на аудио
         storage_url = data['storage_url']
-        presigned_url = generate_presigned_url(storage_url)
+        with tracer.span('generate_presigned_url'):
+            presigned_url = generate_presigned_url(storage_url)
 
-        # 3. Отправка запроса на SpeechKit
-        operation_id = send_to_speechkit(presigned_url)
+        # 4. Отправка запроса на SpeechKit
+        audio_codec = envelope.get('audio_profile', {}).get('codec', 'mp3')
+        with tracer.span('send_to_speechkit'):
+            operation_id = await run_io(send_to_speechkit, presigned_url, audio_codec)
+        handed_off = True
 
-        # 4. Отправка сообщения в очередь для проверки статуса распознавания
+        # 5. Отправка сообщения в очередь для проверки статуса распознавания
+        record_stage_timing(envelope, STAGE_NAME, started_at)
         queue_message = {
             'task_id': task_id,
             'operation_id': operation_id,
-            'attempt': 1
+            'audio_url': storage_url,
+            'attempt': 1,
+            'envelope': envelope
         } 
-        send_to_queue(queue_message)
+        with tracer.span('send_to_queue') as span:
+            response = await run_io(send_to_queue, queue_message)
+            span['retries'] = response['ResponseMetadata'].get('RetryAttempts', 0)
+        # Слот освобождает speech-recognizer-checker, когда операция завершится; пока сообщения
+        # для него нет в очереди, слот освобождается здесь
+        lease_held = False
+        status_writer.event('completed')
+        status_writer.set_status('В обработке')
 
+    except QuotaExceeded as e:
+        # 429 от SpeechKit: задача не проваливается, а повторяется позже
+        delay_seconds = e.retry_after or quota_delay_seconds({}, data.get('deferrals', 0))
+        tracer.log('throttled', api=SPEECHKIT_API, delay_seconds=delay_seconds)
+        status_writer.event('throttled', f'SpeechKit: повтор через {delay_seconds} с')
+        await run_io(defer_to_queue, data, delay_seconds)
+        handed_off = True
     except Exception as e:
-        update_task_status(task_id, 'Ошибка', 'Произошла ошибка во время распознавания речи')   
+        tracer.error(e)
+        status_writer.fail('Произошла ошибка во время распознавания речи')
+    finally:
+        # Запись статуса и освобождение слота не зависят друг от друга
+        flushed, release = await asyncio.gather(
+            flush_status(status_writer, tracer),
+            run_io(release_api_budget, SPEECHKIT_API, task_id) if lease_held else no_io(),
+            return_exceptions=True
+        )
+        if isinstance(release, Exception):
+            tracer.error(release)
+        if not flushed and not handed_off:
+            try:
+                await run_io(defer_to_queue, data, STATUS_RETRY_DELAY_SECONDS)
+            except Exception as e:
+                tracer.error(e)
+        tracer.finish()
+
+async def flush_status(status_writer, tracer):
+    # Запись идемпотентна: события адресуются временем, статус перезаписывается
+    import asyncio
+
+    for attempt in range(FLUSH_ATTEMPTS):
+        try:
+            await run_io(status_writer.flush)
+            return True
+        except Exception as e:
+            tracer.error(e)
+            if attempt + 1 < FLUSH_ATTEMPTS:
+                await asyncio.sleep(FLUSH_RETRY_SECONDS * 2 ** attempt)
+    return False
+
+async def run_io(func, *args):
+    # Блокирующий вызов SDK выполняется в общем пуле потоков, а цикл событий
+    # тем временем продолжает другие операции этого и соседних сообщений
+    import asyncio
+
+    return await asyncio.get_running_loop().run_in_executor(get_io_executor(), func, *args)
+
+async def no_io():
+    return None
 
 def generate_presigned_url(url):
     bucket_name = url.split('.')[0].replace('https://', '')
     object_key = url.split(bucket_name + '.storage.yandexcloud.net/')[1]
-    
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    
-    s3 = boto3.client('s3',
-        endpoint_url='https://storage.yandexcloud.net',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
+
+    s3 = get_s3_client()
    
     presigned_url = s3.generate_presigned_url(
         'get_object',
@@ -54,11 +191,11 @@ def generate_presigned_url(url):
     )
     return presigned_url
     
-def send_to_speechkit(url):
+def send_to_speechkit(url, audio_codec='mp3'):
     api_key = os.environ['API_KEY']
     folder_id = os.environ['FOLDER_ID']
     
-    api_url = "https://stt.api.cloud.yandex.net:443/stt/v3/recognizeFileAsync"
+    api_url = f"{SPEECHKIT_API_URL}/stt/v3/recognizeFileAsync"
     
     headers = {
         'Authorization': f'Api-Key {api_key}',
@@ -72,59 +209,384 @@ def send_to_speechkit(url):
             "model": "general",
             "audio_format": {
                 "container_audio": {
-                    "container_audio_type": "MP3"
+                    "container_audio_type": CONTAINER_AUDIO_TYPES[audio_codec]
                 }
             }
         }
     }
 
-    response = requests.post(api_url, json=request_body, headers=headers)
+    response = get_http_session().post(api_url, json=request_body, headers=headers)
+    if response.status_code == 429:
+        raise QuotaExceeded(parse_retry_after(response.headers.get('Retry-After')))
     result = response.json()
     return result['id'] 
 
-def update_task_status(task_id, status, error):
-    query = f"""
-    UPDATE tasks 
-    SET status = '{status}', errorMessage = '{error}'
-    WHERE taskId = '{task_id}';
+def parse_retry_after(value):
+    try:
+        return min(max(int(value), 1), MAX_DELAY_SECONDS)
+    except (TypeError, ValueError):
+        return None
+
+def acquire_api_budget(api, lease_id, max_operations, max_rps, lease_seconds):
+    # Строки api_budget: kind = 'operation' — занятый слот до освобождения или конца аренды,
+    # kind = 'request' — отметка запроса, живет одну секунду и ограничивает RPS
+    import ydb
+
+    select_query = """
+    DECLARE $api AS Utf8;
+
+    SELECT leaseId, kind, expiresAt
+    FROM api_budget
+    WHERE api = $api;
     """
-    execute_query(query)
+    admit_query = """
+    DECLARE $api AS Utf8;
+    DECLARE $expired AS List<Utf8>;
+    DECLARE $leases AS List<Struct<
+        leaseId: Utf8,
+        kind: Utf8,
+        expiresAt: Timestamp
+    >>;
 
-def execute_query(query):
-    endpoint = f"grpcs://{os.environ['YDB_ENDPOINT']}"
-    database = os.environ['YDB_DATABASE']
-    
-    driver_config = ydb.DriverConfig(
-        endpoint=endpoint,
-        database=database,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate()
-    )
-    
-    with ydb.Driver(driver_config) as driver:
-        driver.wait(timeout=30, fail_fast=True)
-        session = driver.table_client.session().create()
-        session.transaction().execute(query, commit_tx=True)
+    DELETE FROM api_budget
+    WHERE api = $api AND leaseId IN $expired;
+
+    UPSERT INTO api_budget (api, leaseId, kind, expiresAt)
+    SELECT $api AS api, leaseId, kind, expiresAt
+    FROM AS_TABLE($leases);
+    """
+
+    def callee(session):
+        # Подсчет занятого бюджета и запись новых строк — в одной сериализуемой транзакции
+        tx = session.transaction(ydb.SerializableReadWrite()).begin()
+        rows = tx.execute(session.prepare(select_query), {'$api': api})[0].rows
+        now = int(time.time() * 1000000)
+        active = [row for row in rows if row.expiresAt > now and row.leaseId != lease_id]
+        usage = {
+            'api': api,
+            'operations': sum(1 for row in active if row.kind == 'operation'),
+            'max_operations': max_operations,
+            'requests_per_second': sum(1 for row in active if row.kind == 'request'),
+            'max_rps': max_rps
+        }
+        if usage['operations'] >= max_operations or usage['requests_per_second'] >= max_rps:
+            tx.rollback()
+            return False, usage
+
+        tx.execute(session.prepare(admit_query), {
+            '$api': api,
+            '$expired': [row.leaseId for row in rows if row.expiresAt <= now],
+            '$leases': [
+                {'leaseId': lease_id, 'kind': 'operation', 'expiresAt': now + lease_seconds * 1000000},
+                {'leaseId': str(uuid.uuid4()), 'kind': 'request', 'expiresAt': now + 1000000}
+            ]
+        }, commit_tx=True)
+        return True, usage
+
+    return get_session_pool().retry_operation_sync(callee)
+
+def release_api_budget(api, lease_id):
+    query = """
+    DECLARE $api AS Utf8;
+    DECLARE $lease_id AS Utf8;
+
+    DELETE FROM api_budget
+    WHERE api = $api AND leaseId = $lease_id;
+    """
+    execute_query(query, {'$api': api, '$lease_id': lease_id})
+
+def quota_delay_seconds(usage, deferrals):
+    # Исчерпан только RPS — хватит секунды; заняты все слоты — экспоненциальная задержка
+    # со случайной добавкой, чтобы отложенные задачи не возвращались одновременно
+    if usage.get('operations', 0) < usage.get('max_operations', 0):
+        return random.randint(1, 2)
+    delay_seconds = QUOTA_RETRY_SECONDS * 2 ** min(deferrals, 5)
+    return min(delay_seconds + random.randint(0, QUOTA_RETRY_SECONDS), MAX_DELAY_SECONDS)
+
+def get_task_envelope(data):
+    # Конверт задачи передается между этапами, чтобы не читать строку задачи из YDB
+    envelope = data.get('envelope') or {}
+    envelope.setdefault('version', TASK_ENVELOPE_VERSION)
+    envelope.setdefault('task_id', data['task_id'])
+    envelope.setdefault('source', {})
+    envelope.setdefault('timings', {})
+    return envelope
+
+def record_stage_timing(envelope, stage, started_at):
+    timing = envelope['timings'].setdefault(stage, {'started_at': round(started_at, 3)})
+    timing['finished_at'] = round(time.time(), 3)
+
+class Tracer:
+    """Замеряет шаги обработчика и пишет их структурированными JSON-логами"""
+
+    def __init__(self, stage, status_writer=None):
+        global _cold_start
+        self.stage = stage
+        self.status_writer = status_writer
+        self.task_id = None
+        self.cold_start = _cold_start
+        self.started_at = time.time()
+        _cold_start = False
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    @contextmanager
+    def span(self, name):
+        # В span можно дописать bytes и retries — они попадут в лог и в task_events
+        span = {'name': name}
+        started_at = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration_ms'] = round((time.time() - started_at) * 1000, 1)
+            self.log('span', **span)
+            if self.status_writer is not None:
+                self.status_writer.event(
+                    name,
+                    created_at=started_at,
+                    duration_ms=span['duration_ms'],
+                    bytes_moved=span.get('bytes')
+                )
+
+    def error(self, e):
+        # Трейсбек берется из самого исключения: в корутине ошибка может логироваться вне блока except
+        self.log(
+            'error',
+            error=type(e).__name__,
+            message=str(e),
+            traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        )
+
+    def finish(self):
+        self.log('invocation', duration_ms=round((time.time() - self.started_at) * 1000, 1))
+
+    def log(self, msg, **fields):
+        record = {
+            'msg': msg,
+            'stage': self.stage,
+            'task_id': self.task_id,
+            'cold_start': self.cold_start
+        }
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+class StatusWriter:
+    """Накапливает переходы статуса задачи и записывает их одной транзакцией"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.task_id = None
+        self.events = []
+        self.status = None
+        self.error = None
+        self.pdf_url = None
+        self.route = None
+        self.probe = None
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    def start(self, task_id):
+        self.bind(task_id)
+        self.event('started')
+
+    def event(self, name, message=None, created_at=None, duration_ms=None, bytes_moved=None):
+        self.events.append({
+            'createdAt': int((created_at or time.time()) * 1000000),
+            'stage': self.stage,
+            'event': name,
+            'message': message,
+            'durationMs': int(duration_ms) if duration_ms is not None else None,
+            'bytes': bytes_moved
+        })
+
+    def set_status(self, status, error=None, pdf_url=None):
+        self.status = status
+        self.error = error
+        self.pdf_url = pdf_url
+
+    def set_probe(self, route, probe):
+        # Результаты предварительной проверки файла сохраняются в строке задачи
+        self.route = route
+        self.probe = probe
+
+    def fail(self, error):
+        self.event('failed', error)
+        self.set_status('Ошибка', error=error)
+
+    def flush(self):
+        if self.task_id is None or (not self.events and self.status is None):
+            return
+
+        query = """
+        DECLARE $task_id AS Utf8;
+        DECLARE $events AS List<Struct<
+            createdAt: Timestamp,
+            stage: Utf8,
+            event: Utf8,
+            message: Utf8?,
+            durationMs: Uint64?,
+            bytes: Uint64?
+        >>;
+        DECLARE $stage AS Utf8;
+        DECLARE $status AS Utf8?;
+        DECLARE $error AS Utf8?;
+        DECLARE $pdf_url AS Utf8?;
+        DECLARE $route AS Utf8?;
+        DECLARE $probe AS Json?;
+
+        UPSERT INTO task_events (taskId, createdAt, stage, event, message, durationMs, bytes)
+        SELECT $task_id AS taskId, createdAt, stage, event, message, durationMs, bytes
+        FROM AS_TABLE($events);
+
+        UPDATE tasks
+        SET
+            status = $status,
+            stage = $stage,
+            errorMessage = COALESCE($error, errorMessage),
+            pdfUrl = COALESCE($pdf_url, pdfUrl),
+            updatedAt = CurrentUtcTimestamp()
+        WHERE taskId = $task_id AND $status IS NOT NULL;
+
+        UPDATE tasks
+        SET route = $route, probe = $probe
+        WHERE taskId = $task_id AND $route IS NOT NULL;
+        """
+        execute_query(query, {
+            '$task_id': self.task_id,
+            '$events': self.events,
+            '$stage': self.stage,
+            '$status': self.status,
+            '$error': self.error,
+            '$pdf_url': self.pdf_url,
+            '$route': self.route,
+            '$probe': json.dumps(self.probe, ensure_ascii=False) if self.probe is not None else None
+        })
+        self.events = []
+        self.status = None
+        self.route = None
+
+def get_s3_client():
+    # Клиенты создаются при первом использовании и живут весь срок жизни инстанса
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url=STORAGE_ENDPOINT,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(max_pool_connections=IO_CONCURRENCY)
+        )
+    return _s3_client
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+        from botocore.config import Config
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url=QUEUE_ENDPOINT,
+            region_name='ru-central1',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(
+                signature_version='s3v4',
+                s3={'addressing_style': 'virtual'},
+                max_pool_connections=IO_CONCURRENCY
+            )
+        )
+    return _sqs_client
+
+def get_http_session():
+    # Общая HTTP-сессия держит keep-alive соединения между вызовами
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=IO_CONCURRENCY, pool_maxsize=IO_CONCURRENCY)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+def get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _io_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
+    return _io_executor
+
+def get_session_pool():
+    # Драйвер и пул сессий живут весь срок жизни инстанса функции,
+    # поэтому подготовленные запросы переиспользуются между вызовами
+    global _ydb_driver, _ydb_pool
+    if _ydb_pool is None:
+        import ydb
+
+        # YDB_ENDPOINT без схемы — облачная база по grpcs, со схемой — например, локальный контейнер
+        endpoint = os.environ['YDB_ENDPOINT']
+        if '://' not in endpoint:
+            endpoint = f"grpcs://{endpoint}"
+        database = os.environ['YDB_DATABASE']
+
+        driver_config = ydb.DriverConfig(
+            endpoint=endpoint,
+            database=database,
+            credentials=ydb.credentials_from_env_variables(),
+            root_certificates=ydb.load_ydb_root_certificate() if endpoint.startswith('grpcs://') else None
+        )
+
+        _ydb_driver = ydb.Driver(driver_config)
+        _ydb_driver.wait(timeout=30, fail_fast=True)
+        _ydb_pool = ydb.SessionPool(_ydb_driver)
+    return _ydb_pool
+
+def execute_query(query, parameters=None):
+    import ydb
+
+    def callee(session):
+        prepared_query = session.prepare(query)
+        return session.transaction(ydb.SerializableReadWrite()).execute(
+            prepared_query,
+            parameters or {},
+            commit_tx=True
+        )
+    return get_session_pool().retry_operation_sync(callee)
+
+def defer_to_queue(message, delay_seconds):
+    queue_url = os.environ['SELF_QUEUE_URL']
+
+    sqs = get_sqs_client()
+
+    message['deferrals'] = message.get('deferrals', 0) + 1
+    send_params = {
+        'QueueUrl': queue_url,
+        'MessageBody': json.dumps(message, ensure_ascii=False),
+        'DelaySeconds': delay_seconds
+    }
+    return sqs.send_message(**send_params)
 
 def send_to_queue(message):
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
     queue_url = os.environ['QUEUE_URL']
 
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'virtual'}
-        )
-    )
+    sqs = get_sqs_client()
 
     send_params = {
         'QueueUrl': queue_url,
         'MessageBody': json.dumps(message, ensure_ascii=False),
     }
-    sqs.send_message(**send_params)
\ No newline at end of file
+    return sqs.send_message(**send_params)
+
+class QuotaExceeded(Exception):
+    """API ответил 429: квота исчерпана"""
+
+    def __init__(self, retry_after=None):
+        super().__init__(f'Quota exceeded, retry after {retry_after} s')
+        self.retry_after = retry_after
@@ -1,96 +1,759 @@
 import json
+import traceback
 import os
+import re
+import time
+from contextlib import contextmanager
 import uuid
-import boto3
-import requests
-from botocore.config import Config
-from datetime import datetime
-import ydb
+
+TASK_ENVELOPE_VERSION = 1
+STAGE_NAME = 'task-receiver'
+
+STORAGE_ENDPOINT = os.environ.get('STORAGE_ENDPOINT', 'https://storage.yandexcloud.net')
+QUEUE_ENDPOINT = os.environ.get('QUEUE_ENDPOINT', 'https://message-queue.api.cloud.yandex.net')
+YANDEX_DISK_API_URL = os.environ.get('YANDEX_DISK_API_URL', 'https://cloud-api.yandex.net')
+
+# Пакетная постановка задач: SendMessageBatch принимает не больше 10 сообщений
+MAX_BATCH_TASKS = 100
+QUEUE_BATCH_SIZE = 10
+DISK_FOLDER_PAGE_SIZE = 100
+
+# Полоса audio-extractor для прямых загрузок: длительность еще неизвестна, поэтому по размеру файла
+FAST_LANE_MAX_BYTES = 300 * 1024 * 1024
+
+# Прямая загрузка в Storage: части по 16 МБ, не больше 10 000 частей (ограничение S3)
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+MAX_UPLOAD_PARTS = 10000
+# Загруженный файл audio-extractor скачивает в /tmp целиком вместе с будущим аудио неизвестной
+# длительности, и все это должно поместиться в TMP_BUDGET_FRACTION его памяти (как в ScratchSpace
+# audio-extractor). Больший файл отклоняется до загрузки, а не после
+EXTRACTOR_MEMORY_MB = int(os.environ.get('EXTRACTOR_MEMORY_MB', '2048'))
+TMP_BUDGET_FRACTION = 0.6
+LONG_RECORDING_SECONDS = 2 * 3600
+AUDIO_BITRATE_KBPS = 192
+MAX_UPLOAD_BYTES = (
+    int(EXTRACTOR_MEMORY_MB * 1024 * 1024 * TMP_BUDGET_FRACTION)
+    - LONG_RECORDING_SECONDS * AUDIO_BITRATE_KBPS * 1000 // 8
+)
+UPLOAD_URL_EXPIRES_SECONDS = 6 * 3600
+
+_cold_start = True
+_s3_client = None
+_sqs_client = None
+_http_session = None
+_ydb_driver = None
+_ydb_pool = None
 
 def handler(event, context):
+    started_at = time.time()
+    tracer = Tracer(STAGE_NAME)
     try:
-        # 1. Парсинг тела запроса
-        body = json.loads(event['body'])
-        lecture_title = body['lectureTitle'].strip()
-        video_url = body['videoUrl'].strip()
-
-        # 2. Сохранение метаинформации о задаче
-        task_info = {
-            'task_id': str(uuid.uuid4()),
-            'lecture_title': lecture_title,
-            'video_url': video_url,
+        # Прямая загрузка файла в Storage: POST /api/uploads, POST /api/uploads/{taskId}/complete|abort
+        path = event.get('path', '')
+        if path.endswith('/complete'):
+            return complete_upload(event, tracer, started_at)
+        if path.endswith('/abort'):
+            return abort_upload(event, tracer)
+        if path.endswith('/uploads'):
+            return create_upload(event, tracer)
+        # Пакетная постановка курса: POST /api/tasks/batch
+        if path.endswith('/batch'):
+            return create_tasks_batch(event, tracer, started_at)
+
+        return create_task(event, tracer, started_at)
+
+    except RequestError as e:
+        tracer.error(e)
+        return json_response(e.status_code, {'error': str(e)})
+    except Exception as e:
+        tracer.error(e)
+        return json_response(500, {'error': "Произошла неожиданная ошибка.\nПопробуйте позднее."})
+    finally:
+        tracer.finish()
+
+def create_task(event, tracer, started_at):
+    # 1. Парсинг тела запроса
+    body = json.loads(event['body'])
+    lecture_title = body['lectureTitle'].strip()
+    video_url = body['videoUrl'].strip()
+
+    # 2. Сохранение метаинформации о задаче
+    task_info = {
+        'task_id': str(uuid.uuid4()),
+        'lecture_title': lecture_title,
+        'video_url': video_url,
+        'submitter': get_submitter(event)
+    }
+    tracer.bind(task_info['task_id'])
+    with tracer.span('save_task_info'):
+        save_task_info(task_info, 'completed')
+
+    # 3. Отправка сообщения в очередь для загрузки видео
+    envelope = new_task_envelope(task_info)
+    record_stage_timing(envelope, STAGE_NAME, started_at)
+    queue_message = {
+        'task_id': task_info['task_id'],
+        'lecture_title': lecture_title,
+        'video_url': video_url,
+        'envelope': envelope
+    } 
+    with tracer.span('send_to_queue') as span:
+        response = send_to_queue(queue_message)
+        span['retries'] = response['ResponseMetadata'].get('RetryAttempts', 0)
+    
+    # 4. Возврат успешного ответа
+    return {
+        'statusCode': 302,
+        'headers': {
+            'Location': '/tasks'
         }
-        save_task_info(task_info)
-
-        # 3. Отправка сообщения в очередь для загрузки видео
-        queue_message = {
-            'task_id': task_info['task_id'],
-            'lecture_title': lecture_title,
-            'video_url': video_url,
-        } 
-        send_to_queue(queue_message)
-        
-        # 4. Возврат успешного ответа
-        return {
-            'statusCode': 302,
-            'headers': {
-                'Location': '/tasks'
+    }
+
+def create_tasks_batch(event, tracer, started_at):
+    # 1. Список лекций из тела запроса или из публичной папки Яндекс Диска
+    body = json.loads(event['body'])
+    if body.get('folderUrl'):
+        with tracer.span('list_disk_folder'):
+            lectures = list_disk_folder(body['folderUrl'].strip(), (body.get('lectureTitle') or '').strip())
+    else:
+        lectures = [
+            {
+                'lecture_title': (lecture.get('lectureTitle') or '').strip(),
+                'video_url': (lecture.get('videoUrl') or '').strip()
             }
-        }
-    
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'error': "Произошла неожиданная ошибка.\nПопробуйте позднее."
-            }, ensure_ascii=False),
-            'headers': {
-                'Content-Type': 'application/json; charset=utf-8'
+            for lecture in body.get('lectures') or []
+        ]
+
+    if not lectures:
+        raise RequestError("Список лекций пуст")
+    if len(lectures) > MAX_BATCH_TASKS:
+        raise RequestError(f"За один раз можно отправить не больше {MAX_BATCH_TASKS} лекций")
+    if any(not lecture['lecture_title'] or not lecture['video_url'] for lecture in lectures):
+        raise RequestError("У каждой лекции должны быть название и ссылка на видео")
+
+    # 2. Все строки задач одним запросом
+    submitter = get_submitter(event)
+    tasks = [dict(lecture, task_id=str(uuid.uuid4()), submitter=submitter) for lecture in lectures]
+    with tracer.span('save_tasks') as span:
+        save_tasks(tasks)
+        span['rows'] = len(tasks)
+
+    # 3. Сообщения для video-downloader пачками по 10
+    messages = []
+    for task in tasks:
+        envelope = new_task_envelope(task)
+        if task.get('video_path'):
+            envelope['source']['path'] = task['video_path']
+        record_stage_timing(envelope, STAGE_NAME, started_at)
+        messages.append({
+            'task_id': task['task_id'],
+            'lecture_title': task['lecture_title'],
+            'video_url': task['video_url'],
+            'video_path': task.get('video_path'),
+            'envelope': envelope
+        })
+    with tracer.span('send_message_batch') as span:
+        failed = send_batch_to_queue(messages, tracer)
+        span['failed'] = len(failed)
+
+    # 4. Задачи, которые не удалось поставить в очередь (включая пачки, упавшие с исключением),
+    # сразу помечаются ошибкой, иначе они навсегда остались бы "В очереди"
+    if failed:
+        with tracer.span('save_failed_tasks'):
+            fail_tasks(failed, "Не удалось поставить задачу в очередь.\nПопробуйте позднее.")
+
+    return json_response(200, {
+        'taskIds': [task['task_id'] for task in tasks],
+        'failed': failed
+    })
+
+def list_disk_folder(folder_url, title_prefix):
+    # Файлы папки читаются страницами; в задаче остается ссылка на папку и путь к файлу в ней
+    items = []
+    offset = 0
+    while True:
+        response = get_http_session().get(
+            f"{YANDEX_DISK_API_URL}/v1/disk/public/resources",
+            params={
+                'public_key': folder_url,
+                'limit': DISK_FOLDER_PAGE_SIZE,
+                'offset': offset,
+                'fields': 'type,_embedded.total,_embedded.items.name,_embedded.items.path,'
+                          '_embedded.items.type,_embedded.items.media_type'
+            },
+            timeout=15
+        )
+        if response.status_code == 404:
+            raise RequestError("Папка не найдена по указанной ссылке")
+        if response.status_code == 403:
+            raise RequestError("Доступ к папке запрещен.\nУбедитесь, что папка доступна по публичной ссылке.")
+        response.raise_for_status()
+
+        data = response.json()
+        if data.get('type') != 'dir':
+            raise RequestError("Ссылка ведет на файл, а не на папку")
+
+        embedded = data.get('_embedded') or {}
+        page = embedded.get('items') or []
+        items.extend(page)
+        offset += len(page)
+        if not page or offset >= embedded.get('total', 0) or offset > MAX_BATCH_TASKS:
+            break
+
+    files = [
+        item for item in items
+        if item.get('type') == 'file' and item.get('media_type') in ('video', 'audio')
+    ]
+    files.sort(key=lambda item: natural_sort_key(item['name']))
+
+    lectures = []
+    for item in files:
+        name = os.path.splitext(item['name'])[0]
+        lectures.append({
+            'lecture_title': f"{title_prefix}. {name}" if title_prefix else name,
+            'video_url': folder_url,
+            'video_path': item['path']
+        })
+    return lectures
+
+def natural_sort_key(name):
+    # "Лекция 2" идет раньше "Лекция 10"
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def create_upload(event, tracer):
+    # 1. Парсинг и проверка тела запроса
+    body = json.loads(event['body'])
+    lecture_title = (body.get('lectureTitle') or '').strip()
+    file_size = int(body.get('fileSize') or 0)
+    content_type = body.get('contentType') or 'application/octet-stream'
+
+    if not lecture_title:
+        raise RequestError("Название лекции не может быть пустым")
+    if file_size <= 0:
+        raise RequestError("Файл пустой")
+    if file_size > MAX_UPLOAD_BYTES:
+        raise RequestError(f"Файл больше {MAX_UPLOAD_BYTES // 1024 ** 2} МБ")
+    if not content_type.startswith(('video/', 'audio/')):
+        raise RequestError("Можно загрузить только видео- или аудиофайл")
+
+    # 2. Создание multipart-загрузки в videos/
+    bucket_name = os.environ['STORAGE_BUCKET']
+    object_key = f"videos/{uuid.uuid4()}"
+    task_info = {
+        'task_id': str(uuid.uuid4()),
+        'lecture_title': lecture_title,
+        'video_url': f"https://{bucket_name}.storage.yandexcloud.net/{object_key}",
+        'submitter': get_submitter(event)
+    }
+    tracer.bind(task_info['task_id'])
+
+    s3 = get_s3_client()
+    with tracer.span('create_multipart_upload'):
+        upload = s3.create_multipart_upload(Bucket=bucket_name, Key=object_key, ContentType=content_type)
+
+    # 3. Подписанные ссылки на каждую часть: браузер грузит их параллельно напрямую в Storage
+    part_size = get_part_size(file_size)
+    part_count = -(-file_size // part_size)
+    with tracer.span('presign_parts'):
+        parts = [
+            {
+                'partNumber': part_number,
+                'url': s3.generate_presigned_url(
+                    'upload_part',
+                    Params={
+                        'Bucket': bucket_name,
+                        'Key': object_key,
+                        'UploadId': upload['UploadId'],
+                        'PartNumber': part_number
+                    },
+                    ExpiresIn=UPLOAD_URL_EXPIRES_SECONDS
+                )
             }
-        }
-    
-def save_task_info(task_info):
-    query = f"""
-    UPSERT INTO tasks (taskId, lectureTitle, videoUrl, status, createdAt)
-    VALUES ("{task_info['task_id']}", "{task_info['lecture_title']}", "{task_info['video_url']}", "В очереди", CurrentUtcTimestamp());
+            for part_number in range(1, part_count + 1)
+        ]
+
+    # 4. Задача создается сразу, чтобы загрузка была видна в списке заданий
+    with tracer.span('save_task_info'):
+        save_task_info(task_info, 'started')
+
+    return json_response(200, {
+        'taskId': task_info['task_id'],
+        'uploadId': upload['UploadId'],
+        'partSize': part_size,
+        'parts': parts
+    })
+
+def complete_upload(event, tracer, started_at):
+    # 1. Проверка, что задача ждет завершения загрузки
+    task_id = get_upload_task_id(event)
+    tracer.bind(task_id)
+    body = json.loads(event['body'])
+    upload_id = body.get('uploadId')
+    parts = body.get('parts') or []
+    if not upload_id or not parts:
+        raise RequestError("Не переданы части загруженного файла")
+
+    with tracer.span('select_task'):
+        task = select_upload_task(task_id)
+
+    # 2. Сборка объекта из частей; ключ берется из задачи, а не из запроса
+    bucket_name, object_key = parse_storage_url(task.videoUrl)
+    s3 = get_s3_client()
+    with tracer.span('complete_multipart_upload'):
+        s3.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(
+                ({'PartNumber': int(part['partNumber']), 'ETag': part['etag']} for part in parts),
+                key=lambda part: part['PartNumber']
+            )}
+        )
+    with tracer.span('head_object') as span:
+        head = s3.head_object(Bucket=bucket_name, Key=object_key)
+        span['bytes'] = head['ContentLength']
+
+    # 3. Видео уже в Storage, поэтому задача сразу уходит в очередь извлечения аудио
+    envelope = new_task_envelope({
+        'task_id': task_id,
+        'lecture_title': task.lectureTitle,
+        'video_url': task.videoUrl,
+        'submitter': task.submitter
+    })
+    envelope['source'].update({
+        'size': head['ContentLength'],
+        'mime_type': head.get('ContentType'),
+        'upload': 'direct'
+    })
+    # Этап task-receiver длится от создания загрузки до ее завершения
+    record_stage_timing(envelope, STAGE_NAME, min(task.createdAt / 1000000, started_at))
+    envelope['lane'] = 'fast' if head['ContentLength'] <= FAST_LANE_MAX_BYTES else 'slow'
+    queue_message = {
+        'task_id': task_id,
+        'storage_url': task.videoUrl,
+        'envelope': envelope
+    }
+    queue_url = os.environ['AUDIO_SLOW_QUEUE_URL' if envelope['lane'] == 'slow' else 'AUDIO_QUEUE_URL']
+
+    # 4. Завершение отмечается до постановки в очередь: из одновременных запросов задачу ставит только первый
+    with tracer.span('claim_upload_completion'):
+        claim_upload_completion(task_id, head['ContentLength'])
+
+    try:
+        with tracer.span('send_to_queue') as span:
+            response = send_to_queue(queue_message, queue_url)
+            span['retries'] = response['ResponseMetadata'].get('RetryAttempts', 0)
+    except Exception:
+        save_upload_result(task_id, 'failed', error="Не удалось поставить задачу в очередь")
+        raise
+
+    return json_response(200, {'taskId': task_id})
+
+def abort_upload(event, tracer):
+    task_id = get_upload_task_id(event)
+    tracer.bind(task_id)
+    body = json.loads(event.get('body') or '{}')
+
+    with tracer.span('select_task'):
+        task = select_upload_task(task_id)
+
+    if body.get('uploadId'):
+        bucket_name, object_key = parse_storage_url(task.videoUrl)
+        with tracer.span('abort_multipart_upload'):
+            get_s3_client().abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=body['uploadId'])
+
+    with tracer.span('save_upload_result'):
+        save_upload_result(task_id, 'failed', error="Загрузка файла прервана")
+
+    return json_response(200, {'taskId': task_id})
+
+def get_upload_task_id(event):
+    task_id = (event.get('pathParams') or event.get('params') or {}).get('taskId') or ''
+    try:
+        return str(uuid.UUID(task_id))
+    except ValueError:
+        raise RequestError("Задание не найдено", 404)
+
+def get_submitter(event):
+    # Отправитель для справедливой очереди — IP клиента из контекста API Gateway
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    forwarded = (event.get('headers') or {}).get('X-Forwarded-For') or ''
+    return identity.get('sourceIp') or forwarded.split(',')[0].strip() or None
+
+def get_part_size(file_size):
+    # Не больше MAX_UPLOAD_PARTS частей: для больших файлов часть увеличивается кратно мегабайту
+    part_size = max(UPLOAD_PART_SIZE, -(-file_size // MAX_UPLOAD_PARTS))
+    return -(-part_size // (1024 * 1024)) * 1024 * 1024
+
+def parse_storage_url(storage_url):
+    bucket_name = storage_url.split('//')[1].split('.')[0]
+    object_key = storage_url.split(bucket_name + '.storage.yandexcloud.net/')[1]
+    return bucket_name, object_key
+
+def select_upload_task(task_id):
+    query = """
+    DECLARE $task_id AS Utf8;
+    DECLARE $stage AS Utf8;
+
+    SELECT taskId, lectureTitle, videoUrl, status, stage, createdAt, submitter
+    FROM tasks
+    WHERE taskId = $task_id AND stage = $stage;
     """
-    execute_query(query)
+    rows = execute_query(query, {'$task_id': task_id, '$stage': STAGE_NAME})[0].rows
+    if not rows:
+        raise RequestError("Задание не найдено", 404)
 
-def execute_query(query):
-    endpoint = f"grpcs://{os.environ['YDB_ENDPOINT']}"
-    database = os.environ['YDB_DATABASE']
-    
-    driver_config = ydb.DriverConfig(
-        endpoint=endpoint,
-        database=database,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate()
-    )
-    
-    with ydb.Driver(driver_config) as driver:
-        driver.wait(timeout=30, fail_fast=True)
-        session = driver.table_client.session().create()
-        session.transaction().execute(query, commit_tx=True)
-
-def send_to_queue(task):
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    queue_url = os.environ['QUEUE_URL']
-    
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'virtual'}
+    # Загрузка ждет завершения, пока у задачи на этапе task-receiver нет события completed или failed
+    task = rows[0]
+    if task.status != "В очереди" or upload_finished(task_id):
+        raise RequestError("Загрузка уже завершена", 409)
+    return task
+
+def upload_finished(task_id):
+    query = """
+    DECLARE $task_id AS Utf8;
+    DECLARE $stage AS Utf8;
+
+    SELECT event
+    FROM task_events
+    WHERE taskId = $task_id AND stage = $stage;
+    """
+    rows = execute_query(query, {'$task_id': task_id, '$stage': STAGE_NAME})[0].rows
+    return any(row.event in ('completed', 'failed') for row in rows)
+
+def claim_upload_completion(task_id, bytes_moved):
+    # Проверка и запись события completed — в одной сериализуемой транзакции
+    import ydb
+
+    select_query = """
+    DECLARE $task_id AS Utf8;
+    DECLARE $stage AS Utf8;
+
+    SELECT event
+    FROM task_events
+    WHERE taskId = $task_id AND stage = $stage;
+    """
+    complete_query = """
+    DECLARE $task_id AS Utf8;
+    DECLARE $stage AS Utf8;
+    DECLARE $bytes AS Uint64;
+
+    UPSERT INTO task_events (taskId, createdAt, stage, event, bytes)
+    VALUES ($task_id, CurrentUtcTimestamp(), $stage, "completed", $bytes);
+
+    UPDATE tasks
+    SET updatedAt = CurrentUtcTimestamp()
+    WHERE taskId = $task_id;
+    """
+    parameters = {'$task_id': task_id, '$stage': STAGE_NAME}
+
+    def callee(session):
+        tx = session.transaction(ydb.SerializableReadWrite()).begin()
+        rows = tx.execute(session.prepare(select_query), parameters)[0].rows
+        if any(row.event in ('completed', 'failed') for row in rows):
+            tx.rollback()
+            return False
+        tx.execute(session.prepare(complete_query), dict(parameters, **{'$bytes': bytes_moved}), commit_tx=True)
+        return True
+
+    if not get_session_pool().retry_operation_sync(callee):
+        raise RequestError("Загрузка уже завершена", 409)
+
+def save_task_info(task_info, event):
+    query = """
+    DECLARE $task_id AS Utf8;
+    DECLARE $lecture_title AS Utf8;
+    DECLARE $video_url AS Utf8;
+    DECLARE $stage AS Utf8;
+    DECLARE $event AS Utf8;
+    DECLARE $submitter AS Utf8?;
+
+    UPSERT INTO tasks (taskId, lectureTitle, videoUrl, status, stage, submitter, createdAt, updatedAt)
+    VALUES ($task_id, $lecture_title, $video_url, "В очереди", $stage, $submitter, CurrentUtcTimestamp(), CurrentUtcTimestamp());
+
+    UPSERT INTO task_events (taskId, createdAt, stage, event)
+    VALUES ($task_id, CurrentUtcTimestamp(), $stage, $event);
+    """
+    execute_query(query, {
+        '$task_id': task_info['task_id'],
+        '$lecture_title': task_info['lecture_title'],
+        '$video_url': task_info['video_url'],
+        '$stage': STAGE_NAME,
+        '$event': event,
+        '$submitter': task_info.get('submitter')
+    })
+
+def save_tasks(tasks):
+    query = """
+    DECLARE $rows AS List<Struct<
+        taskId: Utf8,
+        lectureTitle: Utf8,
+        videoUrl: Utf8,
+        submitter: Utf8?
+    >>;
+    DECLARE $stage AS Utf8;
+
+    UPSERT INTO tasks (taskId, lectureTitle, videoUrl, status, stage, submitter, createdAt, updatedAt)
+    SELECT taskId, lectureTitle, videoUrl, "В очереди" AS status, $stage AS stage, submitter,
+        CurrentUtcTimestamp() AS createdAt, CurrentUtcTimestamp() AS updatedAt
+    FROM AS_TABLE($rows);
+
+    UPSERT INTO task_events (taskId, createdAt, stage, event)
+    SELECT taskId, CurrentUtcTimestamp() AS createdAt, $stage AS stage, "completed" AS event
+    FROM AS_TABLE($rows);
+    """
+    execute_query(query, {
+        '$rows': [
+            {
+                'taskId': task['task_id'],
+                'lectureTitle': task['lecture_title'],
+                'videoUrl': task['video_url'],
+                'submitter': task['submitter']
+            }
+            for task in tasks
+        ],
+        '$stage': STAGE_NAME
+    })
+
+def fail_tasks(task_ids, error):
+    query = """
+    DECLARE $task_ids AS List<Utf8>;
+    DECLARE $error AS Utf8;
+
+    UPDATE tasks
+    SET status = "Ошибка", errorMessage = $error, updatedAt = CurrentUtcTimestamp()
+    WHERE taskId IN $task_ids;
+    """
+    execute_query(query, {'$task_ids': task_ids, '$error': error})
+
+def save_upload_result(task_id, event, bytes_moved=None, error=None):
+    query = """
+    DECLARE $task_id AS Utf8;
+    DECLARE $stage AS Utf8;
+    DECLARE $event AS Utf8;
+    DECLARE $status AS Utf8?;
+    DECLARE $bytes AS Uint64?;
+    DECLARE $error AS Utf8?;
+
+    UPSERT INTO task_events (taskId, createdAt, stage, event, message, bytes)
+    VALUES ($task_id, CurrentUtcTimestamp(), $stage, $event, $error, $bytes);
+
+    UPDATE tasks
+    SET status = COALESCE($status, status), errorMessage = COALESCE($error, errorMessage), updatedAt = CurrentUtcTimestamp()
+    WHERE taskId = $task_id;
+    """
+    execute_query(query, {
+        '$task_id': task_id,
+        '$stage': STAGE_NAME,
+        '$event': event,
+        '$status': "Ошибка" if error else None,
+        '$bytes': bytes_moved,
+        '$error': error
+    })
+
+def json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json; charset=utf-8',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(body, ensure_ascii=False)
+    }
+
+def new_task_envelope(task_info):
+    return {
+        'version': TASK_ENVELOPE_VERSION,
+        'task_id': task_info['task_id'],
+        'lecture_title': task_info['lecture_title'],
+        'submitter': task_info.get('submitter'),
+        'source': {
+            'url': task_info['video_url']
+        },
+        'timings': {}
+    }
+
+def record_stage_timing(envelope, stage, started_at):
+    timing = envelope['timings'].setdefault(stage, {'started_at': round(started_at, 3)})
+    timing['finished_at'] = round(time.time(), 3)
+
+class Tracer:
+    """Замеряет шаги обработчика и пишет их структурированными JSON-логами"""
+
+    def __init__(self, stage, status_writer=None):
+        global _cold_start
+        self.stage = stage
+        self.status_writer = status_writer
+        self.task_id = None
+        self.cold_start = _cold_start
+        self.started_at = time.time()
+        _cold_start = False
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    @contextmanager
+    def span(self, name):
+        # В span можно дописать bytes и retries — они попадут в лог и в task_events
+        span = {'name': name}
+        started_at = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration_ms'] = round((time.time() - started_at) * 1000, 1)
+            self.log('span', **span)
+            if self.status_writer is not None:
+                self.status_writer.event(
+                    name,
+                    created_at=started_at,
+                    duration_ms=span['duration_ms'],
+                    bytes_moved=span.get('bytes')
+                )
+
+    def error(self, e):
+        # Трейсбек берется из самого исключения: в корутине ошибка может логироваться вне блока except
+        self.log(
+            'error',
+            error=type(e).__name__,
+            message=str(e),
+            traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__))
         )
-    )
+
+    def finish(self):
+        self.log('invocation', duration_ms=round((time.time() - self.started_at) * 1000, 1))
+
+    def log(self, msg, **fields):
+        record = {
+            'msg': msg,
+            'stage': self.stage,
+            'task_id': self.task_id,
+            'cold_start': self.cold_start
+        }
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+def get_s3_client():
+    # Клиенты создаются при первом использовании и живут весь срок жизни инстанса
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url=STORAGE_ENDPOINT,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    return _s3_client
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+        from botocore.config import Config
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url=QUEUE_ENDPOINT,
+            region_name='ru-central1',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(
+                signature_version='s3v4',
+                s3={'addressing_style': 'virtual'}
+            )
+        )
+    return _sqs_client
+
+def get_http_session():
+    # Общая HTTP-сессия держит keep-alive соединения между вызовами
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+    return _http_session
+
+def get_session_pool():
+    # Драйвер и пул сессий живут весь срок жизни инстанса функции,
+    # поэтому подготовленные запросы переиспользуются между вызовами
+    global _ydb_driver, _ydb_pool
+    if _ydb_pool is None:
+        import ydb
+
+        # YDB_ENDPOINT без схемы — облачная база по grpcs, со схемой — например, локальный контейнер
+        endpoint = os.environ['YDB_ENDPOINT']
+        if '://' not in endpoint:
+            endpoint = f"grpcs://{endpoint}"
+        database = os.environ['YDB_DATABASE']
+
+        driver_config = ydb.DriverConfig(
+            endpoint=endpoint,
+            database=database,
+            credentials=ydb.credentials_from_env_variables(),
+            root_certificates=ydb.load_ydb_root_certificate() if endpoint.startswith('grpcs://') else None
+        )
+
+        _ydb_driver = ydb.Driver(driver_config)
+        _ydb_driver.wait(timeout=30, fail_fast=True)
+        _ydb_pool = ydb.SessionPool(_ydb_driver)
+    return _ydb_pool
+
+def execute_query(query, parameters=None):
+    import ydb
+
+    def callee(session):
+        prepared_query = session.prepare(query)
+        return session.transaction(ydb.SerializableReadWrite()).execute(
+            prepared_query,
+            parameters or {},
+            commit_tx=True
+        )
+    return get_session_pool().retry_operation_sync(callee)
+
+def send_to_queue(task, queue_url=None):
+    queue_url = queue_url or os.environ['QUEUE_URL']
+    
+    sqs = get_sqs_client()
 
     send_params = {
         'QueueUrl': queue_url,
         'MessageBody': json.dumps(task, ensure_ascii=False),
     }
-    sqs.send_message(**send_params)
\ No newline at end of file
+    return sqs.send_message(**send_params)
+
+def send_batch_to_queue(tasks, tracer, queue_url=None):
+    # Возвращает task_id сообщений, которые очередь не приняла и после повторной попытки
+    queue_url = queue_url or os.environ['QUEUE_URL']
+
+    sqs = get_sqs_client()
+
+    failed = []
+    for start in range(0, len(tasks), QUEUE_BATCH_SIZE):
+        entries = {
+            str(index): task
+            for index, task in enumerate(tasks[start:start + QUEUE_BATCH_SIZE])
+        }
+        for attempt in range(2):
+            try:
+                response = sqs.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[
+                        {'Id': entry_id, 'MessageBody': json.dumps(task, ensure_ascii=False)}
+                        for entry_id, task in entries.items()
+                    ]
+                )
+            except Exception as e:
+                # SDK уже повторил запрос: неотправленные сообщения пачки считаются непринятыми
+                tracer.error(e)
+                break
+            entries = {item['Id']: entries[item['Id']] for item in response.get('Failed', [])}
+            if not entries:
+                break
+        failed.extend(task['task_id'] for task in entries.values())
+    return failed
+
+class RequestError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
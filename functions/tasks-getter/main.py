@@ -1,77 +1,429 @@
 import json
-import ydb
+import traceback
 import os
+import time
+from contextlib import contextmanager
+import uuid
 from datetime import datetime
-import boto3
+
+# Long-poll: страница держит один запрос на весь список, а не по запросу на задачу. Пока
+# изменений нет, интервал между чтениями YDB растет от LONG_POLL_INTERVAL_SECONDS до
+# LONG_POLL_MAX_INTERVAL_SECONDS
+LONG_POLL_MAX_SECONDS = 60
+LONG_POLL_INTERVAL_SECONDS = 1
+LONG_POLL_MAX_INTERVAL_SECONDS = 5
+
+# Подписанная ссылка на PDF действует час; теплый инстанс отдает ее повторно, пока
+# остается больше половины срока, и не подписывает заново каждую строку списка задач
+PRESIGNED_URL_EXPIRES_SECONDS = 3600
+PRESIGNED_URL_CACHE_SIZE = 10000
+
+STAGE_NAME = 'tasks-getter'
+
+STORAGE_ENDPOINT = os.environ.get('STORAGE_ENDPOINT', 'https://storage.yandexcloud.net')
+
+# Лимиты общего бюджета внешних API — те же, что у speech-recognizer и note-generator
+API_BUDGET_LIMITS = {
+    'speechkit': {
+        'maxOperations': int(os.environ.get('SPEECHKIT_MAX_OPERATIONS', '10')),
+        'maxRps': int(os.environ.get('SPEECHKIT_MAX_RPS', '5'))
+    },
+    'yandexgpt': {
+        'maxOperations': int(os.environ.get('GPT_MAX_OPERATIONS', '10')),
+        'maxRps': int(os.environ.get('GPT_MAX_RPS', '10'))
+    }
+}
+
+_cold_start = True
+_s3_client = None
+_ydb_driver = None
+_ydb_pool = None
+_presigned_urls = {}
 
 def handler(event, context):
+    tracer = Tracer(STAGE_NAME)
+    try:
+        task_id = (event.get('pathParams') or event.get('params') or {}).get('taskId')
+        if task_id:
+            tracer.bind(task_id)
+
+            # Хронология этапов задачи: GET /api/tasks/{taskId}/timeline
+            if event.get('path', '').endswith('/timeline'):
+                return get_task_timeline(task_id, tracer)
+
+            # Запрос одной задачи: GET /api/tasks/{taskId}
+            return get_single_task(task_id, event.get('queryStringParameters') or {}, tracer)
+
+        # Загрузка бюджета SpeechKit и YandexGPT: GET /api/quotas
+        if event.get('path', '').endswith('/quotas'):
+            return get_api_budget(tracer)
+
+        # Список задач или long-poll изменений списка: GET /api/tasks?wait=...&since=...
+        params = event.get('queryStringParameters') or {}
+        if params.get('wait'):
+            return get_changed_tasks(params, tracer)
+
+        return get_all_tasks(tracer)
+    finally:
+        tracer.finish()
+
+def get_all_tasks(tracer):
     # Получаем все задачи из таблицы с сортировкой по дате
     query = """
-    SELECT 
+    SELECT
         taskId,
         lectureTitle,
         videoUrl,
         status,
+        stage,
         createdAt,
+        updatedAt,
         pdfUrl,
-        errorMessage
+        errorMessage,
+        route,
+        probe
     FROM tasks
     ORDER BY createdAt DESC
     """
-    
+
     try:
-        rows = execute_query(query)[0].rows
-        
-        tasks = []
-        for row in rows:
-            created_at = None
-            if row.createdAt:
-                timestamp_micro = row.createdAt
-                timestamp_sec = timestamp_micro / 1000000
-                dt = datetime.fromtimestamp(timestamp_sec)
-                created_at = dt.isoformat()
-            
-            tasks.append({
-                'taskId': row.taskId,
-                'lectureTitle': row.lectureTitle,
-                'videoUrl': row.videoUrl,
-                'status': row.status,
-                'createdAt': created_at,
-                'pdfUrl': generate_presigned_url(row.pdfUrl),
-                'errorMessage': row.errorMessage
-            })
-        
+        with tracer.span('select_tasks'):
+            rows = execute_query(query)[0].rows
+
+        with tracer.span('serialize_tasks'):
+            tasks = [serialize_task(row) for row in rows]
+
+        return json_response(200, tasks)
+
+    except Exception as e:
+        tracer.error(e)
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def get_changed_tasks(params, tracer):
+    # Ждем задачи, измененные позже since — последнего updatedAt, известного клиенту
+    try:
+        wait_seconds = parse_wait_seconds(params)
+        since = parse_timestamp(params.get('since'))
+    except ValueError:
+        return json_response(400, {'error': 'Параметры wait и since должны быть числом секунд и датой'})
+
+    try:
+        with tracer.span('wait_for_tasks_change') as span:
+            rows = wait_for_tasks_change(since, wait_seconds)
+            span['tasks'] = len(rows)
+
+        with tracer.span('serialize_tasks'):
+            tasks = [serialize_task(row) for row in rows]
+
+        return json_response(200, tasks)
+
+    except Exception as e:
+        tracer.error(e)
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def get_single_task(task_id, params, tracer):
+    try:
+        task_id = str(uuid.UUID(task_id))
+    except ValueError:
+        return json_response(404, {'error': 'Задание не найдено'})
+
+    try:
+        wait_seconds = parse_wait_seconds(params)
+    except ValueError:
+        return json_response(400, {'error': 'Параметр wait должен быть числом секунд'})
+
+    try:
+        # Long-poll: ждем, пока статус или updatedAt отличаются от известных клиенту
+        if wait_seconds > 0:
+            with tracer.span('wait_for_task_change'):
+                row = wait_for_task_change(
+                    task_id,
+                    params.get('status'),
+                    params.get('updatedAt'),
+                    wait_seconds
+                )
+        else:
+            with tracer.span('select_task'):
+                row = select_task(task_id)
+
+        if row is None:
+            return json_response(404, {'error': 'Задание не найдено'})
+
+        return json_response(200, serialize_task(row))
+
+    except Exception as e:
+        tracer.error(e)
         return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps(tasks, ensure_ascii=False)
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
         }
-        
+
+def get_task_timeline(task_id, tracer):
+    try:
+        task_id = str(uuid.UUID(task_id))
+    except ValueError:
+        return json_response(404, {'error': 'Задание не найдено'})
+
+    query = """
+    DECLARE $task_id AS Utf8;
+
+    SELECT createdAt, stage, event, message, durationMs, bytes
+    FROM task_events
+    WHERE taskId = $task_id
+    ORDER BY createdAt;
+    """
+
+    try:
+        with tracer.span('select_task_events'):
+            rows = execute_query(query, {'$task_id': task_id})[0].rows
+
+        if not rows:
+            return json_response(404, {'error': 'Задание не найдено'})
+
+        return json_response(200, build_timeline(task_id, rows))
+
     except Exception as e:
+        tracer.error(e)
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
         }
 
+def get_api_budget(tracer):
+    query = """
+    SELECT api, kind, expiresAt
+    FROM api_budget
+    """
+
+    try:
+        with tracer.span('select_api_budget'):
+            rows = execute_query(query)[0].rows
+
+        # Истекшие строки еще не удалены — учитываются только действующие
+        now = int(time.time() * 1000000)
+        budget = []
+        for api, limits in API_BUDGET_LIMITS.items():
+            active = [row for row in rows if row.api == api and row.expiresAt > now]
+            operations = sum(1 for row in active if row.kind == 'operation')
+            requests = sum(1 for row in active if row.kind == 'request')
+            budget.append({
+                'api': api,
+                'operations': operations,
+                'maxOperations': limits['maxOperations'],
+                'requestsPerSecond': requests,
+                'maxRps': limits['maxRps'],
+                'utilization': round(max(
+                    operations / limits['maxOperations'],
+                    requests / limits['maxRps']
+                ), 2)
+            })
+            tracer.log('api_budget', **budget[-1])
+
+        return json_response(200, budget)
+
+    except Exception as e:
+        tracer.error(e)
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def build_timeline(task_id, rows):
+    # Строки task_events отсортированы по времени, поэтому этапы идут в порядке конвейера
+    stages = {}
+    for row in rows:
+        stage = stages.setdefault(row.stage, {
+            'stage': row.stage,
+            'startedAt': None,
+            'finishedAt': None,
+            'outcome': None,
+            'error': None,
+            'bytes': 0,
+            'spans': []
+        })
+
+        if row.durationMs is not None:
+            stage['spans'].append({
+                'name': row.event,
+                'startedAt': format_timestamp(row.createdAt),
+                'durationMs': row.durationMs,
+                'bytes': row.bytes
+            })
+            stage['bytes'] += row.bytes or 0
+        elif row.event == 'started':
+            stage['startedAt'] = stage['startedAt'] or row.createdAt
+        elif row.event in ('completed', 'failed'):
+            stage['finishedAt'] = row.createdAt
+            stage['outcome'] = row.event
+            stage['error'] = row.message
+
+    timeline = []
+    previous_finished_at = None
+    for stage in stages.values():
+        started_at = stage['startedAt'] or stage['finishedAt']
+        finished_at = stage['finishedAt']
+
+        stage['durationMs'] = (finished_at - started_at) // 1000 if started_at and finished_at else None
+        # Время ожидания в очереди между окончанием предыдущего этапа и началом текущего
+        stage['queueWaitMs'] = (
+            (started_at - previous_finished_at) // 1000
+            if started_at and previous_finished_at else None
+        )
+        stage['startedAt'] = format_timestamp(started_at)
+        stage['finishedAt'] = format_timestamp(finished_at)
+
+        previous_finished_at = finished_at or previous_finished_at
+        timeline.append(stage)
+
+    first_started_at = min(row.createdAt for row in rows)
+    return {
+        'taskId': task_id,
+        'totalMs': (previous_finished_at - first_started_at) // 1000 if previous_finished_at else None,
+        'bytes': sum(stage['bytes'] for stage in timeline),
+        'stages': timeline
+    }
+
+def select_task(task_id):
+    query = """
+    DECLARE $task_id AS Utf8;
+
+    SELECT
+        taskId,
+        lectureTitle,
+        videoUrl,
+        status,
+        stage,
+        createdAt,
+        updatedAt,
+        pdfUrl,
+        errorMessage,
+        route,
+        probe
+    FROM tasks
+    WHERE taskId = $task_id;
+    """
+    rows = execute_query(query, {'$task_id': task_id})[0].rows
+    return rows[0] if rows else None
+
+def select_tasks_updated_after(since):
+    # Диапазон по вторичному индексу idx_updated_at: чтение затрагивает только измененные строки
+    query = """
+    DECLARE $since AS Timestamp;
+
+    SELECT
+        taskId,
+        lectureTitle,
+        videoUrl,
+        status,
+        stage,
+        createdAt,
+        updatedAt,
+        pdfUrl,
+        errorMessage,
+        route,
+        probe
+    FROM tasks VIEW idx_updated_at
+    WHERE updatedAt > $since;
+    """
+    return execute_query(query, {'$since': since})[0].rows
+
+def wait_for_tasks_change(since, wait_seconds):
+    deadline = time.monotonic() + wait_seconds
+    interval = LONG_POLL_INTERVAL_SECONDS
+
+    while True:
+        rows = select_tasks_updated_after(since)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, LONG_POLL_MAX_INTERVAL_SECONDS)
+
+def wait_for_task_change(task_id, known_status, known_updated_at, wait_seconds):
+    deadline = time.monotonic() + wait_seconds
+    interval = LONG_POLL_INTERVAL_SECONDS
+
+    # Чтения по первичному ключу через пул сессий с уже подготовленным запросом
+    while True:
+        row = select_task(task_id)
+        if row is None:
+            return None
+
+        changed = (
+            row.status != (known_status or '')
+            or (format_timestamp(row.updatedAt) or '') != (known_updated_at or '')
+        )
+        remaining = deadline - time.monotonic()
+        if changed or remaining <= 0:
+            return row
+
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, LONG_POLL_MAX_INTERVAL_SECONDS)
+
+def parse_wait_seconds(params):
+    wait_seconds = int(params.get('wait', 0) or 0)
+    if wait_seconds < 0:
+        raise ValueError(f'negative wait: {wait_seconds}')
+    return min(wait_seconds, LONG_POLL_MAX_SECONDS)
+
+def parse_timestamp(value):
+    # Обратное к format_timestamp: дата в ISO без часового пояса — в микросекунды
+    if not value:
+        return 0
+    return round(datetime.fromisoformat(value).timestamp() * 1000000)
+
+def serialize_task(row):
+    return {
+        'taskId': row.taskId,
+        'lectureTitle': row.lectureTitle,
+        'videoUrl': row.videoUrl,
+        'status': row.status,
+        'stage': row.stage,
+        'createdAt': format_timestamp(row.createdAt),
+        'updatedAt': format_timestamp(row.updatedAt),
+        'pdfUrl': generate_presigned_url(row.pdfUrl),
+        'errorMessage': row.errorMessage,
+        'route': row.route,
+        'probe': json.loads(row.probe) if row.probe else None
+    }
+
+def format_timestamp(timestamp_micro):
+    if not timestamp_micro:
+        return None
+    timestamp_sec = timestamp_micro / 1000000
+    dt = datetime.fromtimestamp(timestamp_sec)
+    return dt.isoformat()
+
+def json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(body, ensure_ascii=False)
+    }
+
 def generate_presigned_url(url):
     if not url:
         return None
-    
+
+    cached = _presigned_urls.get(url)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
     bucket_name = url.split('.')[0].replace('https://', '')
     object_key = url.split(bucket_name + '.storage.yandexcloud.net/')[1]
-    
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    
-    s3 = boto3.client('s3',
-        endpoint_url='https://storage.yandexcloud.net',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
-   
+
+    s3 = get_s3_client()
+
     presigned_url = s3.generate_presigned_url(
         'get_object',
         Params={
@@ -79,23 +431,118 @@ def generate_presigned_url(url):
             'Key': object_key,
             'ResponseContentDisposition': 'attachment'
         },
-        ExpiresIn=3600
+        ExpiresIn=PRESIGNED_URL_EXPIRES_SECONDS
     )
+
+    if len(_presigned_urls) >= PRESIGNED_URL_CACHE_SIZE:
+        _presigned_urls.clear()
+    _presigned_urls[url] = (presigned_url, time.time() + PRESIGNED_URL_EXPIRES_SECONDS / 2)
     return presigned_url
 
-def execute_query(query):
-    endpoint = f"grpcs://{os.environ['YDB_ENDPOINT']}"
-    database = os.environ['YDB_DATABASE']
-    
-    driver_config = ydb.DriverConfig(
-        endpoint=endpoint,
-        database=database,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate()
-    )
-    
-    with ydb.Driver(driver_config) as driver:
-        driver.wait(timeout=30, fail_fast=True)
-        session = driver.table_client.session().create()
-        result = session.transaction().execute(query, commit_tx=True)
-        return result
\ No newline at end of file
+class Tracer:
+    """Замеряет шаги обработчика и пишет их структурированными JSON-логами"""
+
+    def __init__(self, stage, status_writer=None):
+        global _cold_start
+        self.stage = stage
+        self.status_writer = status_writer
+        self.task_id = None
+        self.cold_start = _cold_start
+        self.started_at = time.time()
+        _cold_start = False
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    @contextmanager
+    def span(self, name):
+        # В span можно дописать bytes и retries — они попадут в лог и в task_events
+        span = {'name': name}
+        started_at = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration_ms'] = round((time.time() - started_at) * 1000, 1)
+            self.log('span', **span)
+            if self.status_writer is not None:
+                self.status_writer.event(
+                    name,
+                    created_at=started_at,
+                    duration_ms=span['duration_ms'],
+                    bytes_moved=span.get('bytes')
+                )
+
+    def error(self, e):
+        # Трейсбек берется из самого исключения: в корутине ошибка может логироваться вне блока except
+        self.log(
+            'error',
+            error=type(e).__name__,
+            message=str(e),
+            traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        )
+
+    def finish(self):
+        self.log('invocation', duration_ms=round((time.time() - self.started_at) * 1000, 1))
+
+    def log(self, msg, **fields):
+        record = {
+            'msg': msg,
+            'stage': self.stage,
+            'task_id': self.task_id,
+            'cold_start': self.cold_start
+        }
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+def get_s3_client():
+    # Клиенты создаются при первом использовании и живут весь срок жизни инстанса
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url=STORAGE_ENDPOINT,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    return _s3_client
+
+def get_session_pool():
+    # Драйвер и пул сессий живут весь срок жизни инстанса функции,
+    # поэтому подготовленные запросы переиспользуются между вызовами
+    global _ydb_driver, _ydb_pool
+    if _ydb_pool is None:
+        import ydb
+
+        # YDB_ENDPOINT без схемы — облачная база по grpcs, со схемой — например, локальный контейнер
+        endpoint = os.environ['YDB_ENDPOINT']
+        if '://' not in endpoint:
+            endpoint = f"grpcs://{endpoint}"
+        database = os.environ['YDB_DATABASE']
+
+        driver_config = ydb.DriverConfig(
+            endpoint=endpoint,
+            database=database,
+            credentials=ydb.credentials_from_env_variables(),
+            root_certificates=ydb.load_ydb_root_certificate() if endpoint.startswith('grpcs://') else None
+        )
+
+        _ydb_driver = ydb.Driver(driver_config)
+        _ydb_driver.wait(timeout=30, fail_fast=True)
+        _ydb_pool = ydb.SessionPool(_ydb_driver)
+    return _ydb_pool
+
+def execute_query(query, parameters=None):
+    import ydb
+
+    def callee(session):
+        prepared_query = session.prepare(query)
+        return session.transaction(ydb.SerializableReadWrite()).execute(
+            prepared_query,
+            parameters or {},
+            commit_tx=True
+        )
+    return get_session_pool().retry_operation_sync(callee)
\ No newline at end of file
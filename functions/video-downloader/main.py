@@ -1,45 +1,209 @@
 import os
-import ydb
+import re
+import shutil
+import subprocess
 import tempfile
+import time
+from contextlib import contextmanager
 import uuid
-import boto3
-import requests
-from botocore.config import Config
 import json
+import traceback
+
+TASK_ENVELOPE_VERSION = 1
+STAGE_NAME = 'video-downloader'
+
+STORAGE_ENDPOINT = os.environ.get('STORAGE_ENDPOINT', 'https://storage.yandexcloud.net')
+QUEUE_ENDPOINT = os.environ.get('QUEUE_ENDPOINT', 'https://message-queue.api.cloud.yandex.net')
+YANDEX_DISK_API_URL = os.environ.get('YANDEX_DISK_API_URL', 'https://cloud-api.yandex.net')
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+
+# Предварительная проверка источника: ограничения асинхронного распознавания SpeechKit
+# и порог, после которого аудио извлекается в компактном профиле
+MAX_SOURCE_BYTES = 5 * 1024 ** 3
+MAX_DURATION_SECONDS = 4 * 3600
+LONG_RECORDING_SECONDS = 2 * 3600
+PROBE_TIMEOUT_SECONDS = 20
+# Аудиофайлы в этих кодеках SpeechKit принимает как есть, без извлечения аудио, если контейнер —
+# тот, что указан (имя формата ffmpeg; оно же передается SpeechKit как формат аудио)
+SPEECHKIT_AUDIO_CODECS = {
+    'mp3': 'mp3',
+    'opus': 'ogg',
+    'pcm_s16le': 'wav'
+}
+# Обложки в аудиофайлах ffmpeg показывает как видеопоток
+COVER_ART_CODECS = {'mjpeg', 'png'}
+
+# Полоса audio-extractor выбирается по длительности, а если она неизвестна — по размеру файла
+FAST_LANE_MAX_SECONDS = 30 * 60
+FAST_LANE_MAX_BYTES = 300 * 1024 * 1024
+
+# Пока в очереди этапа ждут другие сообщения, у одного отправителя одновременно скачивается
+# не больше SUBMITTER_SLOTS видео (0 — без лимита), остальные задачи откладываются в свою же
+# очередь с растущей задержкой
+SUBMITTER_SLOTS = int(os.environ.get('SUBMITTER_SLOTS', 2))
+SLOT_LEASE_SECONDS = 900
+FAIR_SHARE_DELAY_SECONDS = 30
+FAIR_SHARE_MAX_DELAY_SECONDS = 900
+FAIR_SHARE_MAX_DEFERRALS = 6
+
+# Совмещенный режим: аудио извлекается прямо по ссылке Яндекс Диска, в Storage попадает только
+# аудио, а сообщение уходит сразу в speech-recognizer, минуя audio-extractor. Исходное видео
+# при этом сохраняется в videos/, только если включен STORE_SOURCE_VIDEO
+FUSED_EXTRACTION = os.environ.get('FUSED_EXTRACTION', 'false') == 'true'
+STORE_SOURCE_VIDEO = os.environ.get('STORE_SOURCE_VIDEO', 'false') == 'true'
+# Профили извлечения — те же, что у audio-extractor
+AUDIO_PROFILE = {
+    'codec': 'mp3',
+    'encoder': 'libmp3lame',
+    'bitrate': '192k',
+    'sample_rate': 44100
+}
+LONG_AUDIO_PROFILE = {
+    'codec': 'mp3',
+    'encoder': 'libmp3lame',
+    'bitrate': '48k',
+    'sample_rate': 16000,
+    'channels': 1
+}
+
+# /tmp в Cloud Functions хранится в оперативной памяти и делит лимит памяти с процессом:
+# под временные файлы отводится TMP_BUDGET_FRACTION лимита, остальное — интерпретатору и буферам
+TMP_BUDGET_FRACTION = 0.6
+DEFAULT_MEMORY_MB = 2048
+
+_cold_start = True
+_s3_client = None
+_sqs_client = None
+_http_session = None
+_ydb_driver = None
+_ydb_pool = None
 
 def handler(event, context):
+    started_at = time.time()
+    status_writer = StatusWriter(STAGE_NAME)
+    tracer = Tracer(STAGE_NAME, status_writer)
+    submitter = None
+    slot_acquired = False
+    scratch = ScratchSpace(STAGE_NAME, getattr(context, 'memory_limit_in_mb', None))
     try:
         # 1. Парсинг сообщения из очереди
         message = event['messages'][0]['details']['message']
         data = json.loads(message['body'])
-
-        # 2. Обновление статуса задачи
+        envelope = get_task_envelope(data)
         task_id = data['task_id']
-        update_task_status(task_id, 'В обработке')
+        tracer.bind(task_id)
+
+        # 2. Слот отправителя: если все заняты и в очереди ждут другие задачи, эта откладывается
+        submitter = envelope.get('submitter')
+        if submitter:
+            slot_acquired = acquire_submitter_slot(submitter, task_id, SUBMITTER_SLOTS or None)
+            if not slot_acquired and not fair_share_contended(data):
+                slot_acquired = acquire_submitter_slot(submitter, task_id, None)
+            if not slot_acquired:
+                tracer.log('deferred', submitter=submitter, deferrals=data.get('deferrals', 0) + 1)
+                defer_to_queue(data)
+                return
+        status_writer.start(task_id)
 
         # 3. Валидация полей
-        download_url = validate_request(data)
+        with tracer.span('validate_yandex_disk_url'):
+            resource = validate_request(data)
+        envelope['lecture_title'] = data['lecture_title'].strip()
+        envelope['source'].update({
+            'size': resource.get('size'),
+            'mime_type': resource.get('mime_type'),
+            'media_type': resource.get('media_type'),
+            'md5': resource.get('md5')
+        })
+        if data.get('video_path'):
+            envelope['source']['path'] = data['video_path']
+
+        # 4. Предварительная проверка файла по заголовкам, до скачивания
+        with tracer.span('probe_media'):
+            probe = probe_media(resource.get('file', ''), tracer)
+        route, reject_reason = choose_route(resource.get('size'), probe)
+        envelope['probe'] = dict(probe or {}, route=route)
+        status_writer.set_probe(route, dict(envelope['source'], **envelope['probe']))
+        if reject_reason:
+            raise ValidationError(reject_reason)
 
-        # 4. Скачивание видео
-        video_path = download_video(download_url)
+        # 5. Скачивание видео, если оно помещается во временное место. В совмещенном режиме
+        # ffmpeg читает видео по ссылке сам, и скачивать его нужно, только чтобы сохранить.
+        # Без ffmpeg (проба не удалась) задача идет обычным путем через audio-extractor
+        fused = FUSED_EXTRACTION and probe is not None and route in ('standard', 'long')
+        profile = LONG_AUDIO_PROFILE if route == 'long' else AUDIO_PROFILE
+        audio_bytes = estimate_audio_bytes(probe['duration'], profile) if fused else 0
+        video_path = None
+        if fused and not STORE_SOURCE_VIDEO:
+            scratch.reserve(audio_bytes, 'извлечения аудио')
+        else:
+            scratch.reserve((resource.get('size') or 0) + audio_bytes, 'скачивания')
+            with tracer.span('download_video') as span:
+                video_path = download_video(resource.get('file', ''), scratch.file('video.mp4'))
+                span['bytes'] = os.path.getsize(video_path)
 
-        # 5. Загрузка видео в Storage
-        storage_url = upload_video(video_path)
+        # 6. Загрузка в Storage: аудиофайл в поддерживаемом SpeechKit формате сразу идет на распознавание
+        if route == 'fast':
+            audio_codec = SPEECHKIT_AUDIO_CODECS[probe['audio_codec']]
+            envelope['source']['duration'] = probe['duration']
+            envelope['audio_profile'] = {'codec': audio_codec}
+            with tracer.span('upload_audio') as span:
+                storage_url = upload_video(video_path, 'audios', resource.get('mime_type'))
+                span['bytes'] = os.path.getsize(video_path)
+            queue_url = os.environ['SPEECH_QUEUE_URL']
+        elif fused:
+            if video_path:
+                with tracer.span('upload_video') as span:
+                    envelope['source']['video_storage_url'] = upload_video(video_path)
+                    span['bytes'] = os.path.getsize(video_path)
+            with tracer.span('extract_audio') as span:
+                audio_path, duration = extract_audio(
+                    video_path or resource.get('file', ''), scratch.file('audio.mp3'), profile
+                )
+                span['bytes'] = os.path.getsize(audio_path)
+            envelope['source']['duration'] = duration or probe['duration']
+            envelope['audio_profile'] = profile
+            with tracer.span('upload_audio') as span:
+                storage_url = upload_video(audio_path, 'audios', 'audio/mpeg')
+                span['bytes'] = os.path.getsize(audio_path)
+            queue_url = os.environ['SPEECH_QUEUE_URL']
+        else:
+            with tracer.span('upload_video') as span:
+                storage_url = upload_video(video_path)
+                span['bytes'] = os.path.getsize(video_path)
+            envelope['lane'] = choose_lane(envelope)
+            queue_url = os.environ['SLOW_QUEUE_URL' if envelope['lane'] == 'slow' else 'QUEUE_URL']
 
-        # 6. Отправка сообщения в очередь для извлечения аудио
+        # 7. Отправка сообщения в очередь для извлечения аудио или распознавания
+        record_stage_timing(envelope, STAGE_NAME, started_at)
         queue_message = {
             'task_id': task_id,
-            'storage_url': storage_url
+            'storage_url': storage_url,
+            'envelope': envelope
         } 
-        send_to_queue(queue_message)
-
-        # 7. Удаление временных файлов
-        os.remove(video_path)
+        with tracer.span('send_to_queue') as span:
+            response = send_to_queue(queue_message, queue_url)
+            span['retries'] = response['ResponseMetadata'].get('RetryAttempts', 0)
+        status_writer.event('completed')
+        status_writer.set_status('В обработке')
 
     except ValidationError as e:
-        update_task_status_with_error(task_id, 'Ошибка', str(e))
+        tracer.error(e)
+        status_writer.fail(str(e))
     except Exception as e:
-        update_task_status_with_error(task_id, 'Ошибка', 'Произошла ошибка во время загрузки видео')
+        tracer.error(e)
+        status_writer.fail('Произошла ошибка во время загрузки видео')
+    finally:
+        # Временные файлы удаляются при любом исходе, чтобы не занимать память инстанса
+        scratch.cleanup()
+        status_writer.flush()
+        if slot_acquired:
+            try:
+                release_submitter_slot(submitter, task_id)
+            except Exception as e:
+                # Слот освободится сам через SLOT_LEASE_SECONDS
+                tracer.error(e)
+        tracer.finish()
 
 def validate_request(body):
     if not body['lecture_title'].strip():
@@ -49,17 +213,20 @@ def validate_request(body):
     if not video_url.strip():
         raise ValidationError("Ссылка на видео не может быть пустой")
     
-    return validate_yandex_disk_url(video_url)
+    return validate_yandex_disk_url(video_url, body.get('video_path'))
 
-def validate_yandex_disk_url(url):
-    api_url = "https://cloud-api.yandex.net/v1/disk/public/resources"
+def validate_yandex_disk_url(url, path=None):
+    api_url = f"{YANDEX_DISK_API_URL}/v1/disk/public/resources"
     
     params = {
         'public_key': url,
-        'fields': 'name,mime_type,type,file'
+        'fields': 'name,mime_type,media_type,type,file,size,md5'
     }
+    # Файл из папки, отправленной целиком: ссылка на папку и путь внутри нее
+    if path:
+        params['path'] = path
    
-    response = requests.get(api_url, params=params, timeout=15)
+    response = get_http_session().get(api_url, params=params, timeout=15)
         
     if response.status_code == 200:
         data = response.json()
@@ -81,51 +248,335 @@ def analyze_api_response(data):
         raise ValidationError("Неизвестный тип ресурса. Ожидается видеофайл.")
     
     mime_type = data.get('mime_type', '')
-    video_mime_prefixes = ['video/', 'application/x-mpegURL', 'application/vnd.apple.mpegurl']
+    media_mime_prefixes = ['video/', 'audio/', 'application/x-mpegURL', 'application/vnd.apple.mpegurl']
     
-    if not any(mime_type.startswith(prefix) for prefix in video_mime_prefixes):
-        raise ValidationError("Неизвестный тип ресурса. Ожидается видеофайл.")
+    if data.get('media_type') not in ('video', 'audio') and not any(mime_type.startswith(prefix) for prefix in media_mime_prefixes):
+        raise ValidationError("Неизвестный тип ресурса. Ожидается видео- или аудиофайл.")
     
-    return data.get('file', '')
+    return data
 
-def update_task_status(task_id, status):
-    query = f"""
-    UPDATE tasks 
-    SET status = '{status}'
-    WHERE taskId = '{task_id}';
-    """
-    execute_query(query)
+def probe_media(source, tracer):
+    # ffmpeg без выходного файла читает только заголовки контейнера — для HTTP-ссылки
+    # это несколько range-запросов, а не скачивание всего файла. Без ответа ffmpeg задача идет
+    # без предварительной проверки, и об этом пишется предупреждение: отсутствие бинарника
+    # в архиве функции иначе не заметить
+    try:
+        result = subprocess.run(
+            [FFMPEG_PATH, '-hide_banner', '-nostdin', '-i', source],
+            capture_output=True,
+            text=True,
+            timeout=PROBE_TIMEOUT_SECONDS
+        )
+    except OSError as e:
+        tracer.log('warning', message=f'ffmpeg недоступен ({FFMPEG_PATH}), проверка пропущена', error=str(e))
+        return None
+    except subprocess.TimeoutExpired:
+        tracer.log('warning', message=f'ffmpeg не ответил за {PROBE_TIMEOUT_SECONDS} с, проверка пропущена')
+        return None
+    return parse_probe(result.stderr)
 
-def update_task_status_with_error(task_id, status, error):
-    query = f"""
-    UPDATE tasks 
-    SET status = '{status}', errorMessage = '{error}'
-    WHERE taskId = '{task_id}';
-    """
-    execute_query(query)
+def parse_probe(ffmpeg_output):
+    # Строки потоков: "Stream #0:0(und): Video: h264 (High) ...", "Stream #0:1(rus): Audio: aac (LC) ..."
+    streams = re.findall(r'Stream #\d+:\d+\S*: (Video|Audio): (\w+)', ffmpeg_output or '')
+    video_codecs = [codec for kind, codec in streams if kind == 'Video' and codec not in COVER_ART_CODECS]
+    audio_codecs = [codec for kind, codec in streams if kind == 'Audio']
+    # Контейнер: "Input #0, ogg, from ...", для mkv — "Input #0, matroska,webm, from ..."
+    container = re.search(r'Input #\d+, (\S+), from', ffmpeg_output or '')
+    return {
+        'duration': parse_duration(ffmpeg_output),
+        'container': container.group(1) if container else None,
+        'video_codec': video_codecs[0] if video_codecs else None,
+        'audio_codec': audio_codecs[0] if audio_codecs else None,
+        'has_audio': bool(audio_codecs),
+        'readable': bool(streams)
+    }
 
-def execute_query(query):
-    endpoint = f"grpcs://{os.environ['YDB_ENDPOINT']}"
-    database = os.environ['YDB_DATABASE']
-    
-    driver_config = ydb.DriverConfig(
-        endpoint=endpoint,
-        database=database,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate()
-    )
-    
-    with ydb.Driver(driver_config) as driver:
-        driver.wait(timeout=30, fail_fast=True)
-        session = driver.table_client.session().create()
-        session.transaction().execute(query, commit_tx=True)
-
-def download_video(url):
-    temp_dir = tempfile.mkdtemp()
-    file_name = "video.mp4"
-    file_path = os.path.join(temp_dir, file_name)
-    
-    response = requests.get(url, stream=True, timeout=60)
+def choose_route(size, probe):
+    # Возвращает путь обработки и текст ошибки для непригодных файлов
+    if size and size > MAX_SOURCE_BYTES:
+        return 'reject', f"Файл больше {MAX_SOURCE_BYTES // 1024 ** 3} ГБ"
+    if probe is None:
+        # ffmpeg недоступен или не ответил вовремя — обрабатываем без предварительной проверки
+        return 'standard', None
+    if not probe['readable']:
+        return 'reject', "Файл не является видео- или аудиозаписью"
+    if not probe['has_audio']:
+        return 'reject', "В файле нет звуковой дорожки"
+    duration = probe['duration']
+    if duration and duration > MAX_DURATION_SECONDS:
+        return 'reject', f"Запись длиннее {MAX_DURATION_SECONDS // 3600} часов"
+    if probe['video_codec'] is None and is_speechkit_audio(probe):
+        return 'fast', None
+    if duration and duration > LONG_RECORDING_SECONDS:
+        return 'long', None
+    return 'standard', None
+
+def choose_lane(envelope):
+    # Короткие записи идут в быструю очередь, длинные — в медленную со своим пулом инстансов
+    duration = (envelope.get('probe') or {}).get('duration') or envelope['source'].get('duration')
+    if duration is not None:
+        return 'fast' if duration <= FAST_LANE_MAX_SECONDS else 'slow'
+    size = envelope['source'].get('size')
+    return 'fast' if size is None or size <= FAST_LANE_MAX_BYTES else 'slow'
+
+def is_speechkit_audio(probe):
+    # Кодек подходит, только если он в своем контейнере: opus в webm или mp3 в mkv SpeechKit не примет
+    container = SPEECHKIT_AUDIO_CODECS.get(probe['audio_codec'])
+    return container is not None and container in (probe.get('container') or '').split(',')
+
+def parse_duration(ffmpeg_output):
+    # ffmpeg пишет длительность входного файла в stderr: "Duration: 01:23:45.67"
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', ffmpeg_output or '')
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def get_task_envelope(data):
+    # Конверт задачи передается между этапами, чтобы не читать строку задачи из YDB
+    envelope = data.get('envelope') or {}
+    envelope.setdefault('version', TASK_ENVELOPE_VERSION)
+    envelope.setdefault('task_id', data['task_id'])
+    envelope.setdefault('source', {})
+    envelope.setdefault('timings', {})
+    return envelope
+
+def record_stage_timing(envelope, stage, started_at):
+    timing = envelope['timings'].setdefault(stage, {'started_at': round(started_at, 3)})
+    timing['finished_at'] = round(time.time(), 3)
+
+class Tracer:
+    """Замеряет шаги обработчика и пишет их структурированными JSON-логами"""
+
+    def __init__(self, stage, status_writer=None):
+        global _cold_start
+        self.stage = stage
+        self.status_writer = status_writer
+        self.task_id = None
+        self.cold_start = _cold_start
+        self.started_at = time.time()
+        _cold_start = False
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    @contextmanager
+    def span(self, name):
+        # В span можно дописать bytes и retries — они попадут в лог и в task_events
+        span = {'name': name}
+        started_at = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration_ms'] = round((time.time() - started_at) * 1000, 1)
+            self.log('span', **span)
+            if self.status_writer is not None:
+                self.status_writer.event(
+                    name,
+                    created_at=started_at,
+                    duration_ms=span['duration_ms'],
+                    bytes_moved=span.get('bytes')
+                )
+
+    def error(self, e):
+        # Трейсбек берется из самого исключения: в корутине ошибка может логироваться вне блока except
+        self.log(
+            'error',
+            error=type(e).__name__,
+            message=str(e),
+            traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        )
+
+    def finish(self):
+        self.log('invocation', duration_ms=round((time.time() - self.started_at) * 1000, 1))
+
+    def log(self, msg, **fields):
+        record = {
+            'msg': msg,
+            'stage': self.stage,
+            'task_id': self.task_id,
+            'cold_start': self.cold_start
+        }
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+class StatusWriter:
+    """Накапливает переходы статуса задачи и записывает их одной транзакцией"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.task_id = None
+        self.events = []
+        self.status = None
+        self.error = None
+        self.pdf_url = None
+        self.route = None
+        self.probe = None
+
+    def bind(self, task_id):
+        self.task_id = task_id
+
+    def start(self, task_id):
+        self.bind(task_id)
+        self.event('started')
+
+    def event(self, name, message=None, created_at=None, duration_ms=None, bytes_moved=None):
+        self.events.append({
+            'createdAt': int((created_at or time.time()) * 1000000),
+            'stage': self.stage,
+            'event': name,
+            'message': message,
+            'durationMs': int(duration_ms) if duration_ms is not None else None,
+            'bytes': bytes_moved
+        })
+
+    def set_status(self, status, error=None, pdf_url=None):
+        self.status = status
+        self.error = error
+        self.pdf_url = pdf_url
+
+    def set_probe(self, route, probe):
+        # Результаты предварительной проверки файла сохраняются в строке задачи
+        self.route = route
+        self.probe = probe
+
+    def fail(self, error):
+        self.event('failed', error)
+        self.set_status('Ошибка', error=error)
+
+    def flush(self):
+        if self.task_id is None or (not self.events and self.status is None):
+            return
+
+        query = """
+        DECLARE $task_id AS Utf8;
+        DECLARE $events AS List<Struct<
+            createdAt: Timestamp,
+            stage: Utf8,
+            event: Utf8,
+            message: Utf8?,
+            durationMs: Uint64?,
+            bytes: Uint64?
+        >>;
+        DECLARE $stage AS Utf8;
+        DECLARE $status AS Utf8?;
+        DECLARE $error AS Utf8?;
+        DECLARE $pdf_url AS Utf8?;
+        DECLARE $route AS Utf8?;
+        DECLARE $probe AS Json?;
+
+        UPSERT INTO task_events (taskId, createdAt, stage, event, message, durationMs, bytes)
+        SELECT $task_id AS taskId, createdAt, stage, event, message, durationMs, bytes
+        FROM AS_TABLE($events);
+
+        UPDATE tasks
+        SET
+            status = $status,
+            stage = $stage,
+            errorMessage = COALESCE($error, errorMessage),
+            pdfUrl = COALESCE($pdf_url, pdfUrl),
+            updatedAt = CurrentUtcTimestamp()
+        WHERE taskId = $task_id AND $status IS NOT NULL;
+
+        UPDATE tasks
+        SET route = $route, probe = $probe
+        WHERE taskId = $task_id AND $route IS NOT NULL;
+        """
+        execute_query(query, {
+            '$task_id': self.task_id,
+            '$events': self.events,
+            '$stage': self.stage,
+            '$status': self.status,
+            '$error': self.error,
+            '$pdf_url': self.pdf_url,
+            '$route': self.route,
+            '$probe': json.dumps(self.probe, ensure_ascii=False) if self.probe is not None else None
+        })
+        self.events = []
+        self.status = None
+        self.route = None
+
+def get_s3_client():
+    # Клиенты создаются при первом использовании и живут весь срок жизни инстанса
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url=STORAGE_ENDPOINT,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    return _s3_client
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+        from botocore.config import Config
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url=QUEUE_ENDPOINT,
+            region_name='ru-central1',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(
+                signature_version='s3v4',
+                s3={'addressing_style': 'virtual'}
+            )
+        )
+    return _sqs_client
+
+def get_http_session():
+    # Общая HTTP-сессия держит keep-alive соединения между вызовами
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+    return _http_session
+
+def get_session_pool():
+    # Драйвер и пул сессий живут весь срок жизни инстанса функции,
+    # поэтому подготовленные запросы переиспользуются между вызовами
+    global _ydb_driver, _ydb_pool
+    if _ydb_pool is None:
+        import ydb
+
+        # YDB_ENDPOINT без схемы — облачная база по grpcs, со схемой — например, локальный контейнер
+        endpoint = os.environ['YDB_ENDPOINT']
+        if '://' not in endpoint:
+            endpoint = f"grpcs://{endpoint}"
+        database = os.environ['YDB_DATABASE']
+
+        driver_config = ydb.DriverConfig(
+            endpoint=endpoint,
+            database=database,
+            credentials=ydb.credentials_from_env_variables(),
+            root_certificates=ydb.load_ydb_root_certificate() if endpoint.startswith('grpcs://') else None
+        )
+
+        _ydb_driver = ydb.Driver(driver_config)
+        _ydb_driver.wait(timeout=30, fail_fast=True)
+        _ydb_pool = ydb.SessionPool(_ydb_driver)
+    return _ydb_pool
+
+def execute_query(query, parameters=None):
+    import ydb
+
+    def callee(session):
+        prepared_query = session.prepare(query)
+        return session.transaction(ydb.SerializableReadWrite()).execute(
+            prepared_query,
+            parameters or {},
+            commit_tx=True
+        )
+    return get_session_pool().retry_operation_sync(callee)
+
+def download_video(url, file_path):
+    response = get_http_session().get(url, stream=True, timeout=60)
     response.raise_for_status()
     
     with open(file_path, 'wb') as f:
@@ -135,54 +586,187 @@ def download_video(url):
     
     return file_path
 
-def upload_video(file_path):
+def extract_audio(source, audio_path, profile):
+    # Источник — локальный файл или ссылка на скачивание: по HTTP ffmpeg читает поток сам
+    # и при обрыве соединения переподключается с той же позиции
+    ffmpeg_cmd = [FFMPEG_PATH, '-hide_banner', '-nostdin']
+    if source.startswith(('http://', 'https://')):
+        ffmpeg_cmd += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '10']
+    ffmpeg_cmd += [
+        '-i', source,
+        '-vn',
+        '-acodec', profile['encoder'],
+        '-ab', profile['bitrate'],
+        '-ar', str(profile['sample_rate'])
+    ]
+    if profile.get('channels'):
+        ffmpeg_cmd += ['-ac', str(profile['channels'])]
+    ffmpeg_cmd += ['-y', audio_path]
+    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
+    if result.returncode != 0 or not os.path.exists(audio_path) or os.path.getsize(audio_path) == 0:
+        raise Exception(f"ffmpeg error: {result.returncode} - {result.stderr[-500:]}")
+    return audio_path, parse_duration(result.stderr)
+
+def estimate_audio_bytes(duration, profile):
+    # Длительность неизвестна — берется порог длинной записи
+    kilobits_per_second = int(profile['bitrate'].rstrip('k'))
+    return int((duration or LONG_RECORDING_SECONDS) * kilobits_per_second * 1000 / 8)
+
+def upload_video(file_path, prefix='videos', content_type=None):
     bucket_name = os.environ['STORAGE_BUCKET']
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
     
-    s3_client = boto3.client(
-        's3',
-        endpoint_url='https://storage.yandexcloud.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
+    s3_client = get_s3_client()
     file_name = uuid.uuid4()
-    object_key = f"videos/{file_name}"
+    object_key = f"{prefix}/{file_name}"
     
     with open(file_path, 'rb') as f:
         s3_client.upload_fileobj(
             f,
             bucket_name,
             object_key,
-            ExtraArgs={'ContentType': 'video/mp4'}
+            ExtraArgs={'ContentType': content_type or 'video/mp4'}
         )
     storage_url = f"https://{bucket_name}.storage.yandexcloud.net/{object_key}"
     return storage_url
 
-def send_to_queue(task):
-    access_key = os.environ['AWS_ACCESS_KEY_ID']
-    secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    queue_url = os.environ['QUEUE_URL']
-    
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'virtual'}
-        )
+def acquire_submitter_slot(submitter, task_id, limit):
+    # Слот — строка в submitter_slots; слоты упавших вызовов не учитываются после SLOT_LEASE_SECONDS
+    import ydb
+
+    select_query = """
+    DECLARE $submitter AS Utf8;
+    DECLARE $stage AS Utf8;
+
+    SELECT taskId, acquiredAt
+    FROM submitter_slots
+    WHERE submitter = $submitter AND stage = $stage;
+    """
+    upsert_query = """
+    DECLARE $submitter AS Utf8;
+    DECLARE $stage AS Utf8;
+    DECLARE $task_id AS Utf8;
+
+    UPSERT INTO submitter_slots (submitter, stage, taskId, acquiredAt)
+    VALUES ($submitter, $stage, $task_id, CurrentUtcTimestamp());
+    """
+    parameters = {'$submitter': submitter, '$stage': STAGE_NAME}
+
+    def callee(session):
+        # Чтение занятых слотов и запись нового — в одной сериализуемой транзакции
+        tx = session.transaction(ydb.SerializableReadWrite()).begin()
+        rows = tx.execute(session.prepare(select_query), parameters)[0].rows
+        lease_after = int((time.time() - SLOT_LEASE_SECONDS) * 1000000)
+        active = [row for row in rows if row.taskId != task_id and row.acquiredAt > lease_after]
+        if limit is not None and len(active) >= limit:
+            tx.rollback()
+            return False
+        tx.execute(session.prepare(upsert_query), dict(parameters, **{'$task_id': task_id}), commit_tx=True)
+        return True
+
+    return get_session_pool().retry_operation_sync(callee)
+
+def release_submitter_slot(submitter, task_id):
+    query = """
+    DECLARE $submitter AS Utf8;
+    DECLARE $stage AS Utf8;
+    DECLARE $task_id AS Utf8;
+
+    DELETE FROM submitter_slots
+    WHERE submitter = $submitter AND stage = $stage AND taskId = $task_id;
+    """
+    execute_query(query, {
+        '$submitter': submitter,
+        '$stage': STAGE_NAME,
+        '$task_id': task_id
+    })
+
+def defer_to_queue(message):
+    queue_url = os.environ['SELF_QUEUE_URL']
+
+    sqs = get_sqs_client()
+
+    message['deferrals'] = message.get('deferrals', 0) + 1
+    delay = min(FAIR_SHARE_DELAY_SECONDS * 2 ** (message['deferrals'] - 1), FAIR_SHARE_MAX_DELAY_SECONDS)
+    send_params = {
+        'QueueUrl': queue_url,
+        'MessageBody': json.dumps(message, ensure_ascii=False),
+        'DelaySeconds': delay
+    }
+    return sqs.send_message(**send_params)
+
+def fair_share_contended(message):
+    # Лимит отправителя действует, только пока в очереди есть видимые сообщения других задач:
+    # отложенные с задержкой не считаются, а после FAIR_SHARE_MAX_DEFERRALS откладываний задача больше не ждет
+    if message.get('deferrals', 0) >= FAIR_SHARE_MAX_DEFERRALS:
+        return False
+
+    sqs = get_sqs_client()
+
+    response = sqs.get_queue_attributes(
+        QueueUrl=os.environ['SELF_QUEUE_URL'],
+        AttributeNames=['ApproximateNumberOfMessages']
     )
+    return int(response['Attributes'].get('ApproximateNumberOfMessages', 0)) > 0
+
+class ScratchSpace:
+    """Временный каталог вызова в /tmp с проверкой бюджета места; удаляется в finally обработчика"""
+
+    def __init__(self, stage, memory_mb=None):
+        self.prefix = f'scratch-{stage}-'
+        self.budget = int((memory_mb or DEFAULT_MEMORY_MB) * 1024 * 1024 * TMP_BUDGET_FRACTION)
+        self.path = None
+        # Инстанс обрабатывает один вызов за раз, поэтому каталоги этапа от прошлых вызовов —
+        # остатки прерванных по таймауту или падению; без удаления они занимали бы память
+        root = tempfile.gettempdir()
+        for name in os.listdir(root):
+            if name.startswith(self.prefix):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def file(self, name):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix=self.prefix)
+        return os.path.join(self.path, name)
+
+    def reserve(self, size, purpose):
+        # Проверка до начала работы: лучше сразу отказать, чем упасть по памяти на середине
+        available = self.budget - tmp_usage()
+        if size > available:
+            raise ScratchSpaceExceeded(
+                f'Файл слишком большой для обработки: для {purpose} нужно '
+                f'{size // 1024 ** 2} МБ временного места, доступно {max(available, 0) // 1024 ** 2} МБ'
+            )
+        return available - size
+
+    def cleanup(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+def tmp_usage():
+    total = 0
+    for dirpath, _, filenames in os.walk(tempfile.gettempdir()):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def send_to_queue(task, queue_url=None):
+    queue_url = queue_url or os.environ['QUEUE_URL']
+    
+    sqs = get_sqs_client()
 
     send_params = {
         'QueueUrl': queue_url,
         'MessageBody': json.dumps(task, ensure_ascii=False),
     }
-    sqs.send_message(**send_params)    
+    return sqs.send_message(**send_params)
 
 class ValidationError(Exception):
     """Ошибка валидации входных данных"""
+    pass
+
+class ScratchSpaceExceeded(ValidationError):
+    """Файл не помещается во временное место функции"""
     pass    
\ No newline at end of file
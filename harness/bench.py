@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""Микробенчмарки CPU-операций конвейера.
+
+Каждый замер запускается в отдельном интерпретаторе, чтобы пиковая память одного случая
+не влияла на другой. Для каждого случая печатается время (лучшее и медиана из --repeats),
+пик выделенной Python-памяти и сколько ее осталось после вызова (tracemalloc), число
+оставшихся блоков и прирост пикового RSS процесса — он учитывает и память C-библиотек
+вроде PyMuPDF. Входные данные синтетические и детерминированные: лекции 10 минут, 1 и 4 часа,
+списки из 10, 1000 и 100 000 задач.
+
+    python harness/bench.py --output bench.json
+    python harness/bench.py --only convert_markdown_to_pdf --compare bench.json
+"""
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+from compaction_bench import synthetic_transcript
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(ROOT, 'functions')
+
+LECTURE_MINUTES = [10, 60, 240]
+TASK_COUNTS = [10, 1000, 100000]
+
+# Реплики из SpeechKit v3 приходят несколькими сообщениями: промежуточные, final и finalRefinement
+PARTIALS_PER_UTTERANCE = 3
+# Конспект: раздел на каждые 5 минут лекции
+NOTE_MINUTES_PER_SECTION = 5
+# Случай, первый вызов которого дольше этого, не повторяется: хватает одного замера
+SLOW_CASE_SECONDS = 10
+
+
+def load_function(name):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    path = os.path.join(FUNCTIONS_DIR, name, 'main.py')
+    spec = importlib.util.spec_from_file_location(f"bench_{name.replace('-', '_')}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def recognition_dump(minutes):
+    lines = []
+    for index, text in enumerate(synthetic_transcript(minutes).split('\n')):
+        words = text.split()
+        for part in range(1, PARTIALS_PER_UTTERANCE + 1):
+            lines.append({'result': {'channelTag': '0', 'partial': {'alternatives': [
+                {'text': ' '.join(words[:len(words) * part // (PARTIALS_PER_UTTERANCE + 1)])}
+            ]}}})
+        alternatives = {'alternatives': [{'text': text}]}
+        lines.append({'result': {'channelTag': '0', 'final': dict(alternatives, finalIndex=str(index))}})
+        lines.append({'result': {'channelTag': '0', 'finalRefinement': {
+            'finalIndex': str(index),
+            'normalizedText': alternatives
+        }}})
+    return '\n'.join(json.dumps(line, ensure_ascii=False) for line in lines).encode('utf-8')
+
+
+def note_markdown(minutes):
+    phrases = synthetic_transcript(minutes).split('\n')
+    lines = ['# Конспект лекции', '']
+    for section in range(max(1, minutes // NOTE_MINUTES_PER_SECTION)):
+        lines.append(f'## Раздел {section + 1}. Основные идеи')
+        lines.extend(f'- {phrase}' for phrase in phrases[section * 6:section * 6 + 4])
+        lines.append('')
+        lines.append(f'**Ключевые термины:** {phrases[section * 6 + 4]}')
+        lines.append('')
+        lines.append(f'> {phrases[section * 6 + 5]}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def task_rows(count):
+    # Строки YDB в том виде, в каком их отдает execute_query: атрибуты по именам колонок
+    rows = []
+    created_at = 1767225600 * 1000000
+    for index in range(count):
+        done = index % 4 != 0
+        rows.append(types.SimpleNamespace(
+            taskId=f'00000000-0000-4000-8000-{index:012d}',
+            lectureTitle=f'Лекция {index}: пределы и непрерывность',
+            videoUrl=f'https://disk.yandex.ru/i/lecture-{index}',
+            status='Успешно завершено' if done else 'В обработке',
+            stage='note-generator' if done else 'speech-recognizer',
+            createdAt=created_at + index * 60000000,
+            updatedAt=created_at + index * 60000000 + 1800000000,
+            pdfUrl=f'https://notes.storage.yandexcloud.net/notes/{index}.pdf' if done else None,
+            errorMessage=None,
+            route='extract',
+            probe=json.dumps({'duration': 5400.0, 'audio_codec': 'aac', 'size': 734003200})
+        ))
+    return rows
+
+
+def case_extract_full_text(minutes):
+    module = load_function('speech-recognizer-checker')
+    dump = recognition_dump(minutes)
+    return len(dump), lambda: module.extract_full_text(dump)
+
+
+def case_compact_transcript(minutes):
+    module = load_function('note-generator')
+    text = synthetic_transcript(minutes)
+    return len(text.encode('utf-8')), lambda: module.compact_transcript(text)
+
+
+def case_convert_markdown_to_pdf(minutes):
+    module = load_function('note-generator')
+    markdown = note_markdown(minutes)
+    # Создание движка рендеринга с импортом PyMuPDF — часть холодного старта, а не рендеринга
+    module.get_pdf_renderer()
+    return len(markdown.encode('utf-8')), lambda: module.convert_markdown_to_pdf(markdown)
+
+
+def case_serialize_tasks(count):
+    # Цикл по строкам в get_all_tasks: даты и подписанные ссылки; кэш ссылок пуст, как на новом инстансе
+    module = load_function('tasks-getter')
+    rows = task_rows(count)
+    module.get_s3_client()
+
+    def run():
+        module._presigned_urls.clear()
+        return [module.serialize_task(row) for row in rows]
+    return count, run
+
+
+def case_json_response(count):
+    module = load_function('tasks-getter')
+    module.get_s3_client()
+    tasks = [module.serialize_task(row) for row in task_rows(count)]
+    return count, lambda: module.json_response(200, tasks)
+
+
+CASES = {
+    'extract_full_text': (case_extract_full_text, LECTURE_MINUTES, 'мин'),
+    'compact_transcript': (case_compact_transcript, LECTURE_MINUTES, 'мин'),
+    'convert_markdown_to_pdf': (case_convert_markdown_to_pdf, LECTURE_MINUTES, 'мин'),
+    'serialize_tasks': (case_serialize_tasks, TASK_COUNTS, 'задач'),
+    'json_response': (case_json_response, TASK_COUNTS, 'задач'),
+}
+
+
+def run_case(name, size, repeats):
+    setup, _, unit = CASES[name]
+    input_size, func = setup(size)
+
+    # Первый вызов — отдельно: по нему считается прирост пикового RSS
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started_at = time.perf_counter()
+    func()
+    timings = [time.perf_counter() - started_at]
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for _ in range(repeats - 1 if timings[0] < SLOW_CASE_SECONDS else 0):
+        started_at = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started_at)
+
+    # Память — отдельным прогоном: tracemalloc сам замедляет вызов
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    del result
+
+    return {
+        'case': name,
+        'size': size,
+        'unit': unit,
+        'input_bytes': input_size if unit == 'мин' else None,
+        'ms_min': round(min(timings) * 1000, 2),
+        'ms_median': round(statistics.median(timings) * 1000, 2),
+        'python_peak_kb': round(peak / 1024, 1),
+        'python_retained_kb': round(retained / 1024, 1),
+        'retained_blocks': retained_blocks,
+        'rss_delta_mb': round((rss_after - rss_before) / 1024, 1)
+    }
+
+
+def run_in_subprocess(name, size, repeats):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-case', name, str(size), '--repeats', str(repeats)],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'{name}[{size}] failed\n{result.stderr}')
+    # Обработчики печатают логи в stdout; результат замера — последняя строка
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=ROOT)
+    return result.stdout.strip() or None
+
+
+def print_results(results, baseline):
+    previous = {(item['case'], item['size']): item for item in (baseline or {}).get('results', [])}
+    header = f"{'случай':<25} {'размер':>12} {'мс мин':>10} {'мс мед':>10} {'пик КБ':>10} {'остаток КБ':>11} {'RSS МБ':>8}"
+    if previous:
+        header += f" {'время':>8} {'пик':>8}"
+    print(header)
+    for item in results:
+        line = (
+            f"{item['case']:<25} {str(item['size']) + ' ' + item['unit']:>12} {item['ms_min']:>10} "
+            f"{item['ms_median']:>10} {item['python_peak_kb']:>10} {item['python_retained_kb']:>11} "
+            f"{item['rss_delta_mb']:>8}"
+        )
+        before = previous.get((item['case'], item['size']))
+        if before:
+            line += f" {ratio(item['ms_min'], before['ms_min']):>8} {ratio(item['python_peak_kb'], before['python_peak_kb']):>8}"
+        print(line)
+
+
+def ratio(current, before):
+    # Во сколько раз изменилось значение относительно сохраненного прогона: <1 — стало лучше
+    return f'x{current / before:.2f}' if before else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=sorted(CASES), help='запустить только эти случаи')
+    parser.add_argument('--sizes', type=int, nargs='+', help='размеры вместо стандартных')
+    parser.add_argument('--repeats', type=int, default=3, help='повторов замера времени')
+    parser.add_argument('--output', help='куда сохранить результат в JSON')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--run-case', nargs=2, metavar=('CASE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        name, size = args.run_case
+        print(json.dumps(run_case(name, int(size), args.repeats), ensure_ascii=False))
+        return
+
+    results = []
+    for name in args.only or CASES:
+        for size in args.sizes or CASES[name][1]:
+            results.append(run_in_subprocess(name, size, args.repeats))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'created_at': round(time.time()),
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Проверка общих классов функций.
+
+Каждая функция собирается в отдельный архив, поэтому Tracer и StatusWriter скопированы в main.py
+всех функций, которым они нужны. Скрипт сравнивает копии с эталоном и завершается с ошибкой,
+печатая разницу, если какая-то копия разошлась. Исправление вносится в эталон и копируется
+во все функции.
+"""
+import argparse
+import ast
+import difflib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(ROOT, 'functions')
+
+# Класс и функция, в которой лежит его эталонная копия
+SHARED_CLASSES = {
+    'Tracer': 'note-generator',
+    'StatusWriter': 'note-generator'
+}
+
+
+def class_source(name, class_name):
+    path = os.path.join(FUNCTIONS_DIR, name, 'main.py')
+    with open(path) as f:
+        source = f.read()
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ClassDef) and node.name == class_name:
+            return ast.get_source_segment(source, node)
+    return None
+
+
+def check_class(class_name, reference, names):
+    expected = class_source(reference, class_name)
+    mismatches = []
+    for name in names:
+        actual = class_source(name, class_name)
+        if actual is None or actual == expected:
+            continue
+        diff = difflib.unified_diff(
+            expected.splitlines(), actual.splitlines(),
+            f'{reference}/main.py', f'{name}/main.py', lineterm=''
+        )
+        mismatches.append((name, '\n'.join(diff)))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that shared classes are identical in every function')
+    parser.add_argument('functions', nargs='*', help='function directories (default: all)')
+    args = parser.parse_args()
+
+    names = args.functions or sorted(
+        name for name in os.listdir(FUNCTIONS_DIR)
+        if os.path.isfile(os.path.join(FUNCTIONS_DIR, name, 'main.py'))
+    )
+
+    failed = False
+    for class_name, reference in SHARED_CLASSES.items():
+        copies = [name for name in names if class_source(name, class_name) is not None]
+        mismatches = check_class(class_name, reference, copies)
+        print(f'{class_name:<14} {len(copies)} copies, {len(mismatches)} differ from {reference}')
+        for name, diff in mismatches:
+            print(f'MISMATCH: {class_name} in {name}\n{diff}', file=sys.stderr)
+        failed = failed or bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
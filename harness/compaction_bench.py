@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""Замер сжатия расшифровки в note-generator.
+
+Генерирует детерминированные синтетические расшифровки разной длины с междометиями,
+словами-паразитами, запинками и повторами фраз, прогоняет через compact_transcript
+и печатает долю удаленных токенов и скорость в мс на МБ текста. Перед замером проверяет,
+что сжатие не теряет смысл: единицы измерения, отрицания и числа в поправках сохраняются.
+
+    python harness/compaction_bench.py --minutes 10 60 240 --output compaction.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOTE_GENERATOR = os.path.join(ROOT, 'functions', 'note-generator', 'main.py')
+
+# Темп речи лектора и состав синтетической расшифровки
+UTTERANCES_PER_MINUTE = 12
+TERMS = [
+    'функция', 'производная', 'предел', 'интеграл', 'последовательность', 'ряд', 'матрица',
+    'вектор', 'пространство', 'оператор', 'множество', 'отображение', 'точка', 'окрестность'
+]
+VERBS = ['называется', 'сходится', 'определяется', 'ограничена', 'непрерывна', 'равна', 'задается']
+FILLERS = ['ну', 'вот', 'э-э', 'ээ', 'так сказать', 'как бы', 'значит', 'ммм', 'это самое']
+SKELETONS = [
+    '{t1} {v} через {t2}, если {t3} {v2} в каждой точке',
+    'рассмотрим {t1} и заметим, что {t2} {v}',
+    'это свойство понадобится нам, когда мы будем изучать {t1}',
+    '{t1} {v} тогда и только тогда, когда {t2} {v2}',
+    'запишите определение: {t1} {v} на отрезке от 0 до 1',
+]
+
+# Фразы, которые сжатие обязано сохранить: (расшифровка, строки, которые должны остаться)
+PRESERVED_CASES = [
+    ('Диаметр трубы 5 мм, толщина стенки 2 мм.', ['Диаметр трубы 5 мм, толщина стенки 2 мм.']),
+    ('Ммм, зазор 3 мм.', ['зазор 3 мм.']),
+    (
+        'это утверждение верно для всех графов\nэто утверждение не верно для всех графов',
+        ['это утверждение верно для всех графов', 'это утверждение не верно для всех графов']
+    ),
+    (
+        'это утверждение не верно для всех графов\nэто утверждение верно для всех графов',
+        ['это утверждение не верно для всех графов', 'это утверждение верно для всех графов']
+    ),
+    (
+        'предел последовательности равен 5 при n\nпредел последовательности равен 6 при n',
+        ['предел последовательности равен 5 при n', 'предел последовательности равен 6 при n']
+    ),
+    # Определение, повторенное через много фраз, — не запинка, а повторение материала
+    (
+        '\n'.join(['граф называется связным если любые две вершины соединены путем']
+                  + [f'пример номер {index} разобран на доске' for index in range(10)]
+                  + ['граф называется связным если любые две вершины соединены путем']),
+        ['граф называется связным если любые две вершины соединены путем']
+        + [f'пример номер {index} разобран на доске' for index in range(10)]
+        + ['граф называется связным если любые две вершины соединены путем']
+    ),
+]
+
+
+def load_note_generator():
+    spec = importlib.util.spec_from_file_location('bench_note_generator', NOTE_GENERATOR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_transcript(minutes, seed=0):
+    # Реплика на строку, как в выводе speech-recognizer-checker; часть реплик с запинками,
+    # часть — почти дословные повторы одной из недавних
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(minutes * UTTERANCES_PER_MINUTE):
+        if lines and rng.random() < 0.15:
+            words = rng.choice(lines[-5:]).split()
+            if len(words) > 5 and rng.random() < 0.5:
+                del words[rng.randrange(len(words))]
+            lines.append(' '.join(words))
+            continue
+
+        words = rng.choice(SKELETONS).format(
+            t1=rng.choice(TERMS), t2=rng.choice(TERMS), t3=rng.choice(TERMS),
+            v=rng.choice(VERBS), v2=rng.choice(VERBS)
+        ).split()
+        if rng.random() < 0.4:
+            words.insert(0, rng.choice(FILLERS) + ',')
+        if rng.random() < 0.3:
+            position = rng.randrange(1, len(words))
+            words.insert(position, f', {rng.choice(FILLERS)},')
+        if rng.random() < 0.2:
+            position = rng.randrange(len(words))
+            words.insert(position, words[position].strip(','))
+        line = ' '.join(words).replace(' ,', ',')
+        lines.append(line[0].upper() + line[1:] + '.')
+    return '\n'.join(lines)
+
+
+def check_preserved(module):
+    for text, expected in PRESERVED_CASES:
+        compacted = module.compact_transcript(text)[0]
+        if compacted.split('\n') != expected:
+            raise RuntimeError(f'compact_transcript lost meaning: {text!r} -> {compacted!r}')
+
+
+def measure(module, minutes, repeats):
+    text = synthetic_transcript(minutes)
+    size_mb = len(text.encode('utf-8')) / (1024 * 1024)
+    best = None
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        compacted, stats = module.compact_transcript(text)
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        best = elapsed_ms if best is None else min(best, elapsed_ms)
+
+    # Сжатие обязано быть детерминированным
+    if module.compact_transcript(text)[0] != compacted:
+        raise RuntimeError(f'{minutes} min: compact_transcript is not deterministic')
+
+    return {
+        'minutes': minutes,
+        'size_mb': round(size_mb, 3),
+        'tokens_before': stats['tokens_before'],
+        'tokens_after': stats['tokens_after'],
+        'tokens_removed_percent': stats['tokens_removed_percent'],
+        'ms': round(best, 1),
+        'ms_per_mb': round(best / size_mb, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=int, nargs='+', default=[10, 60, 240], help='длительность лекций')
+    parser.add_argument('--repeats', type=int, default=5, help='повторов замера, берется лучший')
+    parser.add_argument('--output', help='куда сохранить результат в JSON')
+    args = parser.parse_args()
+
+    module = load_note_generator()
+    check_preserved(module)
+    results = [measure(module, minutes, args.repeats) for minutes in args.minutes]
+
+    print(f"{'мин':>5} {'МБ':>7} {'токенов до':>11} {'после':>8} {'удалено %':>10} {'мс':>8} {'мс/МБ':>8}")
+    for result in results:
+        print(
+            f"{result['minutes']:>5} {result['size_mb']:>7} {result['tokens_before']:>11} "
+            f"{result['tokens_after']:>8} {result['tokens_removed_percent']:>10} "
+            f"{result['ms']:>8} {result['ms_per_mb']:>8}"
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'compaction': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+import heapq
+import io
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import defaultdict
+
+# Первичные ключи таблиц, как в terraform/main.tf
+PRIMARY_KEYS = {
+    'tasks': ('taskId',),
+    'task_events': ('taskId', 'createdAt', 'stage', 'event'),
+    'submitter_slots': ('submitter', 'stage', 'taskId'),
+    'api_budget': ('api', 'leaseId'),
+}
+
+
+class Row(dict):
+    """Строка результата с доступом к колонкам через атрибуты, как в ydb"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ResultSet:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeYdb:
+    """Хранилище таблиц в памяти с разбором того подмножества YQL, которое используют функции"""
+
+    def __init__(self):
+        self.tables = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def execute(self, query, parameters=None):
+        parameters = parameters or {}
+        results = []
+        with self.lock:
+            self.queries += 1
+            for statement in split_statements(query):
+                result = self.execute_statement(statement, parameters)
+                if result is not None:
+                    results.append(result)
+        return results
+
+    def execute_statement(self, statement, params):
+        match = re.match(r'UPSERT INTO (\w+) \((.+?)\) VALUES \((.+)\)$', statement)
+        if match:
+            table, columns, values = match.groups()
+            row = dict(zip(split_list(columns), [evaluate(v, params, {}) for v in split_list(values)]))
+            self.upsert(table, row)
+            return None
+
+        match = re.match(r'UPSERT INTO (\w+) \((.+?)\) SELECT (.+) FROM AS_TABLE\((\$\w+)\)$', statement)
+        if match:
+            table, columns, select, source = match.groups()
+            expressions = [parse_select_item(item) for item in split_list(select)]
+            for item in params[source]:
+                row = {name: evaluate(expression, params, item) for expression, name in expressions}
+                self.upsert(table, {column: row[column] for column in split_list(columns)})
+            return None
+
+        match = re.match(r'UPDATE (\w+) SET (.+?) WHERE (.+)$', statement)
+        if match:
+            table, assignments, condition = match.groups()
+            for row in self.tables[table].values():
+                if matches(condition, params, row):
+                    updates = {}
+                    for assignment in split_list(assignments):
+                        column, expression = assignment.split('=', 1)
+                        updates[column.strip()] = evaluate(expression.strip(), params, row)
+                    row.update(updates)
+            return None
+
+        match = re.match(r'DELETE FROM (\w+) WHERE (.+)$', statement)
+        if match:
+            table, condition = match.groups()
+            for key, row in list(self.tables[table].items()):
+                if matches(condition, params, row):
+                    del self.tables[table][key]
+            return None
+
+        match = re.match(
+            r'SELECT (.+?) FROM (\w+)(?: VIEW \w+)?(?: WHERE (.+?))?(?: ORDER BY (\w+)( DESC)?)?(?: LIMIT (\d+))?$',
+            statement
+        )
+        if match:
+            select, table, condition, order_by, descending, limit = match.groups()
+            rows = [row for row in self.tables[table].values() if matches(condition, params, row)]
+            if order_by:
+                rows.sort(key=lambda row: (row.get(order_by) is None, row.get(order_by)), reverse=bool(descending))
+            if limit:
+                rows = rows[:int(limit)]
+            expressions = [parse_select_item(item) for item in split_list(select)]
+            return ResultSet([
+                Row({name: evaluate(expression, params, row) for expression, name in expressions})
+                for row in rows
+            ])
+
+        raise NotImplementedError(f'FakeYdb does not support statement: {statement}')
+
+    def upsert(self, table, row):
+        key = tuple(row[column] for column in PRIMARY_KEYS[table])
+        self.tables[table].setdefault(key, {}).update(row)
+
+
+def split_statements(query):
+    statements = []
+    for statement in query.split(';'):
+        statement = ' '.join(statement.split())
+        if statement and not statement.startswith('DECLARE'):
+            statements.append(statement)
+    return statements
+
+
+def split_list(text):
+    # Разбиение по запятым верхнего уровня, без учета запятых внутри скобок и строк
+    items, depth, quote, current = [], 0, None, ''
+    for char in text:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in '"\'':
+            quote = char
+        elif char in '(<':
+            depth += 1
+        elif char in ')>':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(current.strip())
+            current = ''
+            continue
+        current += char
+    if current.strip():
+        items.append(current.strip())
+    return items
+
+
+def parse_select_item(item):
+    match = re.match(r'(.+) AS (\w+)$', item)
+    if match:
+        return match.group(1).strip(), match.group(2)
+    return item, item
+
+
+def evaluate(expression, params, row):
+    expression = expression.strip()
+    if expression.startswith('$'):
+        return params.get(expression)
+    if expression[0] in '"\'' and expression[-1] == expression[0]:
+        return expression[1:-1]
+    if expression == 'NULL':
+        return None
+    if expression == 'CurrentUtcTimestamp()':
+        return int(time.time() * 1000000)
+    if re.fullmatch(r'-?\d+', expression):
+        return int(expression)
+    match = re.fullmatch(r'COALESCE\((.+)\)', expression)
+    if match:
+        for argument in split_list(match.group(1)):
+            value = evaluate(argument, params, row)
+            if value is not None:
+                return value
+        return None
+    return row.get(expression)
+
+
+def matches(condition, params, row):
+    if not condition:
+        return True
+    for clause in re.split(r' AND ', condition):
+        match = re.fullmatch(r'(\S+) IN (\$\w+)', clause)
+        if match:
+            if evaluate(match.group(1), params, row) not in params[match.group(2)]:
+                return False
+            continue
+        match = re.fullmatch(r'(\S+) IS (NOT )?NULL', clause)
+        if match:
+            is_null = evaluate(match.group(1), params, row) is None
+            if is_null == bool(match.group(2)):
+                return False
+            continue
+        match = re.fullmatch(r'(\S+) > (\S+)', clause)
+        if match:
+            value = evaluate(match.group(1), params, row)
+            if value is None or value <= evaluate(match.group(2), params, row):
+                return False
+            continue
+        left, right = clause.split('=', 1)
+        if evaluate(left, params, row) != evaluate(right, params, row):
+            return False
+    return True
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, data, **metadata):
+        with self.lock:
+            self.objects[(bucket, key)] = (data, metadata)
+            self.bytes_in += len(data)
+
+    def get(self, bucket, key):
+        with self.lock:
+            data, _ = self.objects[(bucket, key)]
+            self.bytes_out += len(data)
+            return data
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, 'wb') as f:
+            f.write(self.get(Bucket, Key))
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.put(Bucket, Key, f.read(), **(ExtraArgs or {}))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.put(Bucket, Key, Fileobj.read(), **(ExtraArgs or {}))
+
+    def get_object(self, Bucket, Key, **kwargs):
+        data = self.get(Bucket, Key)
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        self.put(Bucket, Key, data, **kwargs)
+        return {'ResponseMetadata': {'RetryAttempts': 0}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            data, metadata = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'ContentType': metadata.get('ContentType')}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        url = f"http://fake-s3/{Params['Bucket']}/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+        if ClientMethod == 'upload_part':
+            url += f"&uploadId={Params['UploadId']}&partNumber={Params['PartNumber']}"
+        return url
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, **kwargs):
+        upload_id = str(uuid.uuid4())
+        with self.lock:
+            self.uploads[upload_id] = {'bucket': Bucket, 'key': Key, 'content_type': ContentType, 'parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        # Так часть загружает браузер по подписанной ссылке
+        data = Body.read() if hasattr(Body, 'read') else Body
+        etag = f'"{uuid.uuid4().hex}"'
+        with self.lock:
+            self.uploads[UploadId]['parts'][PartNumber] = (etag, data)
+            self.bytes_in += len(data)
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+            if (upload['bucket'], upload['key']) != (Bucket, Key):
+                raise ValueError('NoSuchUpload')
+            chunks = []
+            for part in MultipartUpload['Parts']:
+                etag, data = upload['parts'][part['PartNumber']]
+                if etag != part['ETag']:
+                    raise ValueError('InvalidPart')
+                chunks.append(data)
+            self.objects[(Bucket, Key)] = (b''.join(chunks), {'ContentType': upload['content_type']})
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+
+class FakeSqs:
+    def __init__(self, delay_scale=1.0):
+        self.delay_scale = delay_scale
+        self.messages = []
+        self.counter = itertools.count()
+        self.sent = 0
+        self.sent_task_ids = []
+        self.lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        visible_at = time.monotonic() + DelaySeconds * self.delay_scale
+        with self.lock:
+            heapq.heappush(self.messages, (visible_at, next(self.counter), QueueUrl, MessageBody))
+            self.sent += 1
+            self.sent_task_ids.append(json.loads(MessageBody).get('task_id'))
+        return {'MessageId': str(uuid.uuid4()), 'ResponseMetadata': {'RetryAttempts': 0}}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        successful = []
+        for entry in Entries:
+            response = self.send_message(QueueUrl, entry['MessageBody'], entry.get('DelaySeconds', 0))
+            successful.append({'Id': entry['Id'], 'MessageId': response['MessageId']})
+        return {'Successful': successful, 'Failed': []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=(), **kwargs):
+        # Видимые сообщения очереди; отложенные с задержкой не считаются, как в YMQ
+        with self.lock:
+            now = time.monotonic()
+            visible = sum(1 for item in self.messages if item[2] == QueueUrl and item[0] <= now)
+        return {'Attributes': {'ApproximateNumberOfMessages': str(visible)}}
+
+    def receive(self):
+        with self.lock:
+            if self.messages and self.messages[0][0] <= time.monotonic():
+                _, _, queue_url, body = heapq.heappop(self.messages)
+                return queue_url, body
+        return None
+
+    def receive_more(self, queue_url, limit):
+        # Уже видимые сообщения той же очереди — так триггер собирает пачку
+        bodies, rest = [], []
+        with self.lock:
+            now = time.monotonic()
+            for item in sorted(self.messages):
+                if len(bodies) < limit and item[0] <= now and item[2] == queue_url:
+                    bodies.append(item[3])
+                else:
+                    rest.append(item)
+            self.messages = rest
+        return bodies
+
+    def next_visible_in(self):
+        with self.lock:
+            if not self.messages:
+                return None
+            return max(self.messages[0][0] - time.monotonic(), 0)
+
+
+class FakeConfig:
+    def __init__(self, **kwargs):
+        self.options = kwargs
+
+
+class FakeDriver:
+    def __init__(self, driver_config):
+        self.driver_config = driver_config
+
+    def wait(self, timeout=None, fail_fast=False):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeTransaction:
+    def __init__(self, database):
+        self.database = database
+
+    def begin(self):
+        return self
+
+    def rollback(self):
+        pass
+
+    def execute(self, query, parameters=None, commit_tx=False, settings=None):
+        return self.database.execute(query, parameters)
+
+
+class FakeSession:
+    def __init__(self, database):
+        self.database = database
+
+    def create(self):
+        return self
+
+    def prepare(self, query):
+        return query
+
+    def transaction(self, tx_mode=None):
+        return FakeTransaction(self.database)
+
+
+class FakeSessionPool:
+    def __init__(self, driver, size=None, **kwargs):
+        self.database = driver.driver_config['database_store']
+
+    def retry_operation_sync(self, callee, retry_settings=None, *args, **kwargs):
+        return callee(FakeSession(self.database), *args, **kwargs)
+
+    def stop(self, timeout=None):
+        pass
+
+
+def install_fake_cloud(s3, sqs, database=None):
+    """Подменяет boto3/botocore (и ydb, если передана база) на in-process заглушки"""
+    def client(service_name, *args, **kwargs):
+        return {'s3': s3, 'sqs': sqs}[service_name]
+
+    boto3 = types.ModuleType('boto3')
+    boto3.client = client
+    botocore = types.ModuleType('botocore')
+    botocore_config = types.ModuleType('botocore.config')
+    botocore_config.Config = FakeConfig
+    botocore.config = botocore_config
+    sys.modules.update({'boto3': boto3, 'botocore': botocore, 'botocore.config': botocore_config})
+
+    if database is not None:
+        ydb = types.ModuleType('ydb')
+        ydb.DriverConfig = lambda **kwargs: dict(kwargs, database_store=database)
+        ydb.Driver = FakeDriver
+        ydb.SessionPool = FakeSessionPool
+        ydb.SerializableReadWrite = lambda: 'SerializableReadWrite'
+        ydb.OnlineReadOnly = lambda: 'OnlineReadOnly'
+        ydb.credentials_from_env_variables = lambda: None
+        ydb.load_ydb_root_certificate = lambda: None
+        sys.modules['ydb'] = ydb
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Профиль импорта функций при холодном старте.
+
+Для каждой функции запускает отдельный интерпретатор с `-X importtime` и импортирует main.py
+так же, как это делает среда выполнения. Печатает самые дорогие модули и итог по функции,
+а с флагом --check сверяет результат с бюджетом из import_budget.json и завершается с ошибкой,
+если функция стала импортировать тяжелые зависимости на старте или вышла за лимит времени.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(ROOT, 'functions')
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budget.json')
+
+
+def profile_function(name, python, runs):
+    # Берем минимум из нескольких запусков, чтобы сгладить шум файлового кэша
+    best = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [python, '-X', 'importtime', '-c', 'import main'],
+            cwd=os.path.join(FUNCTIONS_DIR, name),
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f'{name}: import main failed\n{result.stderr}')
+
+        modules = parse_importtime(result.stderr)
+        if best is None or modules['main']['cumulative_us'] < best['main']['cumulative_us']:
+            best = modules
+    return best
+
+
+def parse_importtime(stderr):
+    # Формат строк: "import time:      self [us] |  cumulative | imported package"
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, package = line[len('import time:'):].split('|')
+        name = package.strip()
+        modules[name] = {
+            'self_us': int(self_us),
+            'cumulative_us': int(cumulative_us),
+            'depth': (len(package) - len(package.lstrip())) // 2
+        }
+    return modules
+
+
+def summarize(name, modules, top):
+    main = modules['main']
+    # Модули, импортированные самим main.py (первый уровень вложенности под ним)
+    direct = sorted(
+        ((module, stats) for module, stats in modules.items() if stats['depth'] == 1),
+        key=lambda item: item[1]['cumulative_us'],
+        reverse=True
+    )
+    return {
+        'function': name,
+        'total_ms': round(main['cumulative_us'] / 1000, 1),
+        'main_self_ms': round(main['self_us'] / 1000, 1),
+        'modules_loaded': len(modules),
+        'top_modules': [
+            {'module': module, 'cumulative_ms': round(stats['cumulative_us'] / 1000, 2)}
+            for module, stats in direct[:top]
+        ],
+        'loaded': sorted(modules)
+    }
+
+
+def check_budget(report, budget):
+    violations = []
+    forbidden = budget['forbidden_modules']
+    for item in report:
+        limits = budget['functions'].get(item['function'], {})
+        max_ms = limits.get('max_ms', budget['default_max_ms'])
+
+        heavy = sorted(
+            module for module in item['loaded']
+            if module.split('.')[0] in forbidden
+        )
+        if heavy:
+            roots = sorted({module.split('.')[0] for module in heavy})
+            violations.append(f"{item['function']}: imports {', '.join(roots)} at cold start")
+        if item['total_ms'] > max_ms:
+            violations.append(f"{item['function']}: import takes {item['total_ms']} ms, budget {max_ms} ms")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time profile of cloud functions')
+    parser.add_argument('functions', nargs='*', help='function directories (default: all)')
+    parser.add_argument('--python', default=sys.executable, help='interpreter with function dependencies')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--check', action='store_true', help='fail if the import budget is exceeded')
+    parser.add_argument('--output', help='write the JSON report to this path')
+    args = parser.parse_args()
+
+    names = args.functions or sorted(
+        name for name in os.listdir(FUNCTIONS_DIR)
+        if os.path.isfile(os.path.join(FUNCTIONS_DIR, name, 'main.py'))
+    )
+
+    report = [summarize(name, profile_function(name, args.python, args.runs), args.top) for name in names]
+
+    for item in report:
+        print(f"{item['function']:<28} {item['total_ms']:>7} ms  {item['modules_loaded']:>4} modules")
+        for module in item['top_modules']:
+            print(f"    {module['module']:<32} {module['cumulative_ms']:>8} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.check:
+        with open(BUDGET_PATH) as f:
+            budget = json.load(f)
+        violations = check_budget(report, budget)
+        for violation in violations:
+            print(f'BUDGET EXCEEDED: {violation}', file=sys.stderr)
+        return 1 if violations else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""Локальный прогон конвейера без Yandex Cloud.
+
+Все семь обработчиков запускаются в одном процессе: Object Storage, Message Queue и YDB
+заменены заглушками в памяти (или YDB берется из локального контейнера через --ydb-endpoint),
+Яндекс Диск, SpeechKit и YandexGPT — локальным HTTP-сервером с настраиваемыми задержками.
+Драйвер отправляет N синтетических лекций через task-receiver и разносит сообщения по
+очередям до note-generator, после чего печатает p50/p95 по этапам, пропускную способность
+и пиковый RSS.
+
+    python harness/run.py --lectures 20 --video-mb 8 --speechkit-latency 2 --output report.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import types
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeS3, FakeSqs, FakeYdb, install_fake_cloud
+from servers import FakeServicesConfig, start_fake_services
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(ROOT, 'functions')
+
+# Все задачи прогона отправляются с одного адреса, как один пользователь
+SUBMITTER_IP = '10.0.0.1'
+
+# Очереди и память функций повторяют terraform/main.tf
+QUEUES = {
+    'video-downloader-queue': 'video-downloader',
+    'audio-extractor-queue': 'audio-extractor',
+    'audio-extractor-slow-queue': 'audio-extractor-slow',
+    'speech-recognizer-queue': 'speech-recognizer',
+    'speech-recognizer-checker-queue': 'speech-recognizer-checker',
+    'note-generator-queue': 'note-generator',
+}
+
+FUNCTIONS = {
+    'task-receiver': {'memory': 128, 'env': {
+        'QUEUE_URL': 'video-downloader-queue',
+        'AUDIO_QUEUE_URL': 'audio-extractor-queue',
+        'AUDIO_SLOW_QUEUE_URL': 'audio-extractor-slow-queue'
+    }},
+    'video-downloader': {'memory': 2048, 'env': {
+        'QUEUE_URL': 'audio-extractor-queue',
+        'SLOW_QUEUE_URL': 'audio-extractor-slow-queue',
+        'SPEECH_QUEUE_URL': 'speech-recognizer-queue',
+        'SELF_QUEUE_URL': 'video-downloader-queue'
+    }},
+    'audio-extractor': {'memory': 2048, 'env': {
+        'QUEUE_URL': 'speech-recognizer-queue',
+        'SELF_QUEUE_URL': 'audio-extractor-queue',
+        'LANE': 'fast'
+    }},
+    # Медленная полоса — тот же код в отдельном экземпляре функции
+    'audio-extractor-slow': {'memory': 2048, 'source': 'audio-extractor', 'env': {
+        'QUEUE_URL': 'speech-recognizer-queue',
+        'SELF_QUEUE_URL': 'audio-extractor-slow-queue',
+        'LANE': 'slow'
+    }},
+    'speech-recognizer': {'memory': 1024, 'batch_size': 10, 'env': {
+        'QUEUE_URL': 'speech-recognizer-checker-queue',
+        'SELF_QUEUE_URL': 'speech-recognizer-queue'
+    }},
+    'speech-recognizer-checker': {'memory': 1024, 'batch_size': 10, 'env': {
+        'QUEUE_URL': 'note-generator-queue',
+        'SELF_QUEUE_URL': 'speech-recognizer-checker-queue'
+    }},
+    'note-generator': {'memory': 512, 'batch_size': 4, 'env': {
+        'QUEUE_URL': 'speech-recognizer-checker-queue',
+        'SELF_QUEUE_URL': 'note-generator-queue'
+    }},
+    'tasks-getter': {'memory': 512, 'env': {}},
+}
+
+# DDL для локального контейнера YDB, повторяет yandex_ydb_table из terraform/main.tf
+YDB_TABLES = [
+    """
+    CREATE TABLE tasks (
+        taskId Utf8 NOT NULL,
+        lectureTitle Utf8 NOT NULL,
+        videoUrl Utf8 NOT NULL,
+        status Utf8 NOT NULL,
+        stage Utf8,
+        createdAt Timestamp NOT NULL,
+        updatedAt Timestamp,
+        pdfUrl Utf8,
+        errorMessage Utf8,
+        route Utf8,
+        probe Json,
+        submitter Utf8,
+        PRIMARY KEY (taskId),
+        INDEX idx_updated_at GLOBAL ON (updatedAt)
+    )
+    """,
+    """
+    CREATE TABLE task_events (
+        taskId Utf8 NOT NULL,
+        createdAt Timestamp NOT NULL,
+        stage Utf8 NOT NULL,
+        event Utf8 NOT NULL,
+        message Utf8,
+        durationMs Uint64,
+        bytes Uint64,
+        PRIMARY KEY (taskId, createdAt, stage, event)
+    )
+    """,
+    """
+    CREATE TABLE submitter_slots (
+        submitter Utf8 NOT NULL,
+        stage Utf8 NOT NULL,
+        taskId Utf8 NOT NULL,
+        acquiredAt Timestamp NOT NULL,
+        PRIMARY KEY (submitter, stage, taskId)
+    )
+    """,
+    """
+    CREATE TABLE api_budget (
+        api Utf8 NOT NULL,
+        leaseId Utf8 NOT NULL,
+        kind Utf8 NOT NULL,
+        expiresAt Timestamp NOT NULL,
+        PRIMARY KEY (api, leaseId)
+    )
+    """,
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--lectures', type=int, default=10, help='число синтетических лекций')
+    parser.add_argument('--video-mb', type=float, default=4, help='размер каждого видео, МБ')
+    parser.add_argument('--utterances', type=int, default=200, help='число фраз в расшифровке')
+    parser.add_argument('--disk-latency', type=float, default=0.05, help='задержка API Яндекс Диска, с')
+    parser.add_argument('--speechkit-latency', type=float, default=1.0, help='время распознавания, с')
+    parser.add_argument('--gpt-latency', type=float, default=0.5, help='задержка YandexGPT, с')
+    parser.add_argument('--speechkit-max-operations', type=int, default=10,
+                        help='общий лимит одновременных операций распознавания')
+    parser.add_argument('--gpt-max-operations', type=int, default=10,
+                        help='общий лимит одновременных запросов к YandexGPT')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='доля запросов к SpeechKit и YandexGPT, на которые заглушка отвечает 429')
+    parser.add_argument('--direct-upload', action='store_true',
+                        help='загружать видео напрямую в Storage через /api/uploads вместо ссылки на Яндекс Диск')
+    parser.add_argument('--bulk', choices=['list', 'folder'],
+                        help='отправить все лекции одним запросом /api/tasks/batch: списком или ссылкой на папку')
+    parser.add_argument('--fused', action='store_true',
+                        help='video-downloader извлекает аудио сам, минуя audio-extractor')
+    parser.add_argument('--store-video', action='store_true',
+                        help='в режиме --fused сохранять исходное видео в Storage')
+    parser.add_argument('--delay-scale', type=float, default=0.1,
+                        help='множитель DelaySeconds очередей, чтобы не ждать реальные 2**attempt секунд')
+    parser.add_argument('--ydb-endpoint', help='локальный YDB, например grpc://localhost:2136')
+    parser.add_argument('--ydb-database', default='/local')
+    parser.add_argument('--output', help='путь для JSON-отчета')
+    return parser.parse_args()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.5) * 1000, 1) if values else None,
+        'p95_ms': round(percentile(values, 0.95) * 1000, 1) if values else None,
+        'max_ms': round(max(values) * 1000, 1) if values else None,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах; дочерние процессы — это ffmpeg
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'harness': round(own / 1024, 1), 'children': round(children / 1024, 1)}
+
+
+class Pipeline:
+    def __init__(self, args, base_env, s3, sqs):
+        self.args = args
+        self.base_env = base_env
+        self.s3 = s3
+        self.sqs = sqs
+        self.modules = {}
+        self.durations = {name: [] for name in FUNCTIONS}
+
+    @contextmanager
+    def function_env(self, name):
+        previous = dict(os.environ)
+        os.environ.update(self.base_env)
+        os.environ.update(FUNCTIONS[name]['env'])
+        try:
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(previous)
+
+    def load(self, name):
+        if name not in self.modules:
+            path = os.path.join(FUNCTIONS_DIR, FUNCTIONS[name].get('source', name), 'main.py')
+            spec = importlib.util.spec_from_file_location(f"harness_{name.replace('-', '_')}", path)
+            module = importlib.util.module_from_spec(spec)
+            with self.function_env(name):
+                spec.loader.exec_module(module)
+            self.modules[name] = module
+        return self.modules[name]
+
+    def invoke(self, name, event):
+        module = self.load(name)
+        context = types.SimpleNamespace(function_name=name, memory_limit_in_mb=FUNCTIONS[name]['memory'])
+        with self.function_env(name):
+            started_at = time.perf_counter()
+            result = module.handler(event, context)
+            self.durations[name].append(time.perf_counter() - started_at)
+        return result
+
+    def submit(self, index):
+        if self.args.direct_upload:
+            return self.upload(index)
+        body = {'lectureTitle': f'Лекция {index + 1}', 'videoUrl': f'https://disk.yandex.ru/i/lecture-{index + 1}'}
+        return self.invoke('task-receiver', {'body': json.dumps(body, ensure_ascii=False),
+                                             'requestContext': {'identity': {'sourceIp': SUBMITTER_IP}}})
+
+    def submit_bulk(self):
+        if self.args.bulk == 'folder':
+            body = {'folderUrl': f'https://disk.yandex.ru/d/course-{self.args.lectures}', 'lectureTitle': 'Курс'}
+        else:
+            body = {'lectures': [
+                {'lectureTitle': f'Лекция {index + 1}', 'videoUrl': f'https://disk.yandex.ru/i/lecture-{index + 1}'}
+                for index in range(self.args.lectures)
+            ]}
+        return self.invoke('task-receiver', {'path': '/api/tasks/batch', 'body': json.dumps(body, ensure_ascii=False),
+                                             'requestContext': {'identity': {'sourceIp': SUBMITTER_IP}}})
+
+    def upload(self, index):
+        # Повторяет браузер: создать загрузку, залить части по подписанным ссылкам, завершить
+        size = int(self.args.video_mb * 1024 * 1024)
+        body = {'lectureTitle': f'Лекция {index + 1}', 'fileName': f'lecture-{index + 1}.mp4',
+                'fileSize': size, 'contentType': 'video/mp4'}
+        response = self.invoke('task-receiver', {'path': '/api/uploads', 'body': json.dumps(body, ensure_ascii=False)})
+        upload = json.loads(response['body'])
+
+        chunk = bytes(range(256)) * (upload['partSize'] // 256)
+        parts = []
+        for part in upload['parts']:
+            query = parse_qs(urlparse(part['url']).query)
+            bucket, key = urlparse(part['url']).path.lstrip('/').split('/', 1)
+            part_bytes = min(upload['partSize'], size - (part['partNumber'] - 1) * upload['partSize'])
+            result = self.s3.upload_part(Bucket=bucket, Key=key, UploadId=query['uploadId'][0],
+                                         PartNumber=int(query['partNumber'][0]), Body=chunk[:part_bytes])
+            parts.append({'partNumber': part['partNumber'], 'etag': result['ETag']})
+
+        complete = {'uploadId': upload['uploadId'], 'parts': parts}
+        return self.invoke('task-receiver', {
+            'path': '/api/uploads/{taskId}/complete',
+            'pathParams': {'taskId': upload['taskId']},
+            'body': json.dumps(complete)
+        })
+
+    def get_task(self, task_id):
+        response = self.invoke('tasks-getter', {'pathParams': {'taskId': task_id}, 'path': '/api/tasks/{taskId}'})
+        return json.loads(response['body'])
+
+
+def run(args):
+    video_bytes = int(args.video_mb * 1024 * 1024)
+    services_config = FakeServicesConfig(
+        video_bytes=video_bytes,
+        disk_latency=args.disk_latency,
+        speechkit_latency=args.speechkit_latency,
+        gpt_latency=args.gpt_latency,
+        utterances=args.utterances,
+        throttle_rate=args.throttle_rate,
+    )
+    server, services_url = start_fake_services(services_config)
+
+    # Отдельный /tmp прогона: функции считают занятое место по всему каталогу временных файлов
+    tempfile.tempdir = tempfile.mkdtemp(prefix='harness-tmp-')
+
+    s3 = FakeS3()
+    sqs = FakeSqs(delay_scale=args.delay_scale)
+    database = None if args.ydb_endpoint else FakeYdb()
+    install_fake_cloud(s3, sqs, database)
+
+    base_env = {
+        'AWS_ACCESS_KEY_ID': 'harness',
+        'AWS_SECRET_ACCESS_KEY': 'harness',
+        'STORAGE_BUCKET': 'harness-bucket',
+        'STORAGE_ENDPOINT': 'http://fake-s3',
+        'QUEUE_ENDPOINT': 'http://fake-sqs',
+        'YDB_ENDPOINT': args.ydb_endpoint or 'grpc://fake-ydb',
+        'YDB_DATABASE': args.ydb_database,
+        'YDB_ANONYMOUS_CREDENTIALS': '1',
+        'FOLDER_ID': 'harness-folder',
+        'API_KEY': 'harness',
+        'SPEECHKIT_API_URL': services_url,
+        'OPERATION_API_URL': services_url,
+        'GPT_API_URL': services_url,
+        'YANDEX_DISK_API_URL': services_url,
+        'FFMPEG_PATH': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_ffmpeg.py'),
+        'SPEECHKIT_MAX_OPERATIONS': str(args.speechkit_max_operations),
+        'GPT_MAX_OPERATIONS': str(args.gpt_max_operations),
+        'FUSED_EXTRACTION': 'true' if args.fused else 'false',
+        'STORE_SOURCE_VIDEO': 'true' if args.store_video else 'false',
+    }
+    if args.ydb_endpoint:
+        create_ydb_tables(args.ydb_endpoint, args.ydb_database)
+
+    pipeline = Pipeline(args, base_env, s3, sqs)
+    started_at = time.perf_counter()
+    if args.bulk:
+        pipeline.submit_bulk()
+    else:
+        for index in range(args.lectures):
+            pipeline.submit(index)
+
+    submitted_at = {}
+    finished_at = {}
+    outcomes = {}
+    deferred = {}
+
+    while True:
+        message = sqs.receive()
+        if message is None:
+            wait = sqs.next_visible_in()
+            if wait is None:
+                break
+            time.sleep(min(wait, 0.5))
+            continue
+
+        queue_url, body = message
+        name = QUEUES[queue_url]
+        bodies = [body] + sqs.receive_more(queue_url, FUNCTIONS[name].get('batch_size', 1) - 1)
+        task_ids = []
+        for body in bodies:
+            data = json.loads(body)
+            task_ids.append(data['task_id'])
+            timings = (data.get('envelope') or {}).get('timings', {})
+            submitted_at.setdefault(data['task_id'], timings.get('task-receiver', {}).get('started_at', time.time()))
+            if data.get('deferrals'):
+                deferred[name] = deferred.get(name, 0) + 1
+
+        sent_before = len(sqs.sent_task_ids)
+        pipeline.invoke(name, {'messages': [{'details': {'message': {'body': body}}} for body in bodies]})
+        continued = set(sqs.sent_task_ids[sent_before:])
+
+        # Задача, по которой этап не отправил сообщений дальше, завершена — успешно или с ошибкой
+        for task_id in task_ids:
+            if task_id not in continued:
+                finished_at[task_id] = time.time()
+                outcomes[task_id] = pipeline.get_task(task_id).get('status')
+
+    wall = time.perf_counter() - started_at
+    # После прогона все слоты бюджета должны быть освобождены
+    api_budget = json.loads(pipeline.invoke('tasks-getter', {'path': '/api/quotas'})['body'])
+    server.shutdown()
+
+    end_to_end = [finished_at[task_id] - submitted_at[task_id] for task_id in finished_at]
+    statuses = {}
+    for status in outcomes.values():
+        statuses[status] = statuses.get(status, 0) + 1
+
+    return {
+        'lectures': args.lectures,
+        'video_mb': args.video_mb,
+        'wall_seconds': round(wall, 2),
+        'throughput_tasks_per_minute': round(len(finished_at) / wall * 60, 2) if wall else None,
+        'statuses': statuses,
+        'end_to_end': summarize(end_to_end),
+        'stages': {name: summarize(values) for name, values in pipeline.durations.items() if values},
+        'storage_bytes': {'uploaded': s3.bytes_in, 'downloaded': s3.bytes_out},
+        'disk_bytes': server.disk_bytes,
+        'ydb_queries': database.queries if database else None,
+        'deferred': deferred,
+        'leftover_objects': leftover_objects(s3),
+        'leftover_tmp_bytes': sum(
+            os.path.getsize(os.path.join(dirpath, name))
+            for dirpath, _, names in os.walk(tempfile.tempdir) for name in names
+        ),
+        'api_budget': {item['api']: item['operations'] for item in api_budget},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def leftover_objects(s3):
+    # После успешного прогона в бакете должны остаться только конспекты
+    prefixes = {}
+    for _, key in s3.objects:
+        prefix = key.split('/', 1)[0]
+        prefixes[prefix] = prefixes.get(prefix, 0) + 1
+    return prefixes
+
+
+def create_ydb_tables(endpoint, database):
+    import ydb
+
+    driver = ydb.Driver(ydb.DriverConfig(endpoint=endpoint, database=database,
+                                         credentials=ydb.AnonymousCredentials()))
+    driver.wait(timeout=30, fail_fast=True)
+    session = driver.table_client.session().create()
+    for ddl in YDB_TABLES:
+        try:
+            session.execute_scheme(ddl)
+        except ydb.issues.AlreadyExists:
+            pass
+    driver.stop()
+
+
+def print_report(report):
+    print(f"Лекций: {report['lectures']}, время прогона: {report['wall_seconds']} с, "
+          f"пропускная способность: {report['throughput_tasks_per_minute']} задач/мин")
+    print(f"Статусы: {report['statuses']}")
+    print(f"{'этап':<28}{'вызовов':>9}{'p50, мс':>12}{'p95, мс':>12}{'max, мс':>12}")
+    rows = list(report['stages'].items()) + [('end-to-end', report['end_to_end'])]
+    for name, stats in rows:
+        print(f"{name:<28}{stats['count']:>9}{stats['p50_ms']:>12}{stats['p95_ms']:>12}{stats['max_ms']:>12}")
+    print(f"Object Storage: загружено {report['storage_bytes']['uploaded']} Б, "
+          f"скачано {report['storage_bytes']['downloaded']} Б; с Яндекс Диска скачано {report['disk_bytes']} Б")
+    print(f"Отложено сообщений: {report['deferred']}, занятые слоты API после прогона: {report['api_budget']}")
+    print(f"Осталось объектов: {report['leftover_objects']}, во временных файлах: {report['leftover_tmp_bytes']} Б")
+    print(f"Пиковый RSS: {report['peak_rss_mb']}")
+
+
+def main():
+    args = parse_args()
+    # Логи обработчиков (JSON-строки Tracer) уходят в stderr, чтобы не смешиваться с отчетом
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        report = run(args)
+    finally:
+        sys.stdout = stdout
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
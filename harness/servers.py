@@ -0,0 +1,181 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+# Фразы для синтетической расшифровки и конспекта
+SENTENCES = [
+    'Сегодня мы рассмотрим основные понятия курса',
+    'Функция называется непрерывной, если малым изменениям аргумента соответствуют малые изменения значения',
+    'Обратите внимание на это определение, оно понадобится на экзамене',
+    'Ну вот, э-э, перейдем к примерам и разберем их подробно',
+    'Таким образом, мы получили важный промежуточный результат',
+]
+
+
+class FakeServicesConfig:
+    def __init__(self, video_bytes, disk_latency, speechkit_latency, gpt_latency, utterances, throttle_rate=0):
+        self.video_bytes = video_bytes
+        self.disk_latency = disk_latency
+        self.speechkit_latency = speechkit_latency
+        self.gpt_latency = gpt_latency
+        self.utterances = utterances
+        self.throttle_rate = throttle_rate
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    """Имитация Яндекс Диска, SpeechKit, API операций и YandexGPT с настраиваемыми задержками"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/v1/disk/public/resources':
+            time.sleep(self.config.disk_latency)
+            name = query['public_key'][0].rstrip('/').rsplit('/', 1)[-1]
+            # Публичная папка course-N с N лекциями; файлы в ней запрашиваются с параметром path
+            if name.startswith('course-') and 'path' not in query:
+                return self.send_folder(name, int(name.split('-')[1]), query)
+            if 'path' in query:
+                name = query['path'][0].rsplit('/', 1)[-1]
+            name = name if '.' in name else f'{name}.mp4'
+            is_audio = name.endswith('.mp3')
+            size = self.config.video_bytes
+            return self.send_json({
+                'name': name,
+                'type': 'file',
+                'mime_type': 'audio/mpeg' if is_audio else 'video/mp4',
+                'media_type': 'audio' if is_audio else 'video',
+                'size': size,
+                'md5': hashlib.md5(name.encode()).hexdigest(),
+                'file': f'{self.base_url}/files/{quote(name)}?size={size}'
+            })
+
+        if url.path.startswith('/files/'):
+            return self.send_file(int(query.get('size', [self.config.video_bytes])[0]), self.headers.get('Range'))
+
+        if url.path.startswith('/operations/'):
+            operation_id = url.path.rsplit('/', 1)[-1]
+            created_at = self.server.operations.get(operation_id)
+            if created_at is None:
+                return self.send_json({'error': 'not found'}, status=404)
+            done = time.monotonic() - created_at >= self.config.speechkit_latency
+            return self.send_json({'id': operation_id, 'done': done})
+
+        if url.path == '/stt/v3/getRecognition':
+            lines = []
+            for index in range(self.config.utterances):
+                text = SENTENCES[index % len(SENTENCES)]
+                lines.append(json.dumps({'result': {
+                    'channelTag': '0',
+                    'finalRefinement': {
+                        'finalIndex': str(index),
+                        'normalizedText': {'alternatives': [{'text': text}]}
+                    }
+                }}, ensure_ascii=False))
+            return self.send_bytes('\n'.join(lines).encode('utf-8'), 'application/x-ndjson')
+
+        self.send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        # Имитация исчерпанной квоты: часть запросов к SpeechKit и YandexGPT получает 429
+        if random.random() < self.config.throttle_rate:
+            return self.send_json({'error': 'quota exceeded'}, status=429, headers={'Retry-After': '1'})
+
+        if url.path == '/stt/v3/recognizeFileAsync':
+            operation_id = str(uuid.uuid4())
+            self.server.operations[operation_id] = time.monotonic()
+            return self.send_json({'id': operation_id, 'done': False})
+
+        if url.path == '/foundationModels/v1/completion':
+            time.sleep(self.config.gpt_latency)
+            prompt = body['messages'][-1]['text']
+            note = '# Конспект\n\n' + '\n'.join(f'- {sentence}' for sentence in SENTENCES)
+            return self.send_json({'result': {
+                'alternatives': [{'message': {'role': 'assistant', 'text': note}, 'status': 'ALTERNATIVE_STATUS_FINAL'}],
+                'usage': {'inputTextTokens': str(len(prompt) // 4), 'completionTokens': str(len(note) // 4)}
+            }})
+
+        self.send_json({'error': 'not found'}, status=404)
+
+    def send_folder(self, name, count, query):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['20'])[0])
+        items = [
+            {'name': f'Лекция {index}.mp4', 'path': f'/Лекция {index}.mp4', 'type': 'file', 'media_type': 'video'}
+            for index in range(1, count + 1)
+        ]
+        items.append({'name': 'notes.txt', 'path': '/notes.txt', 'type': 'file', 'media_type': 'text'})
+        return self.send_json({
+            'name': name,
+            'type': 'dir',
+            '_embedded': {'items': items[offset:offset + limit], 'total': len(items)}
+        })
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def send_json(self, payload, status=200, headers=None):
+        self.send_bytes(json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json', status, headers)
+
+    def send_bytes(self, data, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_file(self, size, byte_range=None):
+        chunk = bytes(range(256)) * 256
+        # Проба читает только начало файла range-запросом
+        start, end = 0, size - 1
+        if byte_range and byte_range.startswith('bytes='):
+            first, _, last = byte_range[len('bytes='):].partition('-')
+            start, end = int(first or 0), min(int(last or end), end)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        remaining = end - start + 1
+        while remaining > 0:
+            part = chunk[:min(len(chunk), remaining)]
+            self.wfile.write(part)
+            remaining -= len(part)
+            with self.server.lock:
+                self.server.disk_bytes += len(part)
+
+
+def start_fake_services(config):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeServicesHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.operations = {}
+    # Сколько байт файлов отдано с "Яндекс Диска" — для сравнения режимов скачивания
+    server.disk_bytes = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f'http://{host}:{port}'
@@ -72,6 +72,17 @@ resource "yandex_storage_bucket" "generator_bucket" {
   access_key    = yandex_iam_service_account_static_access_key.sa_static_key.access_key
   secret_key    = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
 
+  # Браузер загружает части видео напрямую по подписанным ссылкам и читает ETag из ответа
+  cors_rule {
+    allowed_methods = ["PUT"]
+    allowed_origins = ["*"]
+    allowed_headers = ["*"]
+    expose_headers  = ["ETag"]
+    max_age_seconds = 3600
+  }
+
+  # Промежуточные объекты удаляет этап, который их прочитал; правила ниже убирают то,
+  # что осталось от задач, упавших на середине
   lifecycle_rule {
     id      = "auto-delete-videos-after-1-day"
     enabled = true
@@ -83,6 +94,8 @@ resource "yandex_storage_bucket" "generator_bucket" {
     expiration {
       days = 1
     }
+
+    abort_incomplete_multipart_upload_days = 1
   }
 
   lifecycle_rule {
@@ -146,6 +159,16 @@ resource "yandex_storage_object" "audio_extractor_zip" {
   secret_key   = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
 }
 
+resource "yandex_storage_object" "video_downloader_zip" {
+  bucket       = yandex_storage_bucket.generator_bucket.bucket
+  key          = "video-downloader.zip"
+  source       = data.archive_file.video_downloader.output_path
+  content_type = "application/zip"
+
+  access_key   = yandex_iam_service_account_static_access_key.sa_static_key.access_key
+  secret_key   = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
+}
+
 resource "yandex_message_queue" "video_downloader_queue" {
   name                        = "${var.prefix}-video-downloader-queue"
   visibility_timeout_seconds  = 300
@@ -174,6 +197,21 @@ resource "yandex_message_queue" "audio_extractor_queue" {
   ]
 }
 
+# Медленная полоса для длинных записей: своя очередь, триггер и ограниченный пул инстансов
+resource "yandex_message_queue" "audio_extractor_slow_queue" {
+  name                        = "${var.prefix}-audio-extractor-slow-queue"
+  visibility_timeout_seconds  = 660
+  receive_wait_time_seconds   = 20
+  message_retention_seconds   = 1209600
+  
+  access_key = yandex_iam_service_account_static_access_key.sa_static_key.access_key
+  secret_key = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
+
+  depends_on = [
+    yandex_resourcemanager_folder_iam_member.queue_admin
+  ]
+}
+
 resource "yandex_message_queue" "speech_recognizer_queue" {
   name                        = "${var.prefix}-speech-recognizer-queue"
   visibility_timeout_seconds  = 300
@@ -250,6 +288,23 @@ resource "yandex_function_trigger" "audio_extractor_trigger" {
   }
 }
 
+resource "yandex_function_trigger" "audio_extractor_slow_trigger" {
+  name        = "${var.prefix}-audio-extractor-slow-queue-trigger"
+  description = "Trigger for processing messages from audio_extractor_slow_queue"
+  
+  message_queue {
+    queue_id           = yandex_message_queue.audio_extractor_slow_queue.arn
+    service_account_id = yandex_iam_service_account.generator_sa.id
+    batch_size         = 1
+    batch_cutoff       = 10
+  }
+  
+  function {
+    id                 = yandex_function.audio_extractor_slow.id
+    service_account_id = yandex_iam_service_account.generator_sa.id
+  }
+}
+
 resource "yandex_function_trigger" "speech_recognizer_trigger" {
   name        = "${var.prefix}-speech-recognizer-queue-trigger"
   description = "Trigger for processing messages from speech_recognizer_queue"
@@ -257,8 +312,9 @@ resource "yandex_function_trigger" "speech_recognizer_trigger" {
   message_queue {
     queue_id           = yandex_message_queue.speech_recognizer_queue.arn
     service_account_id = yandex_iam_service_account.generator_sa.id
-    batch_size         = 1
-    batch_cutoff       = 10
+    # Пачка сообщений обрабатывается конкурентно в одном вызове
+    batch_size         = 10
+    batch_cutoff       = 2
   }
   
   function {
@@ -274,8 +330,9 @@ resource "yandex_function_trigger" "speech_recognizer_checker_trigger" {
   message_queue {
     queue_id           = yandex_message_queue.speech_recognizer_checker_queue.arn
     service_account_id = yandex_iam_service_account.generator_sa.id
-    batch_size         = 1
-    batch_cutoff       = 10
+    # Пачка сообщений обрабатывается конкурентно в одном вызове
+    batch_size         = 10
+    batch_cutoff       = 2
   }
   
   function {
@@ -291,8 +348,9 @@ resource "yandex_function_trigger" "note_generator_trigger" {
   message_queue {
     queue_id           = yandex_message_queue.note_generator_queue.arn
     service_account_id = yandex_iam_service_account.generator_sa.id
-    batch_size         = 1
-    batch_cutoff       = 10
+    # Пачка сообщений обрабатывается конкурентно в одном вызове
+    batch_size         = 4
+    batch_cutoff       = 2
   }
   
   function {
@@ -307,10 +365,21 @@ data "archive_file" "task_receiver" {
   output_path = "${path.module}/../functions/task-receiver.zip"
 }
 
+# video-downloader запускает тот же ffmpeg, что и audio-extractor: бинарник копируется в архив
+resource "local_file" "video_downloader_ffmpeg" {
+  source          = "${path.module}/../functions/audio-extractor/ffmpeg"
+  filename        = "${path.module}/../functions/video-downloader/ffmpeg"
+  file_permission = "0755"
+}
+
 data "archive_file" "video_downloader" {
   type        = "zip"
   source_dir  = "${path.module}/../functions/video-downloader"
   output_path = "${path.module}/../functions/video-downloader.zip"
+
+  depends_on = [
+    local_file.video_downloader_ffmpeg
+  ]
 }
 
 data "archive_file" "audio_extractor" {
@@ -355,6 +424,10 @@ resource "yandex_function" "task_receiver" {
   
   environment = {
     QUEUE_URL              = yandex_message_queue.video_downloader_queue.id
+    AUDIO_QUEUE_URL        = yandex_message_queue.audio_extractor_queue.id
+    AUDIO_SLOW_QUEUE_URL   = yandex_message_queue.audio_extractor_slow_queue.id
+    EXTRACTOR_MEMORY_MB    = min(yandex_function.audio_extractor.memory, yandex_function.audio_extractor_slow.memory)
+    STORAGE_BUCKET         = yandex_storage_bucket.generator_bucket.bucket
     AWS_ACCESS_KEY_ID      = yandex_iam_service_account_static_access_key.sa_static_key.access_key
     AWS_SECRET_ACCESS_KEY  = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
     YDB_ENDPOINT           = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
@@ -379,17 +452,29 @@ resource "yandex_function" "video_downloader" {
   
   environment = {
     QUEUE_URL              = yandex_message_queue.audio_extractor_queue.id
+    SLOW_QUEUE_URL         = yandex_message_queue.audio_extractor_slow_queue.id
+    SPEECH_QUEUE_URL       = yandex_message_queue.speech_recognizer_queue.id
+    SELF_QUEUE_URL         = yandex_message_queue.video_downloader_queue.id
+    SUBMITTER_SLOTS        = var.downloader_submitter_slots
     AWS_ACCESS_KEY_ID      = yandex_iam_service_account_static_access_key.sa_static_key.access_key
     AWS_SECRET_ACCESS_KEY  = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
     STORAGE_BUCKET         = yandex_storage_bucket.generator_bucket.bucket
     YDB_ENDPOINT           = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
     YDB_DATABASE           = yandex_ydb_database_serverless.tasks_database.database_path
+    FUSED_EXTRACTION       = var.fused_audio_extraction ? "true" : "false"
+    STORE_SOURCE_VIDEO     = var.store_source_video ? "true" : "false"
     PYTHONUNBUFFERED       = "1"
   }
-  
-  content {
-    zip_filename = data.archive_file.video_downloader.output_path
+
+  # Архив с ffmpeg больше лимита прямой загрузки, поэтому — через Object Storage
+  package {
+    bucket_name = yandex_storage_object.video_downloader_zip.bucket
+    object_name = yandex_storage_object.video_downloader_zip.key
   }
+
+  depends_on = [
+    yandex_storage_object.video_downloader_zip
+  ]
 }
 
 resource "yandex_function" "audio_extractor" {
@@ -404,6 +489,9 @@ resource "yandex_function" "audio_extractor" {
 
   environment = {
     QUEUE_URL             = yandex_message_queue.speech_recognizer_queue.id
+    SELF_QUEUE_URL        = yandex_message_queue.audio_extractor_queue.id
+    LANE                  = "fast"
+    SUBMITTER_SLOTS       = var.extractor_submitter_slots
     STORAGE_BUCKET        = yandex_storage_bucket.generator_bucket.bucket
     AWS_ACCESS_KEY_ID     = yandex_iam_service_account_static_access_key.sa_static_key.access_key
     AWS_SECRET_ACCESS_KEY = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
@@ -422,6 +510,50 @@ resource "yandex_function" "audio_extractor" {
   ]
 }
 
+resource "yandex_function" "audio_extractor_slow" {
+  name               = "${var.prefix}-audio-extractor-slow"
+  description        = "Extracting audio from long recordings using ffmpeg"
+  user_hash          = data.archive_file.audio_extractor.output_base64sha256
+  runtime            = "python39"
+  entrypoint         = "main.handler"
+  memory             = 2048    
+  execution_timeout  = 600    
+  service_account_id = yandex_iam_service_account.generator_sa.id
+
+  environment = {
+    QUEUE_URL             = yandex_message_queue.speech_recognizer_queue.id
+    SELF_QUEUE_URL        = yandex_message_queue.audio_extractor_slow_queue.id
+    LANE                  = "slow"
+    SUBMITTER_SLOTS       = var.slow_extractor_submitter_slots
+    STORAGE_BUCKET        = yandex_storage_bucket.generator_bucket.bucket
+    AWS_ACCESS_KEY_ID     = yandex_iam_service_account_static_access_key.sa_static_key.access_key
+    AWS_SECRET_ACCESS_KEY = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
+    YDB_ENDPOINT          = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
+    YDB_DATABASE          = yandex_ydb_database_serverless.tasks_database.database_path
+    PYTHONUNBUFFERED      = "1"
+  }
+
+  package {
+    bucket_name = yandex_storage_object.audio_extractor_zip.bucket
+    object_name = yandex_storage_object.audio_extractor_zip.key
+  }
+
+  depends_on = [
+    yandex_storage_object.audio_extractor_zip
+  ]
+}
+
+# Длинные записи не занимают больше двух инстансов, чтобы не вытеснять быструю полосу
+resource "yandex_function_scaling_policy" "audio_extractor_slow" {
+  function_id = yandex_function.audio_extractor_slow.id
+
+  policy {
+    tag                  = "$latest"
+    zone_instances_limit = 2
+    zone_requests_limit  = 2
+  }
+}
+
 resource "yandex_function" "speech_recognizer" {
   name               = "${var.prefix}-speech-recognizer"
   description        = "Recognize speech"
@@ -433,14 +565,17 @@ resource "yandex_function" "speech_recognizer" {
   service_account_id = yandex_iam_service_account.generator_sa.id
   
   environment = {
-    QUEUE_URL             = yandex_message_queue.speech_recognizer_checker_queue.id
-    AWS_ACCESS_KEY_ID     = yandex_iam_service_account_static_access_key.sa_static_key.access_key
-    AWS_SECRET_ACCESS_KEY = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
-    YDB_ENDPOINT          = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
-    YDB_DATABASE          = yandex_ydb_database_serverless.tasks_database.database_path
-    FOLDER_ID             = var.folder_id
-    API_KEY               = yandex_iam_service_account_api_key.sa_api_key.secret_key
-    PYTHONUNBUFFERED      = "1"
+    QUEUE_URL                = yandex_message_queue.speech_recognizer_checker_queue.id
+    SELF_QUEUE_URL           = yandex_message_queue.speech_recognizer_queue.id
+    AWS_ACCESS_KEY_ID        = yandex_iam_service_account_static_access_key.sa_static_key.access_key
+    AWS_SECRET_ACCESS_KEY    = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
+    YDB_ENDPOINT             = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
+    YDB_DATABASE             = yandex_ydb_database_serverless.tasks_database.database_path
+    FOLDER_ID                = var.folder_id
+    API_KEY                  = yandex_iam_service_account_api_key.sa_api_key.secret_key
+    SPEECHKIT_MAX_OPERATIONS = var.speechkit_max_operations
+    SPEECHKIT_MAX_RPS        = var.speechkit_max_rps
+    PYTHONUNBUFFERED         = "1"
   }
   
   content {
@@ -482,12 +617,14 @@ resource "yandex_function" "note_generator" {
   user_hash          = data.archive_file.note_generator.output_base64sha256
   runtime            = "python39"
   entrypoint         = "main.handler"
-  memory             = 2048   
+  # Рендеринг конспекта 4-часовой лекции занимает меньше 100 МБ вместе с клиентами SDK
+  memory             = 512
   execution_timeout  = 600    
   service_account_id = yandex_iam_service_account.generator_sa.id
   
   environment = {
     QUEUE_URL             = yandex_message_queue.speech_recognizer_checker_queue.id
+    SELF_QUEUE_URL        = yandex_message_queue.note_generator_queue.id
     AWS_ACCESS_KEY_ID     = yandex_iam_service_account_static_access_key.sa_static_key.access_key
     AWS_SECRET_ACCESS_KEY = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
     STORAGE_BUCKET        = yandex_storage_bucket.generator_bucket.bucket
@@ -495,6 +632,8 @@ resource "yandex_function" "note_generator" {
     YDB_DATABASE          = yandex_ydb_database_serverless.tasks_database.database_path
     FOLDER_ID             = var.folder_id
     API_KEY               = yandex_iam_service_account_api_key.sa_api_key.secret_key
+    GPT_MAX_OPERATIONS    = var.gpt_max_operations
+    GPT_MAX_RPS           = var.gpt_max_rps
     PYTHONUNBUFFERED      = "1"
   }
   
@@ -514,11 +653,15 @@ resource "yandex_function" "tasks_getter" {
   service_account_id = yandex_iam_service_account.generator_sa.id
   
   environment = {
-    YDB_ENDPOINT          = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
-    YDB_DATABASE          = yandex_ydb_database_serverless.tasks_database.database_path
-    AWS_ACCESS_KEY_ID     = yandex_iam_service_account_static_access_key.sa_static_key.access_key
-    AWS_SECRET_ACCESS_KEY = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
-    PYTHONUNBUFFERED      = "1"
+    YDB_ENDPOINT             = yandex_ydb_database_serverless.tasks_database.ydb_api_endpoint
+    YDB_DATABASE             = yandex_ydb_database_serverless.tasks_database.database_path
+    AWS_ACCESS_KEY_ID        = yandex_iam_service_account_static_access_key.sa_static_key.access_key
+    AWS_SECRET_ACCESS_KEY    = yandex_iam_service_account_static_access_key.sa_static_key.secret_key
+    SPEECHKIT_MAX_OPERATIONS = var.speechkit_max_operations
+    SPEECHKIT_MAX_RPS        = var.speechkit_max_rps
+    GPT_MAX_OPERATIONS       = var.gpt_max_operations
+    GPT_MAX_RPS              = var.gpt_max_rps
+    PYTHONUNBUFFERED         = "1"
   }
   
   content {
@@ -551,6 +694,18 @@ paths:
         service_account_id: ${yandex_iam_service_account.generator_sa.id}
   /api/tasks:
     get:
+      parameters:
+        - name: wait
+          in: query
+          required: false
+          description: Long-poll timeout in seconds (max 60); returns only tasks updated after since
+          schema:
+            type: integer
+        - name: since
+          in: query
+          required: false
+          schema:
+            type: string
       x-yc-apigateway-integration:
         type: cloud-functions
         function_id: ${yandex_function.tasks_getter.id}
@@ -571,6 +726,95 @@ paths:
               schema:
                 type: string
           content: {}  
+  /api/tasks/batch:
+    post:
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.task_receiver.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
+  /api/uploads:
+    post:
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.task_receiver.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
+  /api/uploads/{taskId}/complete:
+    post:
+      parameters:
+        - name: taskId
+          in: path
+          required: true
+          schema:
+            type: string
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.task_receiver.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
+  /api/uploads/{taskId}/abort:
+    post:
+      parameters:
+        - name: taskId
+          in: path
+          required: true
+          schema:
+            type: string
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.task_receiver.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
+  /api/tasks/{taskId}:
+    get:
+      parameters:
+        - name: taskId
+          in: path
+          required: true
+          schema:
+            type: string
+        - name: wait
+          in: query
+          required: false
+          description: Long-poll timeout in seconds (max 60)
+          schema:
+            type: integer
+        - name: status
+          in: query
+          required: false
+          schema:
+            type: string
+        - name: updatedAt
+          in: query
+          required: false
+          schema:
+            type: string
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.tasks_getter.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
+  /api/tasks/{taskId}/timeline:
+    get:
+      parameters:
+        - name: taskId
+          in: path
+          required: true
+          schema:
+            type: string
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.tasks_getter.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
+  /api/quotas:
+    get:
+      x-yc-apigateway-integration:
+        type: cloud-functions
+        function_id: ${yandex_function.tasks_getter.id}
+        service_account_id: ${yandex_iam_service_account.generator_sa.id}
+        tag: $latest
 EOT
 }
 
@@ -619,11 +863,19 @@ resource "yandex_ydb_table" "tasks" {
     type = "Utf8"
     not_null = true
   }
+  column {
+    name = "stage"
+    type = "Utf8"
+  }
   column {
     name = "createdAt"
     type = "Timestamp"
     not_null = true
   }
+  column {
+    name = "updatedAt"
+    type = "Timestamp"
+  }
   column {
     name = "pdfUrl"
     type = "Utf8"
@@ -632,6 +884,18 @@ resource "yandex_ydb_table" "tasks" {
     name = "errorMessage"
     type = "Utf8"
   }
+  column {
+    name = "route"
+    type = "Utf8"
+  }
+  column {
+    name = "probe"
+    type = "Json"
+  }
+  column {
+    name = "submitter"
+    type = "Utf8"
+  }
   
   primary_key = ["taskId"]
 
@@ -639,3 +903,126 @@ resource "yandex_ydb_table" "tasks" {
     time_sleep.wait_60_seconds
   ]
 }
+
+# Long-poll списка задач читает только измененные строки — диапазон по индексу, а не всю таблицу
+resource "yandex_ydb_table_index" "tasks_updated_at" {
+  table_id = yandex_ydb_table.tasks.id
+  name     = "idx_updated_at"
+  type     = "global_sync"
+  columns  = ["updatedAt"]
+}
+
+resource "yandex_ydb_table" "task_events" {
+  path = "task_events"
+  connection_string = yandex_ydb_database_serverless.tasks_database.ydb_full_endpoint
+
+  column {
+    name = "taskId"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "createdAt"
+    type = "Timestamp"
+    not_null = true
+  }
+  column {
+    name = "stage"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "event"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "message"
+    type = "Utf8"
+  }
+  column {
+    name = "durationMs"
+    type = "Uint64"
+  }
+  column {
+    name = "bytes"
+    type = "Uint64"
+  }
+
+  primary_key = ["taskId", "createdAt", "stage", "event"]
+
+  depends_on = [
+    time_sleep.wait_60_seconds
+  ]
+}
+
+resource "yandex_ydb_table" "submitter_slots" {
+  path = "submitter_slots"
+  connection_string = yandex_ydb_database_serverless.tasks_database.ydb_full_endpoint
+
+  column {
+    name = "submitter"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "stage"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "taskId"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "acquiredAt"
+    type = "Timestamp"
+    not_null = true
+  }
+
+  primary_key = ["submitter", "stage", "taskId"]
+
+  depends_on = [
+    time_sleep.wait_60_seconds
+  ]
+}
+
+# Общий бюджет SpeechKit и YandexGPT: занятые слоты операций и отметки запросов за последнюю секунду
+resource "yandex_ydb_table" "api_budget" {
+  path = "api_budget"
+  connection_string = yandex_ydb_database_serverless.tasks_database.ydb_full_endpoint
+
+  column {
+    name = "api"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "leaseId"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "kind"
+    type = "Utf8"
+    not_null = true
+  }
+  column {
+    name = "expiresAt"
+    type = "Timestamp"
+    not_null = true
+  }
+
+  primary_key = ["api", "leaseId"]
+
+  # Истекшие строки функции не учитывают, а фоновое удаление не дает таблице расти
+  ttl {
+    column_name     = "expiresAt"
+    expire_interval = "PT1H"
+  }
+
+  depends_on = [
+    time_sleep.wait_60_seconds
+  ]
+}
@@ -25,4 +25,57 @@ variable "prefix" {
   description = "Prefix for names"
   type        = string
   default     = "vvot13"
-}
\ No newline at end of file
+}
+variable "speechkit_max_operations" {
+  description = "Max concurrent SpeechKit recognition operations across all function instances"
+  type        = number
+  default     = 10
+}
+
+variable "speechkit_max_rps" {
+  description = "Max SpeechKit recognition requests per second"
+  type        = number
+  default     = 5
+}
+
+variable "gpt_max_operations" {
+  description = "Max concurrent YandexGPT completion requests across all function instances"
+  type        = number
+  default     = 10
+}
+
+variable "gpt_max_rps" {
+  description = "Max YandexGPT completion requests per second"
+  type        = number
+  default     = 10
+}
+
+variable "fused_audio_extraction" {
+  description = "Extract audio in video-downloader directly from the Yandex Disk link, skipping audio-extractor"
+  type        = bool
+  default     = false
+}
+
+variable "store_source_video" {
+  description = "Keep the source video in videos/ when audio is extracted in video-downloader"
+  type        = bool
+  default     = false
+}
+
+variable "downloader_submitter_slots" {
+  description = "Max concurrent video downloads per submitter while other tasks are queued (0 disables the limit)"
+  type        = number
+  default     = 2
+}
+
+variable "extractor_submitter_slots" {
+  description = "Max concurrent fast-lane audio extractions per submitter while other tasks are queued (0 disables the limit)"
+  type        = number
+  default     = 4
+}
+
+variable "slow_extractor_submitter_slots" {
+  description = "Max concurrent slow-lane audio extractions per submitter while other tasks are queued (0 disables the limit)"
+  type        = number
+  default     = 1
+}